@@ -1,9 +1,16 @@
 from typing import ClassVar
 
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from helpdesk import settings as helpdesk_settings
+from helpdesk.email import (
+    close_queue_logger,
+    get_queue_logger,
+    reprocess_quarantined_email,
+)
+from helpdesk.exceptions import DeleteIgnoredTicketException, IgnoreTicketException
 from helpdesk.models import (
     Checklist,
     ChecklistTask,
@@ -15,7 +22,9 @@ from helpdesk.models import (
     FollowUpAttachment,
     IgnoreEmail,
     KBIAttachment,
+    OutgoingEmail,
     PreSetReply,
+    QuarantinedEmail,
     Queue,
     Ticket,
     TicketChange,
@@ -138,6 +147,89 @@ class IgnoreEmailAdmin(admin.ModelAdmin):
     list_display = ("name", "queue_list", "email_address", "keep_in_mailbox")
 
 
+@admin.register(QuarantinedEmail)
+class QuarantinedEmailAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "queue", "failures", "date", "quarantined")
+    list_filter = ("queue", "quarantined")
+    readonly_fields = (
+        "queue",
+        "message_id",
+        "content_hash",
+        "failures",
+        "last_error",
+        "file",
+        "date",
+        "quarantined",
+    )
+    actions = ("reprocess",)
+
+    @admin.action(description=_("Re-process the selected quarantined e-mails"))
+    def reprocess(self, request, queryset):
+        for entry in queryset.filter(quarantined__isnull=False).select_related("queue"):
+            name = str(entry)
+            logger, log_file_handler = get_queue_logger(entry.queue, quiet=True)
+            try:
+                ticket = reprocess_quarantined_email(entry, logger)
+            except (IgnoreTicketException, DeleteIgnoredTicketException):
+                self.message_user(
+                    request,
+                    _("%(email)s was ignored, its sender is an ignored e-mail address.")
+                    % {"email": name},
+                    messages.WARNING,
+                )
+            except Exception as e:  # noqa: BLE001 - reported to the user
+                self.message_user(
+                    request,
+                    _("%(email)s failed again: %(error)s")
+                    % {"email": name, "error": e},
+                    messages.ERROR,
+                )
+            else:
+                if ticket:
+                    self.message_user(
+                        request,
+                        _("%(email)s was processed into ticket %(ticket)s.")
+                        % {"email": name, "ticket": ticket.ticket},
+                        messages.SUCCESS,
+                    )
+                else:
+                    self.message_user(
+                        request,
+                        _("%(email)s was not processed.") % {"email": name},
+                        messages.WARNING,
+                    )
+            finally:
+                close_queue_logger(logger, log_file_handler)
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "recipients", "attempts", "next_attempt", "failed")
+    list_filter = ("failed",)
+    search_fields = ("subject",)
+    exclude = ("message",)
+    readonly_fields = (
+        "from_email",
+        "recipients",
+        "subject",
+        "created",
+        "next_attempt",
+        "attempts",
+        "last_error",
+        "failed",
+    )
+    actions = ("retry",)
+
+    @admin.action(description=_("Retry sending the selected e-mails"))
+    def retry(self, request, queryset):
+        retried = queryset.update(failed=None, attempts=0, next_attempt=timezone.now())
+        self.message_user(
+            request,
+            _("%(count)d e-mail(s) will be sent again.") % {"count": retried},
+            messages.SUCCESS,
+        )
+
+
 @admin.register(ChecklistTemplate)
 class ChecklistTemplateAdmin(admin.ModelAdmin):
     list_display = ("name", "task_list")
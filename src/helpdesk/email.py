@@ -8,31 +8,55 @@ See LICENSE for details.
 # import base64
 from __future__ import annotations
 
+import binascii
+import contextlib
 import email
+import hashlib
 import imaplib
+import itertools
 import logging
 import mimetypes
 import os
 import poplib
 import re
-import socket
+import select
+import shutil
 import ssl
 import sys
+import threading
+import time
 import traceback
-from datetime import timedelta
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
 from email import policy
 from email.message import EmailMessage, MIMEPart
-from email.utils import getaddresses
-from os.path import isfile, join
+from email.parser import BytesHeaderParser, HeaderParser
+from email.utils import getaddresses, parsedate_to_datetime
+from html.parser import HTMLParser
+from os.path import join
 from time import ctime
 
+import django
 import oauthlib.oauth2 as oauth2lib
 import requests_oauthlib
-from bs4 import BeautifulSoup
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import (
+    SimpleUploadedFile,
+    TemporaryUploadedFile,
+    UploadedFile,
+)
+from django.db import DatabaseError, connections
 from django.db.models import Q
 from django.utils import encoding, timezone
 from django.utils.translation import gettext as _
@@ -41,8 +65,18 @@ from email_reply_parser import EmailReplyParser
 from helpdesk import settings as helpdesk_settings
 from helpdesk.exceptions import DeleteIgnoredTicketException, IgnoreTicketException
 from helpdesk.lib import process_attachments, safe_template_context
-from helpdesk.models import FollowUp, IgnoreEmail, Queue, Ticket
+from helpdesk.models import (
+    FollowUp,
+    IgnoreEmail,
+    IngestedEmail,
+    QuarantinedEmail,
+    Queue,
+    SeenPOP3Message,
+    Ticket,
+    TicketCC,
+)
 from helpdesk.signals import new_ticket_done, update_ticket_done
+from helpdesk.templated_email import notification_batch
 
 # import User model, which may be a custom model
 User = get_user_model()
@@ -76,80 +110,266 @@ STRIPPED_SUBJECT_STRINGS = [
 # the web server serves.
 HTML_EMAIL_ATTACHMENT_FILENAME = "email_html_body.txt"
 
+IMAP_FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+IMAP_FETCH_SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
 
-def process_email(quiet: bool = False, debug_to_stdout: bool = False):
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes
+IMAP_IDLE_TIMEOUT = 29 * 60
+
+# Characters of base64 encoded payload decoded at a time when spooling
+ATTACHMENT_DECODE_CHUNK_SIZE = 1024 * 1024
+BASE64_JUNK_RE = re.compile(r"[^A-Za-z0-9+/]")
+
+# Ticket tracking ID in a subject, eg. "[queue-slug-123]"
+TRACKING_ID_RE = re.compile(r"\[([-\w]+)-(\d+)\]")
+
+MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+# Most recent References looked up to thread a reply
+MAX_REFERENCES = 50
+
+# POP3 messages retrieved, and processed, together
+POP3_PIPELINE_DEPTH = 16
+
+# Pool of processes parsing e-mails, see get_parse_executor()
+PARSE_EXECUTOR = None
+PARSE_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_queue_logger(q: Queue, quiet: bool = False):
+    """Configure the logger of a queue according to its logging settings
+
+    Returns the logger and, if the queue logs to its own file, the handler
+    that must be handed back to close_queue_logger() once the queue is done.
+    """
+    logger = logging.getLogger("django.helpdesk.queue." + q.slug)
+    logging_types = {
+        "info": logging.INFO,
+        "warn": logging.WARNING,
+        "error": logging.ERROR,
+        "crit": logging.CRITICAL,
+        "debug": logging.DEBUG,
+    }
+    if q.logging_type in logging_types:
+        logger.setLevel(logging_types[q.logging_type])
+    elif not q.logging_type or q.logging_type == "none":
+        # disable all handlers so messages go to nowhere
+        logger.handlers = []
+        logger.propagate = False
+    if quiet:
+        logger.propagate = (
+            False  # do not propagate to root logger that would log to console
+        )
+    # Log messages to specific file only if the queue has it configured
+    if (
+        q.logging_type in logging_types
+    ) and q.logging_dir:  # if it's enabled and the dir is set
+        log_file_handler = logging.FileHandler(
+            join(q.logging_dir, q.slug + "_get_email.log")
+        )
+        logger.addHandler(log_file_handler)
+    else:
+        log_file_handler = None
+    return logger, log_file_handler
+
+
+def close_queue_logger(logger: logging.Logger, log_file_handler) -> None:
+    # we must close the file handler correctly if it's created
+    try:
+        if log_file_handler:
+            log_file_handler.close()
+    except Exception:
+        logger.exception("Failed to close log file handler")
+    try:
+        if log_file_handler:
+            logger.removeHandler(log_file_handler)
+    except Exception:
+        logger.exception("Failed to remove log file handler")
+
+
+def poll_queue(q: Queue, quiet: bool = False, debug_to_stdout: bool = False):
+    """Poll the mailbox of a single queue if its check interval has elapsed
+
+    Any failure is logged to the queue's logger and does not propagate, so
+    that one broken mailbox cannot stop the other queues from being polled.
+    """
+    log_msg = f"Processing queue: {q.slug} Email address: {q.email_address}..."
+    if debug_to_stdout:
+        print(log_msg)
+    logger, log_file_handler = get_queue_logger(q, quiet)
+    if not log_file_handler and not q.email_box_last_check:
+        q.email_box_last_check = timezone.now() - timedelta(minutes=30)
+    try:
+        queue_time_delta = timedelta(minutes=q.email_box_interval or 0)
+        if (q.email_box_last_check + queue_time_delta) < timezone.now():
+            process_queue(q, logger=logger)
+            q.email_box_last_check = timezone.now()
+            q.save(update_fields=["email_box_last_check"])
+            log_msg: str = f"Queue successfully processed: {q.slug}"
+            logger.info(log_msg)
+            if debug_to_stdout:
+                print(log_msg)
+    except Exception:
+        logger.exception(f"Queue processing failed: {q.slug}")
+        if debug_to_stdout:
+            print(f"Queue processing failed: {q.slug}")
+            print("-" * 60)
+            traceback.print_exc(file=sys.stdout)
+    finally:
+        close_queue_logger(logger, log_file_handler)
+
+
+def poll_queue_in_worker(q: Queue, quiet: bool, debug_to_stdout: bool):
+    """Run poll_queue() in a pool thread, releasing its DB connections after"""
+    try:
+        poll_queue(q, quiet=quiet, debug_to_stdout=debug_to_stdout)
+    finally:
+        connections.close_all()
+
+
+def process_email(
+    quiet: bool = False, debug_to_stdout: bool = False, workers: int | None = None
+):
+    """Poll the mailbox of every queue that accepts e-mail submission
+
+    With more than one worker, the queues are polled concurrently by a pool
+    of threads, so the total time is bound by the slowest mailbox rather than
+    the sum of all of them.
+    """
     if debug_to_stdout:
         print("Extracting email into queues...")
-    q: Queue()  # Typing ahead of time for loop to make it more useful in an IDE
-    for q in Queue.objects.filter(
+    workers = workers or helpdesk_settings.HELPDESK_EMAIL_POLL_WORKERS
+    queues = Queue.objects.filter(
         email_box_type__isnull=False, allow_email_submission=True
-    ):
-        log_msg = f"Processing queue: {q.slug} Email address: {q.email_address}..."
-        if debug_to_stdout:
-            print(log_msg)
-        logger = logging.getLogger("django.helpdesk.queue." + q.slug)
-        logging_types = {
-            "info": logging.INFO,
-            "warn": logging.WARNING,
-            "error": logging.ERROR,
-            "crit": logging.CRITICAL,
-            "debug": logging.DEBUG,
-        }
-        if q.logging_type in logging_types:
-            logger.setLevel(logging_types[q.logging_type])
-        elif not q.logging_type or q.logging_type == "none":
-            # disable all handlers so messages go to nowhere
-            logger.handlers = []
-            logger.propagate = False
-        if quiet:
-            logger.propagate = (
-                False  # do not propagate to root logger that would log to console
-            )
-        # Log messages to specific file only if the queue has it configured
-        if (
-            q.logging_type in logging_types
-        ) and q.logging_dir:  # if it's enabled and the dir is set
-            log_file_handler = logging.FileHandler(
-                join(q.logging_dir, q.slug + "_get_email.log")
-            )
-            logger.addHandler(log_file_handler)
-        else:
-            log_file_handler = None
-            if not q.email_box_last_check:
-                q.email_box_last_check = timezone.now() - timedelta(minutes=30)
-        try:
-            queue_time_delta = timedelta(minutes=q.email_box_interval or 0)
-            if (q.email_box_last_check + queue_time_delta) < timezone.now():
-                process_queue(q, logger=logger)
-                q.email_box_last_check = timezone.now()
-                q.save()
-                log_msg: str = f"Queue successfully processed: {q.slug}"
-                logger.info(log_msg)
-                if debug_to_stdout:
-                    print(log_msg)
-        except Exception:
-            logger.exception(f"Queue processing failed: {q.slug}")
-            if debug_to_stdout:
-                print(f"Queue processing failed: {q.slug}")
-                print("-" * 60)
-                traceback.print_exc(file=sys.stdout)
-        finally:
-            # we must close the file handler correctly if it's created
-            try:
-                if log_file_handler:
-                    log_file_handler.close()
-            except Exception:
-                logger.exception("Failed to close log file handler")
-            try:
-                if log_file_handler:
-                    logger.removeHandler(log_file_handler)
-            except Exception:
-                logger.exception("Failed to remove log file handler")
+    )
+    if workers > 1:
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="helpdesk-get-email"
+        ) as executor:
+            for q in queues:
+                executor.submit(poll_queue_in_worker, q, quiet, debug_to_stdout)
+    else:
+        for q in queues:
+            poll_queue(q, quiet=quiet, debug_to_stdout=debug_to_stdout)
     if debug_to_stdout:
         print("Email extraction into queues completed.")
 
 
+def message_batches(sizes, batch_size: int, max_bytes: int):
+    """Group (key, size) pairs of messages into lists of keys to be retrieved
+    together, eg IMAP UIDs or POP3 message numbers
+
+    Each batch holds at most batch_size messages and at most max_bytes bytes,
+    except for a single message larger than max_bytes which gets its own batch.
+    """
+    batch, batch_bytes = [], 0
+    for key, size in sizes:
+        if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(key)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def pop3_listing(lines) -> list:
+    """Split the "<num> <size>" or "<num> <uidl>" lines of LIST or UIDL"""
+    listing = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("ascii", "replace")
+        num, __, value = line.partition(" ")
+        listing.append((num, value.strip()))
+    return listing
+
+
+def pop3_capabilities(server) -> dict:
+    """Capabilities announced by the POP3 server, empty if it lacks CAPA"""
+    try:
+        return server.capa()
+    except poplib.error_proto:
+        return {}
+
+
+def pop3_long_commands(server, command: str, args_list, pipelining: bool) -> list:
+    """
+    Send a POP3 command with a multi-line response, RETR or TOP, for each of
+    args_list, and return the lines of each response, None for an error
+
+    With pipelining, all the commands are sent before the first response is
+    read, so the batch costs a single round trip. poplib has no public API for
+    this, so it relies on the private POP3._putcmd() and POP3._getlongresp(),
+    which are unchanged in Python 3.9 to 3.13.
+    """
+    results = []
+    if not pipelining:
+        method = getattr(server, command.lower())
+        for args in args_list:
+            try:
+                results.append(method(*args)[1])
+            except poplib.error_proto:
+                results.append(None)
+        return results
+    # Private poplib API, see above
+    for args in args_list:
+        server._putcmd(" ".join((command, *map(str, args))))
+    for __ in args_list:
+        try:
+            results.append(server._getlongresp()[1])
+        except poplib.error_proto:
+            # The error is a single line, the next responses are still readable
+            results.append(None)
+    return results
+
+
+def pop3_prescreen(q, logger, server, messages, pipelining: bool, kept: list):
+    """
+    Read the headers of the messages with TOP, leaving or deleting those of
+    ignored senders before their body is downloaded
+
+    The UIDLs of the messages left on the server are added to kept. Returns
+    the (num, uidl) of the other messages.
+    """
+    remaining = []
+    headers = pop3_long_commands(
+        server, "TOP", [(num, 0) for num, __ in messages], pipelining
+    )
+    for (num, uidl), lines in zip(messages, headers):
+        keep_in_mailbox = None
+        if lines:
+            joined = b"\r\n".join(
+                line.encode() if isinstance(line, str) else line for line in lines
+            )
+            sender_hdr = BytesHeaderParser(policy=policy.default).parsebytes(joined)[
+                "from"
+            ]
+            if sender_hdr:
+                sender_email = email.utils.parseaddr(str(sender_hdr))[1]
+                keep_in_mailbox = IgnoreEmail.objects.match(q, sender_email)
+        if keep_in_mailbox is None:
+            remaining.append((num, uidl))
+        elif keep_in_mailbox:
+            kept.append(uidl)
+            logger.warning(f"Message {num} was ignored and will be left on POP3 server")
+        else:
+            server.dele(num)
+            logger.warning(f"Message {num} was ignored and deleted from POP3 server")
+    return remaining
+
+
 def pop3_sync(q, logger, server):
+    """
+    Process the messages of a POP3 mailbox
+
+    Messages are retrieved POP3_PIPELINE_DEPTH at a time, and no more than
+    HELPDESK_POP3_RETR_BATCH_MAX_BYTES according to their LIST sizes, in a
+    single round trip when the server supports PIPELINING. When ignored
+    addresses apply to the queue and the server supports TOP, the headers of
+    the messages are read first so that those of ignored senders are not
+    downloaded. With
+    HELPDESK_POP3_UIDL_TRACKING, the messages left on the server are not
+    downloaded again on the next polls.
+    """
     server.getwelcome()
     try:
         server.stls()
@@ -160,53 +380,293 @@ def pop3_sync(q, logger, server):
     server.user(q.email_box_user or helpdesk_settings.QUEUE_EMAIL_BOX_USER)
     server.pass_(q.email_box_pass or helpdesk_settings.QUEUE_EMAIL_BOX_PASSWORD)
 
-    messagesInfo = server.list()[1]
-    logger.info(f"Received {len(messagesInfo)} messages from POP3 server")
+    sizes = {
+        num: int(size) if size.isdigit() else 0
+        for num, size in pop3_listing(server.list()[1])
+    }
+    tracking = helpdesk_settings.HELPDESK_POP3_UIDL_TRACKING
+    if tracking:
+        messages = pop3_listing(server.uidl()[1])
+    else:
+        messages = [(num, None) for num in sizes]
+    logger.info(f"Received {len(messages)} messages from POP3 server")
 
-    for msgRaw in messagesInfo:
-        if type(msgRaw) is bytes:
-            try:
-                msg = msgRaw.decode("utf-8")
-            except UnicodeError:
-                # if couldn't decode easily, just leave it raw
-                msg = msgRaw
-        else:
-            # already a str
-            msg = msgRaw
-        msgNum = msg.split(" ")[0]
-        logger.info(f"Processing message {msgNum}")
-
-        raw_content = server.retr(msgNum)[1]
-        if type(raw_content[0]) is bytes:
-            full_message = "\n".join([elm.decode("utf-8") for elm in raw_content])
-        else:
-            full_message = encoding.force_str("\n".join(raw_content), errors="replace")
+    if tracking:
+        seen = set(
+            SeenPOP3Message.objects.filter(queue=q).values_list("uidl", flat=True)
+        )
+        # Forget the messages that were removed from the server since
+        gone = seen - {uidl for __, uidl in messages}
+        if gone:
+            SeenPOP3Message.objects.filter(queue=q, uidl__in=gone).delete()
+        messages = [(num, uidl) for num, uidl in messages if uidl not in seen]
+        logger.info(f"{len(messages)} of them were not seen by a previous poll")
+
+    capabilities = pop3_capabilities(server)
+    pipelining = "PIPELINING" in capabilities
+    prescreen = "TOP" in capabilities and IgnoreEmail.objects.has_rules(q)
+    chunks = message_batches(
+        ((message, sizes.get(message[0], 0)) for message in messages),
+        POP3_PIPELINE_DEPTH,
+        helpdesk_settings.HELPDESK_POP3_RETR_BATCH_MAX_BYTES,
+    )
+    for chunk in chunks:
+        # UIDLs of the messages left on the server
+        kept = []
+        if prescreen:
+            chunk = pop3_prescreen(q, logger, server, chunk, pipelining, kept)
+        contents = {}
+        retrieved = pop3_long_commands(
+            server, "RETR", [(num,) for num, __ in chunk], pipelining
+        )
+        for (num, __), lines in zip(chunk, retrieved):
+            if lines is None:
+                logger.warning(f"Message {num} could not be retrieved from POP3 server")
+            elif lines and isinstance(lines[0], str):
+                contents[num] = "\n".join(lines)
+            else:
+                contents[num] = b"\n".join(lines)
+        parsed = parse_email_messages(contents, logger, queue=q)
         try:
-            ticket = extract_email_metadata(
-                message=full_message, queue=q, logger=logger
-            )
-        except IgnoreTicketException:
-            logger.warning(
-                f"Message {msgNum} was ignored and will be left on POP3 server"
+            for num, uidl in chunk:
+                if num not in contents:
+                    continue
+                logger.info(f"Processing message {num}")
+                try:
+                    ticket = extract_email_metadata(
+                        message=contents[num],
+                        queue=q,
+                        logger=logger,
+                        parsed=parsed.get(num),
+                    )
+                except IgnoreTicketException:
+                    kept.append(uidl)
+                    logger.warning(
+                        f"Message {num} was ignored and will be left on POP3 server"
+                    )
+                except DeleteIgnoredTicketException:
+                    logger.warning(
+                        f"Message {num} was ignored and deleted from POP3 server"
+                    )
+                    server.dele(num)
+                except DatabaseError:
+                    raise
+                except Exception:
+                    # Retried on the next poll, until it is quarantined
+                    logger.exception(f"Unexpected error processing message {num}")
+                    if record_message_failure(q, contents[num], logger):
+                        server.dele(num)
+                else:
+                    if ticket:
+                        server.dele(num)
+                        logger.info(
+                            f"Successfully processed message {num}, deleted from POP3 server"
+                        )
+                    else:
+                        kept.append(uidl)
+                        logger.warning(
+                            f"Message {num} was not successfully processed, and will be left on POP3 server"
+                        )
+        finally:
+            discard_parsed_emails(parsed.values())
+        if tracking and kept:
+            SeenPOP3Message.objects.bulk_create(
+                [SeenPOP3Message(queue=q, uidl=uidl) for uidl in kept],
+                ignore_conflicts=True,
             )
-        except DeleteIgnoredTicketException:
-            logger.warning(f"Message {msgNum} was ignored and deleted from POP3 server")
-            server.dele(msgNum)
-        else:
-            if ticket:
-                server.dele(msgNum)
-                logger.info(
-                    f"Successfully processed message {msgNum}, deleted from POP3 server"
-                )
-            else:
-                logger.warning(
-                    f"Message {msgNum} was not successfully processed, and will be left on POP3 server"
-                )
 
     server.quit()
 
 
-def imap_sync(q, logger, server):
+def imap_message_set(uids) -> str:
+    """Compress a list of message UIDs into an IMAP sequence set
+
+    Consecutive UIDs are collapsed into ranges, eg. [1, 2, 3, 7] gives "1:3,7",
+    which keeps the command line short for large batches.
+    """
+    nums = sorted({int(uid) for uid in uids})
+    ranges = []
+    start = prev = nums[0]
+    for num in nums[1:]:
+        if num != prev + 1:
+            ranges.append((start, prev))
+            start = num
+        prev = num
+    ranges.append((start, prev))
+    return ",".join(f"{a}:{b}" if a != b else f"{a}" for a, b in ranges)
+
+
+def imap_parse_fetch_response(data) -> dict:
+    """Map the UIDs in a UID FETCH response to their fetched data item
+
+    The response holds a tuple of (envelope, literal) for every message when a
+    literal such as RFC822 was requested, otherwise just the envelope bytes.
+    Some servers send the UID after the literal, in the item that closes it.
+    """
+    results = {}
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            envelope, literal = item
+            match = IMAP_FETCH_UID_RE.search(envelope)
+            if match:
+                results[int(match.group(1))] = literal
+                pending = None
+            else:
+                pending = literal
+        elif isinstance(item, bytes):
+            match = IMAP_FETCH_UID_RE.search(item)
+            if not match:
+                continue
+            if pending is not None:
+                results[int(match.group(1))] = pending
+                pending = None
+            else:
+                results[int(match.group(1))] = item
+    return results
+
+
+def imap_fetch_message_sizes(server, uids) -> dict:
+    """Get the RFC822 size of every UID in a single round trip"""
+    data = server.uid("FETCH", imap_message_set(uids), "(RFC822.SIZE)")[1]
+    sizes = {}
+    for uid, envelope in imap_parse_fetch_response(data).items():
+        match = IMAP_FETCH_SIZE_RE.search(envelope)
+        sizes[uid] = int(match.group(1)) if match else 0
+    return sizes
+
+
+def imap_uidvalidity(q, server) -> int | None:
+    """UIDVALIDITY of the selected folder, as reported when it was selected
+
+    The untagged response is consumed by the first call, and cannot change
+    without the server closing the connection, so later polls on the same
+    connection keep the value recorded on the queue.
+    """
+    uidvalidity = server.response("UIDVALIDITY")[1][0]
+    if uidvalidity is None:
+        return q.email_box_imap_uidvalidity
+    return int(uidvalidity)
+
+
+def imap_save_last_uid(q, uidvalidity: int | None, last_uid: int):
+    """Record the highest UID processed so far in the queue's IMAP folder"""
+    q.email_box_imap_uidvalidity = uidvalidity
+    q.email_box_imap_last_uid = last_uid
+    Queue.objects.filter(pk=q.pk).update(
+        email_box_imap_uidvalidity=uidvalidity, email_box_imap_last_uid=last_uid
+    )
+
+
+def imap_batch_sync(q, logger, server):
+    """
+    Fetch the messages of the selected folder by UID, in batches.
+
+    Each batch is pulled with a single UID FETCH, bounded by
+    HELPDESK_IMAP_FETCH_BATCH_SIZE messages and HELPDESK_IMAP_FETCH_BATCH_MAX_BYTES
+    bytes, and the messages successfully processed in it are flagged as deleted
+    with a single UID STORE. Expunging is left to the caller.
+
+    With HELPDESK_IMAP_INCREMENTAL_SYNC, only the UIDs above the highest one
+    processed by a previous poll are searched, unless the UIDVALIDITY of the
+    folder has changed since. A message that failed, or was not returned by
+    the server, holds the highest UID back until it is processed or
+    quarantined.
+    """
+    incremental = helpdesk_settings.HELPDESK_IMAP_INCREMENTAL_SYNC
+    last_uid = 0
+    if incremental:
+        uidvalidity = imap_uidvalidity(q, server)
+        if uidvalidity != q.email_box_imap_uidvalidity:
+            logger.info(
+                f"IMAP folder UIDVALIDITY is now {uidvalidity}, scanning all messages"
+            )
+        else:
+            last_uid = q.email_box_imap_last_uid or 0
+    if last_uid:
+        # "n:*" always matches the last message, even if its UID is below n
+        data = server.uid("SEARCH", "UID", f"{last_uid + 1}:*", "NOT", "DELETED")[1]
+    else:
+        data = server.uid("SEARCH", "NOT", "DELETED")[1]
+    uids = [int(uid) for uid in data[0].split()] if data and data[0] else []
+    uids = [uid for uid in uids if uid > last_uid]
+    logger.info(f"Received {len(uids)} messages from IMAP server")
+    if not uids:
+        return
+
+    sizes = imap_fetch_message_sizes(server, uids)
+    batches = message_batches(
+        ((uid, sizes.get(uid, 0)) for uid in uids),
+        helpdesk_settings.HELPDESK_IMAP_FETCH_BATCH_SIZE or 1,
+        helpdesk_settings.HELPDESK_IMAP_FETCH_BATCH_MAX_BYTES,
+    )
+    # The UIDs above the first message that was not handled are searched
+    # again by the next poll, so that it is retried until it is quarantined
+    retry_from = None
+    for batch in batches:
+        logger.info(f"Fetching {len(batch)} messages from IMAP server")
+        data = server.uid("FETCH", imap_message_set(batch), "(RFC822)")[1]
+        messages = imap_parse_fetch_response(data)
+        parsed = parse_email_messages(messages, logger, queue=q)
+        # Messages left on the server on purpose, as well as deleted ones
+        handled = set()
+        try:
+            to_delete = []
+            for uid in batch:
+                if uid not in messages:
+                    logger.warning(f"Message UID {uid} was not returned by IMAP server")
+                    continue
+                logger.info(f"Processing message UID {uid}")
+                try:
+                    ticket = extract_email_metadata(
+                        message=messages[uid],
+                        queue=q,
+                        logger=logger,
+                        parsed=parsed.get(uid),
+                    )
+                except IgnoreTicketException:
+                    handled.add(uid)
+                    logger.warning(
+                        f"Message UID {uid} was ignored and will be left on IMAP server"
+                    )
+                except DeleteIgnoredTicketException:
+                    to_delete.append(uid)
+                    logger.warning(
+                        f"Message UID {uid} was ignored and deleted from IMAP server"
+                    )
+                except DatabaseError:
+                    raise
+                except Exception:
+                    # Log the error with stacktrace to help identify what went wrong
+                    logger.exception(f"Unexpected error processing message UID {uid}")
+                    if record_message_failure(q, messages[uid], logger):
+                        to_delete.append(uid)
+                else:
+                    if ticket:
+                        to_delete.append(uid)
+                        logger.info(
+                            f"Successfully processed message UID {uid}, deleted from IMAP server"
+                        )
+                    else:
+                        # eg. not a reply with QUEUE_EMAIL_BOX_UPDATE_ONLY
+                        handled.add(uid)
+                        logger.warning(
+                            f"Message UID {uid} was not successfully processed, and will be left on IMAP server"
+                        )
+        finally:
+            discard_parsed_emails(parsed.values())
+        if to_delete:
+            server.uid("STORE", imap_message_set(to_delete), "+FLAGS", "(\\Deleted)")
+        if incremental and retry_from is None:
+            handled.update(to_delete)
+            retry_from = min((uid for uid in batch if uid not in handled), default=None)
+            done = [uid for uid in batch if retry_from is None or uid < retry_from]
+            if done:
+                imap_save_last_uid(q, uidvalidity, max(done))
+
+
+def imap_login(q, logger, server):
+    """Log in to the IMAP server and select the queue's folder"""
     try:
         try:
             server.starttls()
@@ -225,27 +685,33 @@ def imap_sync(q, logger, server):
             "the username and password are correct."
         )
         server.logout()
-        sys.exit()
+        raise
     except ssl.SSLError:
         logger.error(
             "IMAP login failed due to SSL error. This is often due to a timeout. "
             "Please check your connection and try again."
         )
         server.logout()
-        sys.exit()
+        raise
+
 
+def imap_fetch_messages(q, logger, server):
+    """Process the messages of the selected folder, flagging those to delete"""
     try:
-        data = server.search(None, "NOT", "DELETED")[1]
-        if data:
+        if (
+            helpdesk_settings.HELPDESK_IMAP_FETCH_BATCH_SIZE
+            or helpdesk_settings.HELPDESK_IMAP_INCREMENTAL_SYNC
+        ):
+            imap_batch_sync(q, logger, server)
+        elif data := server.search(None, "NOT", "DELETED")[1]:
             msgnums = data[0].split()
             logger.info(f"Received {len(msgnums)} messages from IMAP server")
             for num in msgnums:
                 logger.info(f"Processing message {num}")
                 data = server.fetch(num, "(RFC822)")[1]
-                full_message = encoding.force_str(data[0][1], errors="replace")
                 try:
                     ticket = extract_email_metadata(
-                        message=full_message, queue=q, logger=logger
+                        message=data[0][1], queue=q, logger=logger
                     )
                 except IgnoreTicketException:
                     logger.warning(
@@ -256,9 +722,13 @@ def imap_sync(q, logger, server):
                     logger.warning(
                         f"Message {num} was ignored and deleted from IMAP server"
                     )
-                except TypeError:
+                except DatabaseError:
+                    raise
+                except Exception:
                     # Log the error with stacktrace to help identify what went wrong
                     logger.exception(f"Unexpected error processing message {num}")
+                    if record_message_failure(q, data[0][1], logger):
+                        server.store(num, "+FLAGS", "\\Deleted")
                 else:
                     if ticket:
                         server.store(num, "+FLAGS", "\\Deleted")
@@ -275,149 +745,251 @@ def imap_sync(q, logger, server):
             q.email_box_imap_folder,
         )
 
+
+def imap_sync(q, logger, server):
+    imap_login(q, logger, server)
+    imap_fetch_messages(q, logger, server)
     server.expunge()
     server.close()
     server.logout()
 
 
-def imap_oauth_sync(q, logger, server):
-    """
-    IMAP eMail server with OAUTH authentication.
-    Only tested against O365 implementation
+def oauth_token_cache_key() -> str:
+    """Cache key of the access token for the configured client_id and scope"""
+    oauth = helpdesk_settings.HELPDESK_OAUTH
+    scope = oauth["scope"]
+    if not isinstance(scope, str):
+        scope = " ".join(scope)
+    digest = hashlib.sha256(
+        "\n".join((oauth["token_url"], oauth["client_id"], scope)).encode()
+    ).hexdigest()
+    return f"helpdesk:oauth-token:{digest}"
 
-    Uses HELPDESK OAUTH Dict in Settings.
 
+def get_oauth_token(logger) -> dict:
     """
+    Get an access token for HELPDESK_OAUTH, with the client credentials grant.
 
-    try:
-        logger.debug("Start Mailbox polling via IMAP OAUTH")
+    Tokens are kept in Django's cache until HELPDESK_OAUTH_TOKEN_EXPIRY_MARGIN
+    seconds before they expire, so that all the queues sharing an app
+    registration reuse the same token instead of fetching one on every poll.
+    Tokens without an expiry are not cached.
+    """
+    cache_key = oauth_token_cache_key()
+    token = cache.get(cache_key)
+    if token:
+        logger.debug("Using cached OAUTH access token")
+        return token
+
+    client = oauth2lib.BackendApplicationClient(
+        client_id=helpdesk_settings.HELPDESK_OAUTH["client_id"],
+        scope=helpdesk_settings.HELPDESK_OAUTH["scope"],
+    )
 
-        client = oauth2lib.BackendApplicationClient(
-            client_id=helpdesk_settings.HELPDESK_OAUTH["client_id"],
-            scope=helpdesk_settings.HELPDESK_OAUTH["scope"],
+    oauth = requests_oauthlib.OAuth2Session(client=client)
+    token = oauth.fetch_token(
+        token_url=helpdesk_settings.HELPDESK_OAUTH["token_url"],
+        client_id=helpdesk_settings.HELPDESK_OAUTH["client_id"],
+        client_secret=helpdesk_settings.HELPDESK_OAUTH["secret"],
+        include_client_id=True,
+    )
+    try:
+        timeout = (
+            int(token["expires_in"])
+            - helpdesk_settings.HELPDESK_OAUTH_TOKEN_EXPIRY_MARGIN
         )
+    except (KeyError, TypeError, ValueError):
+        timeout = 0
+    if timeout > 0:
+        cache.set(cache_key, dict(token), timeout)
+    return token
 
-        oauth = requests_oauthlib.OAuth2Session(client=client)
-        token = oauth.fetch_token(
-            token_url=helpdesk_settings.HELPDESK_OAUTH["token_url"],
-            client_id=helpdesk_settings.HELPDESK_OAUTH["client_id"],
-            client_secret=helpdesk_settings.HELPDESK_OAUTH["secret"],
-            include_client_id=True,
-        )
+
+def imap_oauth_login(q, logger, server):
+    """Authenticate to the IMAP server with XOAUTH2 and select the queue's folder"""
+    try:
+        logger.debug("Start Mailbox polling via IMAP OAUTH")
+
+        token = get_oauth_token(logger)
 
         server.debug = helpdesk_settings.HELPDESK_IMAP_DEBUG_LEVEL
         # TODO: Perhaps store the authentication string template externally? Settings? Queue Table?
-        server.authenticate(
-            "XOAUTH2",
-            lambda x: (
-                f"user={q.email_box_user}\x01auth=Bearer {token['access_token']}\x01\x01".encode()
-            ),
-        )
+        try:
+            server.authenticate(
+                "XOAUTH2",
+                lambda x: (
+                    f"user={q.email_box_user}\x01auth=Bearer {token['access_token']}\x01\x01".encode()
+                ),
+            )
+        except imaplib.IMAP4.error:
+            # The cached token may have been revoked, fetch a new one next time
+            cache.delete(oauth_token_cache_key())
+            raise
         # Select the Inbound Mailbox folder
         server.select(q.email_box_imap_folder)
 
     except imaplib.IMAP4.abort:
         logger.exception("IMAP authentication failed in OAUTH")
         server.logout()
-        sys.exit()
+        raise
 
     except ssl.SSLError:
         logger.exception(
             "IMAP login failed due to SSL error. (This is often due to a timeout)"
         )
         server.logout()
-        sys.exit()
+        raise
+
+
+def imap_oauth_fetch_messages(q, logger, server):
+    """
+    Process the messages of the selected folder, flagging those to delete
 
+    Messages are addressed by UID, and the ones to delete are flagged with a
+    single UID STORE once the folder has been processed. Expunging is left to
+    the caller, so the mailbox is not renumbered while it is being read.
+    """
     try:
-        data = server.search(None, "NOT", "DELETED")[1]
-        if data:
-            msgnums = data[0].split()
-            logger.info(f"Found {len(msgnums)} message(s) on IMAP server")
-            for num in msgnums:
-                logger.info(f"Processing message {num}")
-                data = server.fetch(num, "(RFC822)")[1]
-                full_message = encoding.force_str(data[0][1], errors="replace")
+        if (
+            helpdesk_settings.HELPDESK_IMAP_FETCH_BATCH_SIZE
+            or helpdesk_settings.HELPDESK_IMAP_INCREMENTAL_SYNC
+        ):
+            imap_batch_sync(q, logger, server)
+        elif data := server.uid("SEARCH", "NOT", "DELETED")[1]:
+            uids = [int(uid) for uid in data[0].split()] if data[0] else []
+            logger.info(f"Found {len(uids)} message(s) on IMAP server")
+            to_delete = []
+            try:
+                for uid in uids:
+                    logger.info(f"Processing message UID {uid}")
+                    data = server.uid("FETCH", str(uid), "(RFC822)")[1]
+                    if not data or not isinstance(data[0], tuple):
+                        logger.warning(
+                            f"Message UID {uid} was not returned by IMAP server"
+                        )
+                        continue
 
-                try:
-                    ticket = extract_email_metadata(
-                        message=full_message, queue=q, logger=logger
-                    )
+                    try:
+                        ticket = extract_email_metadata(
+                            message=data[0][1], queue=q, logger=logger
+                        )
 
-                except IgnoreTicketException as itex:
-                    logger.warning(f"Message {num} was ignored. {itex}")
+                    except IgnoreTicketException as itex:
+                        logger.warning(f"Message UID {uid} was ignored. {itex}")
 
-                except DeleteIgnoredTicketException:
-                    server.store(num, "+FLAGS", "\\Deleted")
-                    server.expunge()
-                    logger.warning(
-                        f"Message {num} was ignored and deleted from IMAP server"
-                    )
+                    except DeleteIgnoredTicketException:
+                        to_delete.append(uid)
+                        logger.warning(
+                            f"Message UID {uid} was ignored and deleted from IMAP server"
+                        )
 
-                except TypeError:
-                    # Log the error with stacktrace to help identify what went wrong
-                    logger.exception(f"Unexpected error processing message {num}")
+                    except DatabaseError:
+                        raise
 
-                else:
-                    if ticket:
-                        server.store(num, "+FLAGS", "\\Deleted")
-                        server.expunge()
-                        logger.info(
-                            f"Successfully processed message {num}, deleted from IMAP server"
+                    except Exception:
+                        # Log the error with stacktrace to help identify what went wrong
+                        logger.exception(
+                            f"Unexpected error processing message UID {uid}"
                         )
+                        if record_message_failure(q, data[0][1], logger):
+                            to_delete.append(uid)
+
                     else:
-                        logger.warning(
-                            f"Message {num} was not successfully processed, and will be left on IMAP server"
-                        )
+                        if ticket:
+                            to_delete.append(uid)
+                            logger.info(
+                                f"Successfully processed message UID {uid}, deleted from IMAP server"
+                            )
+                        else:
+                            logger.warning(
+                                f"Message UID {uid} was not successfully processed, and will be left on IMAP server"
+                            )
+            finally:
+                # Flag what was processed even if a later message failed
+                if to_delete:
+                    server.uid(
+                        "STORE", imap_message_set(to_delete), "+FLAGS", "(\\Deleted)"
+                    )
 
     except imaplib.IMAP4.error:
         logger.error(
             "IMAP retrieve failed. Is the folder '%s' spelled correctly, and does it exist on the server?",
             q.email_box_imap_folder,
         )
+
+
+def imap_oauth_sync(q, logger, server):
+    """
+    IMAP eMail server with OAUTH authentication.
+    Only tested against O365 implementation
+
+    Uses HELPDESK OAUTH Dict in Settings.
+
+    """
+    imap_oauth_login(q, logger, server)
+    imap_oauth_fetch_messages(q, logger, server)
     # Purged Flagged Messages & Logout
     server.expunge()
     server.close()
     server.logout()
 
 
-def process_queue(q, logger):
-    logger.info(
-        f"***** {ctime()}: Begin processing mail for django-helpdesk queue: {q.title}"
-    )
+class SocksProxyMixin:
+    """Open the connection of a poplib/imaplib client through a SOCKS proxy
 
-    if q.socks_proxy_type and q.socks_proxy_host and q.socks_proxy_port:
-        try:
-            import socks
-        except ImportError:
-            no_socks_msg = (
-                "Queue has been configured with proxy settings, "
-                "but no socks library was installed. Try to "
-                "install PySocks via PyPI."
-            )
-            logger.error(no_socks_msg)
-            raise ImportError(no_socks_msg)
+    The proxy only applies to this one connection, so proxied and direct
+    queues can be polled side by side in the same process.
+    """
 
-        proxy_type = {
-            "socks4": socks.SOCKS4,
-            "socks5": socks.SOCKS5,
-        }.get(q.socks_proxy_type)
+    def __init__(self, *args, socks_proxy: dict, **kwargs):
+        self.socks_proxy = socks_proxy
+        super().__init__(*args, **kwargs)
 
-        socks.set_default_proxy(
-            proxy_type=proxy_type, addr=q.socks_proxy_host, port=q.socks_proxy_port
+    def _create_socket(self, timeout):
+        import socks
+
+        if timeout is not None and not timeout:
+            raise ValueError("Non-blocking socket (timeout=0) is not supported")
+        sock = socks.create_connection(
+            (self.host, self.port), timeout=timeout, **self.socks_proxy
         )
-        socket.socket = socks.socksocket
+        return self._wrap_socket(sock)
+
+    def _wrap_socket(self, sock):
+        return sock
+
+
+class ProxiedPOP3(SocksProxyMixin, poplib.POP3):
+    pass
+
+
+class ProxiedPOP3_SSL(SocksProxyMixin, poplib.POP3_SSL):
+    def _wrap_socket(self, sock):
+        return self.context.wrap_socket(sock, server_hostname=self.host)
+
+
+class ProxiedIMAP4(SocksProxyMixin, imaplib.IMAP4):
+    pass
+
+
+class ProxiedIMAP4_SSL(SocksProxyMixin, imaplib.IMAP4_SSL):
+    def _wrap_socket(self, sock):
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host)
 
-    email_box_type = helpdesk_settings.QUEUE_EMAIL_BOX_TYPE or q.email_box_type
 
-    mail_defaults = {
+def get_mail_server_defaults() -> dict:
+    """Connection classes, default ports and sync function of each mailbox type"""
+    return {
         "pop3": {
             "ssl": {
                 "port": 995,
                 "init": poplib.POP3_SSL,
+                "proxied_init": ProxiedPOP3_SSL,
             },
             "insecure": {
                 "port": 110,
                 "init": poplib.POP3,
+                "proxied_init": ProxiedPOP3,
             },
             "sync": pop3_sync,
         },
@@ -425,10 +997,12 @@ def process_queue(q, logger):
             "ssl": {
                 "port": 993,
                 "init": imaplib.IMAP4_SSL,
+                "proxied_init": ProxiedIMAP4_SSL,
             },
             "insecure": {
                 "port": 143,
                 "init": imaplib.IMAP4,
+                "proxied_init": ProxiedIMAP4,
             },
             "sync": imap_sync,
         },
@@ -436,71 +1010,404 @@ def process_queue(q, logger):
             "ssl": {
                 "port": 993,
                 "init": imaplib.IMAP4_SSL,
+                "proxied_init": ProxiedIMAP4_SSL,
             },
             "insecure": {
                 "port": 143,
                 "init": imaplib.IMAP4,
+                "proxied_init": ProxiedIMAP4,
             },
             "sync": imap_oauth_sync,
         },
     }
+
+
+def connect_to_mail_server(q, logger, email_box_type: str):
+    """Open a connection to the POP3 or IMAP server of the queue"""
+    mail_defaults = get_mail_server_defaults()[email_box_type]
+    encryption = "insecure"
+    if q.email_box_ssl or helpdesk_settings.QUEUE_EMAIL_BOX_SSL:
+        encryption = "ssl"
+    if not q.email_box_port:
+        q.email_box_port = mail_defaults[encryption]["port"]
+
+    init = mail_defaults[encryption]["init"]
+    connection_kwargs = {}
+    if helpdesk_settings.HELPDESK_EMAIL_POLL_TIMEOUT:
+        connection_kwargs["timeout"] = helpdesk_settings.HELPDESK_EMAIL_POLL_TIMEOUT
+    if q.socks_proxy_type and q.socks_proxy_host and q.socks_proxy_port:
+        try:
+            import socks
+        except ImportError:
+            no_socks_msg = (
+                "Queue has been configured with proxy settings, "
+                "but no socks library was installed. Try to "
+                "install PySocks via PyPI."
+            )
+            logger.error(no_socks_msg)
+            raise ImportError(no_socks_msg)
+
+        proxy_type = {
+            "socks4": socks.SOCKS4,
+            "socks5": socks.SOCKS5,
+        }.get(q.socks_proxy_type)
+
+        init = mail_defaults[encryption]["proxied_init"]
+        connection_kwargs["socks_proxy"] = {
+            "proxy_type": proxy_type,
+            "proxy_addr": q.socks_proxy_host,
+            "proxy_port": q.socks_proxy_port,
+        }
+
+    return init(
+        q.email_box_host or helpdesk_settings.QUEUE_EMAIL_BOX_HOST,
+        int(q.email_box_port),
+        **connection_kwargs,
+    )
+
+
+def process_queue(q, logger):
+    logger.info(
+        f"***** {ctime()}: Begin processing mail for django-helpdesk queue: {q.title}"
+    )
+
+    email_box_type = helpdesk_settings.QUEUE_EMAIL_BOX_TYPE or q.email_box_type
+
+    mail_defaults = get_mail_server_defaults()
     if email_box_type in mail_defaults:
-        encryption = "insecure"
-        if q.email_box_ssl or helpdesk_settings.QUEUE_EMAIL_BOX_SSL:
-            encryption = "ssl"
-        if not q.email_box_port:
-            q.email_box_port = mail_defaults[email_box_type][encryption]["port"]
-
-        server = mail_defaults[email_box_type][encryption]["init"](
-            q.email_box_host or helpdesk_settings.QUEUE_EMAIL_BOX_HOST,
-            int(q.email_box_port),
-        )
+        server = connect_to_mail_server(q, logger, email_box_type)
         logger.info(f"Attempting {email_box_type.upper()} server login")
         mail_defaults[email_box_type]["sync"](q, logger, server)
 
     elif email_box_type == "local":
-        mail_dir = q.email_box_local_dir or "/var/lib/mail/helpdesk/"
-        mail = [
-            join(mail_dir, f) for f in os.listdir(mail_dir) if isfile(join(mail_dir, f))
-        ]
-        logger.info(f"Found {len(mail)} messages in local mailbox directory")
+        local_sync(q, logger)
 
-        logger.info(f"Found {len(mail)} messages in local mailbox directory")
-        for i, m in enumerate(mail, 1):
-            logger.info(f"Processing message {i}")
-            with open(m, "r") as f:
-                full_message = encoding.force_str(f.read(), errors="replace")
-                try:
-                    ticket = extract_email_metadata(
-                        message=full_message, queue=q, logger=logger
-                    )
-                except IgnoreTicketException:
-                    logger.warning(
-                        "Message %d was ignored and will be left in local directory", i
-                    )
-                except DeleteIgnoredTicketException:
-                    os.unlink(m)
-                    logger.warning(
-                        "Message %d was ignored and deleted local directory", i
-                    )
-                else:
-                    if ticket:
-                        logger.info(
-                            "Successfully processed message %d, ticket/comment created.",
+
+def is_maildir(mail_dir: str) -> bool:
+    """Whether a local directory is a Maildir, with new, cur and tmp folders"""
+    return all(os.path.isdir(join(mail_dir, sub)) for sub in ("new", "cur", "tmp"))
+
+
+def iter_local_messages(mail_dir: str):
+    """Yield the paths of the message files of a directory as it is scanned,
+    skipping hidden files"""
+    with os.scandir(mail_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith(".") and entry.is_file():
+                yield entry.path
+
+
+def claim_maildir_message(path: str) -> str | None:
+    """
+    Claim a message of the new folder of a Maildir by moving it to cur
+
+    The rename is atomic, so when several pollers share the Maildir only one
+    of them gets the message. Returns the claimed path, or None when another
+    poller claimed the message first.
+    """
+    mail_dir = os.path.dirname(os.path.dirname(path))
+    name = os.path.basename(path)
+    claimed = join(mail_dir, "cur", name.split(":")[0] + ":2,")
+    try:
+        # The modification time of a claimed message is the time of its claim,
+        # see recover_maildir_claims()
+        os.utime(path)
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+
+def recover_maildir_claims(mail_dir: str, timeout: float) -> int:
+    """
+    Put back in new the messages of cur that were claimed more than timeout
+    seconds ago and are not flagged as seen: the poller that claimed them
+    died before processing or releasing them. Returns the number of messages
+    put back.
+    """
+    deadline = time.time() - timeout
+    recovered = 0
+    for path in iter_local_messages(join(mail_dir, "cur")):
+        name, __, info = os.path.basename(path).partition(":")
+        if not info.startswith("2,") or "S" in info[2:]:
+            continue
+        try:
+            if os.stat(path).st_mtime > deadline:
+                continue
+            os.rename(path, join(mail_dir, "new", name))
+        except FileNotFoundError:
+            # Removed or put back by another poller in the meantime
+            continue
+        recovered += 1
+    return recovered
+
+
+def release_maildir_message(path: str, keep: bool) -> None:
+    """
+    Give back a claimed Maildir message that was not removed: kept messages
+    are flagged as seen in cur, the others go back to new to be processed on
+    the next poll
+    """
+    mail_dir = os.path.dirname(os.path.dirname(path))
+    name = os.path.basename(path)
+    if keep:
+        os.rename(path, path + "S")
+    else:
+        os.rename(path, join(mail_dir, "new", name.split(":")[0]))
+
+
+def local_sync(q, logger):
+    """
+    Process the messages of a local directory
+
+    A Maildir is read from its new folder, each message being claimed by
+    moving it to cur before it is processed, so that several pollers can
+    share it. The claims older than HELPDESK_MAILDIR_CLAIM_TIMEOUT, left by a
+    poller that was killed, are put back in new first. Any other directory is read as a flat list of message files.
+    The directory is scanned as messages are processed, up to
+    HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES messages per poll.
+    """
+    mail_dir = q.email_box_local_dir or "/var/lib/mail/helpdesk/"
+    maildir = is_maildir(mail_dir)
+    if maildir and (
+        recovered := recover_maildir_claims(
+            mail_dir, helpdesk_settings.HELPDESK_MAILDIR_CLAIM_TIMEOUT
+        )
+    ):
+        logger.warning(
+            f"Put {recovered} messages claimed by an interrupted poll back in new"
+        )
+    paths = iter_local_messages(join(mail_dir, "new") if maildir else mail_dir)
+    if helpdesk_settings.HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES:
+        paths = itertools.islice(
+            paths, helpdesk_settings.HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES
+        )
+
+    # With parse workers, messages are read and parsed a window ahead of
+    # the one being turned into a ticket
+    window = 2 * (helpdesk_settings.HELPDESK_EMAIL_PARSE_WORKERS or 0) or 1
+    i = 0
+    # Messages to put back in new, once the scan of new is over so that they
+    # are not listed again by it
+    retry = []
+    try:
+        while chunk := list(itertools.islice(paths, window)):
+            contents = {}
+            for m in chunk:
+                if maildir and not (m := claim_maildir_message(m)):
+                    continue
+                with open(m, "rb") as f:
+                    contents[m] = f.read()
+            parsed = parse_email_messages(contents, logger, queue=q)
+            try:
+                for m, full_message in contents.items():
+                    i += 1
+                    logger.info(f"Processing message {i}")
+                    # Whether a message not removed is kept as seen, in a Maildir
+                    keep = False
+                    try:
+                        ticket = extract_email_metadata(
+                            message=full_message,
+                            queue=q,
+                            logger=logger,
+                            parsed=parsed.get(m),
+                        )
+                    except IgnoreTicketException:
+                        keep = True
+                        logger.warning(
+                            "Message %d was ignored and will be left in local directory",
                             i,
                         )
-                        try:
-                            # delete message file if ticket was successful
+                    except DeleteIgnoredTicketException:
+                        os.unlink(m)
+                        logger.warning(
+                            "Message %d was ignored and deleted local directory", i
+                        )
+                        continue
+                    except DatabaseError:
+                        if maildir:
+                            retry.append(m)
+                        raise
+                    except Exception:
+                        logger.exception("Unexpected error processing message %d", i)
+                        if record_message_failure(q, full_message, logger):
                             os.unlink(m)
-                        except OSError as e:
-                            logger.error("Unable to delete message %d (%s).", i, str(e))
+                            continue
+                    else:
+                        if ticket:
+                            logger.info(
+                                "Successfully processed message %d, ticket/comment created.",
+                                i,
+                            )
+                            try:
+                                # delete message file if ticket was successful
+                                os.unlink(m)
+                            except OSError as e:
+                                logger.error(
+                                    "Unable to delete message %d (%s).", i, str(e)
+                                )
+                            else:
+                                logger.info("Successfully deleted message %d.", i)
+                            continue
+                        logger.warning(
+                            "Message %d was not successfully processed, and will be left in local directory",
+                            i,
+                        )
+                    if maildir:
+                        if keep:
+                            release_maildir_message(m, keep)
                         else:
-                            logger.info("Successfully deleted message %d.", i)
+                            retry.append(m)
+            finally:
+                discard_parsed_emails(parsed.values())
+    finally:
+        for m in retry:
+            release_maildir_message(m, keep=False)
+    logger.info(f"Processed {i} messages from local mailbox directory")
+
+
+def imap_start_raw_command(server, command: bytes) -> bytes:
+    """
+    Send an IMAP command whose responses the caller reads itself with
+    server.readline(), such as IDLE, and return its tag. Finish it with
+    imap_finish_raw_command().
+
+    imaplib has no public API for commands like IDLE, so this relies on the
+    private IMAP4._new_tag() and IMAP4.tagged_commands, which are unchanged
+    in Python 3.9 to 3.13. Python 3.14 adds IMAP4.idle(), which can replace
+    this once older versions are no longer supported.
+    """
+    tag = server._new_tag()
+    server.send(tag + b" " + command + b"\r\n")
+    return tag
+
+
+def imap_finish_raw_command(server, tag: bytes) -> bytes:
+    """
+    Read the responses of a command started with imap_start_raw_command()
+    up to its tagged completion, which is returned.
+    """
+    while not (line := server.readline()).startswith(tag):
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed by server")
+    server.tagged_commands.pop(tag, None)
+    return line
+
+
+def imap_pop_new_mail_responses(server) -> bool:
+    """
+    Remove the EXISTS and RECENT responses imaplib kept from the untagged
+    data of the previous commands, returning True if there were any: the
+    server announced new mail while they ran, and does not announce it again.
+    """
+    found = False
+    for name in ("EXISTS", "RECENT"):
+        if server.untagged_responses.pop(name, None) is not None:
+            found = True
+    return found
+
+
+def imap_idle(server, timeout: float = IMAP_IDLE_TIMEOUT, stop_event=None) -> bool:
+    """
+    Wait in IMAP IDLE (RFC 2177) until the server announces new messages.
+
+    Returns True when new messages were announced, False when the timeout
+    expired or stop_event was set first. The connection has left IDLE and is
+    ready for the next command when this returns.
+    """
+    tag = imap_start_raw_command(server, b"IDLE")
+    new_mail = False
+    # New mail may be announced before the server accepts IDLE
+    while (response := server.readline()).startswith(b"* "):
+        new_mail = new_mail or b"EXISTS" in response or b"RECENT" in response
+    if not response.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected by server: {response!r}")
+
+    deadline = time.monotonic() + timeout
+    while not new_mail and not (stop_event and stop_event.is_set()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # SSL sockets may already hold decrypted data that select() cannot see
+        pending = getattr(server.sock, "pending", None)
+        if not (pending and pending()):
+            readable, _, _ = select.select([server.sock], [], [], min(remaining, 1))
+            if not readable:
+                continue
+        line = server.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed by server during IDLE")
+        new_mail = line.startswith(b"*") and b"EXISTS" in line
+
+    server.send(b"DONE\r\n")
+    imap_finish_raw_command(server, tag)
+    return new_mail
+
+
+def get_imap_listener_functions() -> dict:
+    """Login and fetch functions of the mailbox types that support IDLE"""
+    return {
+        "imap": (imap_login, imap_fetch_messages),
+        "oauth": (imap_oauth_login, imap_oauth_fetch_messages),
+    }
+
+
+def listen_to_queue(
+    q: Queue,
+    stop_event,
+    idle_timeout: float = IMAP_IDLE_TIMEOUT,
+    max_backoff: float = 300,
+    quiet: bool = False,
+):
+    """
+    Keep an authenticated IMAP connection open for the queue until stop_event
+    is set, processing new mail as soon as the server announces it.
+
+    Connection failures are retried with an exponential backoff capped at
+    max_backoff seconds. Database connections are released while waiting for
+    mail so an idle listener does not hold one per queue.
+    """
+    logger, log_file_handler = get_queue_logger(q, quiet)
+    email_box_type = helpdesk_settings.QUEUE_EMAIL_BOX_TYPE or q.email_box_type
+    login, fetch_messages = get_imap_listener_functions()[email_box_type]
+    backoff = 1
+    try:
+        while not stop_event.is_set():
+            server = None
+            try:
+                server = connect_to_mail_server(q, logger, email_box_type)
+                login(q, logger, server)
+                logger.info(f"Listening for new mail for queue: {q.slug}")
+                backoff = 1
+                while not stop_event.is_set():
+                    # Mail announced so far is fetched now
+                    imap_pop_new_mail_responses(server)
+                    fetch_messages(q, logger, server)
+                    server.expunge()
+                    if imap_pop_new_mail_responses(server):
+                        # Arrived during the fetch, IDLE would not report it
+                        continue
+                    connections.close_all()
+                    if "IDLE" in server.capabilities:
+                        imap_idle(server, idle_timeout, stop_event)
                     else:
-                        logger.warning(
-                            "Message %d was not successfully processed, and will be left in local directory",
-                            i,
-                        )
+                        stop_event.wait((q.email_box_interval or 1) * 60)
+            except Exception:
+                logger.exception(
+                    f"Mail listener failed for queue: {q.slug}, "
+                    f"reconnecting in {backoff} seconds"
+                )
+                connections.close_all()
+                stop_event.wait(backoff)
+                backoff = min(backoff * 2, max_backoff)
+            finally:
+                if server is not None:
+                    try:
+                        server.logout()
+                    except Exception:
+                        logger.debug("IMAP logout failed", exc_info=True)
+    finally:
+        close_queue_logger(logger, log_file_handler)
 
 
 def decodeUnknown(charset, string):
@@ -542,32 +1449,47 @@ def is_autoreply(message):
 
 
 def create_ticket_cc(ticket, cc_list, logger):
+    """
+    Subscribe the To and Cc addresses of an e-mail to the updates of a ticket
+
+    The users of all the addresses and the existing subscriptions of the
+    ticket are loaded with one query each, and the new subscriptions are
+    created in bulk. Returns the subscriptions of the addresses, new or not.
+    """
     if not cc_list:
         return []
-    # Local import to deal with non-defined / circular reference problem
-
-    new_ticket_ccs = []
-    from helpdesk.views.staff import User, subscribe_to_ticket_updates
 
+    emails = []
     for __, cced_email in cc_list:
         cced_email = cced_email.strip()
-        if cced_email == ticket.queue.email_address:
-            continue
+        if cced_email != ticket.queue.email_address and cced_email not in emails:
+            emails.append(cced_email)
+    if not emails:
+        return []
 
-        user_id = None
+    user_ids = {}
+    for user_id, user_email in User.objects.filter(
+        email__in=emails, is_active=True
+    ).values_list("id", "email"):
+        user_ids.setdefault(user_email, []).append(user_id)
+    existing = {}
+    for ticket_cc in TicketCC.objects.filter(ticket=ticket, email__in=emails).order_by(
+        "pk"
+    ):
+        existing.setdefault((ticket_cc.user_id, ticket_cc.email), ticket_cc)
 
-        user_list = User.objects.filter(email=cced_email, is_active=True).values_list(
-            "id", flat=True
-        )
-        count = user_list.count()
-        if count == 0:
+    ticket_ccs, new_ticket_ccs = [], []
+    for cced_email in emails:
+        user_id = None
+        user_list = user_ids.get(cced_email, [])
+        if not user_list:
             if getattr(
                 helpdesk_settings, "LOG_WARN_WHEN_CC_EMAIL_NOT_LINKED_TO_A_USER", False
             ):
                 logger.warning(
                     f"CC email address is not linked to an active user: {cced_email}"
                 )
-        elif count > 1:
+        elif len(user_list) > 1:
             if getattr(
                 helpdesk_settings,
                 "LOG_WARN_WHEN_CC_EMAIL_LINKED_TO_MORE_THAN_1_USER",
@@ -577,20 +1499,73 @@ def create_ticket_cc(ticket, cc_list, logger):
         else:
             user_id = user_list[0]
 
-        try:
-            ticket_cc = subscribe_to_ticket_updates(
-                ticket=ticket, user_id=user_id, email=cced_email
+        ticket_cc = existing.get((user_id, cced_email))
+        if ticket_cc is None:
+            # Same rule as subscribe_to_ticket_updates()
+            if user_id is None and len(cced_email) < 5:
+                continue
+            ticket_cc = TicketCC(
+                ticket=ticket,
+                user_id=user_id,
+                email=cced_email,
+                can_view=True,
+                can_update=False,
             )
             new_ticket_ccs.append(ticket_cc)
-        except ValidationError:
-            pass
+        ticket_ccs.append(ticket_cc)
+
+    TicketCC.objects.bulk_create(new_ticket_ccs)
+    return ticket_ccs
+
+
+def get_reply_message_ids(message) -> list[str]:
+    """
+    Get the ids of the messages an e-mail replies to, most relevant first
 
-    return new_ticket_ccs
+    The In-Reply-To id comes first, followed by the References ids from the
+    most recent one back.
+    """
+    message_ids = []
+    for header in ("In-Reply-To", "References"):
+        value = message.get(header)
+        if not value:
+            continue
+        value = str(value)
+        ids = MESSAGE_ID_RE.findall(value) or [value.strip()]
+        if header == "References":
+            ids = ids[::-1][:MAX_REFERENCES]
+        message_ids += [i for i in ids if i not in message_ids]
+    return message_ids
+
+
+def get_previous_followup(message) -> FollowUp | None:
+    """
+    Find the follow-up of the message an e-mail replies to
+
+    All the ids of In-Reply-To and References are resolved with a single
+    query, and the most relevant one found wins.
+    """
+    message_ids = get_reply_message_ids(message)
+    if not message_ids:
+        return None
+    followups = {}
+    for followup in (
+        FollowUp.objects.filter(message_id__in=message_ids)
+        .select_related("ticket")
+        .order_by("-date")
+    ):
+        followups.setdefault(followup.message_id, followup)
+    for message_id in message_ids:
+        if message_id in followups:
+            return followups[message_id]
+    return None
 
 
-def create_object_from_email_message(message, ticket_id, payload, files, logger):
+def create_object_from_email_message(
+    message, ticket_id, payload, files, logger, notify=True, date=None
+):
     ticket, previous_followup, new = None, None, False
-    now = timezone.now()
+    now = date or timezone.now()
 
     queue = payload["queue"]
     sender_email = payload["sender_email"]
@@ -599,22 +1574,13 @@ def create_object_from_email_message(message, ticket_id, payload, files, logger)
     cc_list = getaddresses(message.get_all("Cc", []))
 
     message_id = message.get("Message-Id")
-    in_reply_to = message.get("In-Reply-To")
 
     if message_id:
         message_id = message_id.strip()
 
-    if in_reply_to:
-        in_reply_to = in_reply_to.strip()
-
-    if in_reply_to is not None:
-        try:
-            queryset = FollowUp.objects.filter(message_id=in_reply_to).order_by("-date")
-            if queryset.count() > 0:
-                previous_followup = queryset.first()
-                ticket = previous_followup.ticket
-        except FollowUp.DoesNotExist:
-            pass  # play along. The header may be wrong
+    previous_followup = get_previous_followup(message)
+    if previous_followup is not None:
+        ticket = previous_followup.ticket
 
     if previous_followup is None and ticket_id is not None:
         try:
@@ -672,6 +1638,14 @@ def create_object_from_email_message(message, ticket_id, payload, files, logger)
 
     f.save()
     logger.debug("Created new FollowUp for Ticket")
+    if date is not None:
+        # Ticket.save() and FollowUp.save() stamp the ticket with the current time
+        ticket.modified = date
+        if new:
+            ticket.created = date
+        Ticket.objects.filter(pk=ticket.pk).update(
+            created=ticket.created, modified=ticket.modified
+        )
 
     logger.info(f"[{ticket.queue.slug}-{ticket.id}] {ticket.title}")
 
@@ -688,11 +1662,14 @@ def create_object_from_email_message(message, ticket_id, payload, files, logger)
                     att_file[1].size,
                 )
 
-    context = safe_template_context(ticket)
-
     new_ticket_ccs = []
     new_ticket_ccs.append(create_ticket_cc(ticket, to_list + cc_list, logger))
 
+    if not notify:
+        return ticket
+
+    context = safe_template_context(ticket)
+
     autoreply = is_autoreply(message)
     if autoreply:
         logger.info(
@@ -709,6 +1686,7 @@ def create_object_from_email_message(message, ticket_id, payload, files, logger)
     return ticket
 
 
+@notification_batch()
 def send_info_email(
     message_id: str, f: FollowUp, ticket: Ticket, context: dict, queue: dict, new: bool
 ):
@@ -749,26 +1727,39 @@ def send_info_email(
             )
 
 
-def get_ticket_id_from_subject_slug(
-    queue_slug: str, subject: str, logger: logging.Logger
-) -> int | None:
-    """Get a ticket id from the subject string
+def get_ticket_id_from_subject(
+    queue: Queue, subject: str, logger: logging.Logger
+) -> tuple[Queue, int | None]:
+    """Get the queue and ticket id of the tracking ID in the subject string
 
-    Performs a match on the subject using the queue_slug as reference,
-    returning the ticket id if a match is found.
+    A tracking ID for the queue the message was received in is preferred,
+    otherwise the first tracking ID of any other queue with an e-mail box is
+    used. The subject is scanned once, whatever the number of queues.
     """
-    matchobj = re.match(r".*\[" + queue_slug + r"-(?P<id>\d+)\]", subject)
-    ticket_id = None
-    if matchobj:
-        # This is a reply or forward.
-        ticket_id = matchobj.group("id")
-        logger.info(f"Matched tracking ID {queue_slug}-{ticket_id}")
-    else:
-        logger.info("No tracking ID matched.")
-    return ticket_id
+    tracking_ids = TRACKING_ID_RE.findall(subject)
+    for slug, ticket_id in reversed(tracking_ids):
+        if slug == queue.slug:
+            logger.info(f"Matched tracking ID {slug}-{ticket_id}")
+            return queue, int(ticket_id)
+    if tracking_ids:
+        slugs = Queue.objects.get_email_slugs()
+        for slug, ticket_id in tracking_ids:
+            if slug not in slugs:
+                continue
+            other_queue = Queue.objects.filter(pk=slugs[slug]).first()
+            if other_queue is not None:
+                logger.info(
+                    f"Found ticket {ticket_id} matching subject in queue {other_queue.slug} "
+                    f"instead of current queue {queue.slug}"
+                )
+                return other_queue, int(ticket_id)
+    logger.info("No tracking ID matched.")
+    return queue, None
 
 
-def add_file_if_always_save_incoming_email_message(files_, message: str) -> None:
+def add_file_if_always_save_incoming_email_message(
+    files_, message: str | bytes
+) -> None:
     """When `settings.HELPDESK_ALWAYS_SAVE_INCOMING_EMAIL_MESSAGE` is `True`
     add a file to the files_ list"""
     if getattr(settings, "HELPDESK_ALWAYS_SAVE_INCOMING_EMAIL_MESSAGE", False):
@@ -779,7 +1770,7 @@ def add_file_if_always_save_incoming_email_message(files_, message: str) -> None
                 _("original_message.eml").replace(
                     ".eml", timezone.localtime().strftime("_%d-%m-%Y_%H:%M") + ".eml"
                 ),
-                str(message).encode("utf-8"),
+                message if isinstance(message, bytes) else message.encode("utf-8"),
                 "text/plain",
             )
         )
@@ -806,35 +1797,82 @@ def get_email_body_from_part_payload(part) -> str:
         return encoding.smart_str(part.get_payload(decode=False))
 
 
-def attempt_body_extract_from_html(message: str) -> str:
-    mail = BeautifulSoup(str(message), "html.parser")
-    beautiful_body = mail.find("body")
-    body = None
-    full_body = None
-    if beautiful_body:
-        try:
-            body = beautiful_body.text
-            full_body = body
-        except AttributeError:
-            pass
-    if not body:
-        body = ""
-    return body, full_body
+class HTMLTextExtractor(HTMLParser):
+    """
+    Collect the text of the body of an HTML document as it is parsed,
+    without building a tree of the document, skipping the content of the
+    style and script tags like BeautifulSoup's Tag.text
+    """
 
+    SKIPPED_TAGS = ("script", "style")
 
-def mime_content_to_string(
-    part: EmailMessage,
-) -> str:
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.has_body = False
+        self.in_body = False
+        self.skipped = 0
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "body":
+            self.has_body = self.in_body = True
+        elif tag in self.SKIPPED_TAGS:
+            self.skipped += 1
+
+    def handle_endtag(self, tag):
+        if tag == "body":
+            self.in_body = False
+        elif tag in self.SKIPPED_TAGS and self.skipped:
+            self.skipped -= 1
+
+    def handle_data(self, data):
+        if self.in_body and not self.skipped:
+            self.text.append(data)
+
+
+def attempt_body_extract_from_html(message: str) -> tuple[str, str | None]:
+    """
+    Extract the text of the body of an HTML e-mail
+
+    Only the first HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE characters of the HTML
+    are parsed, with a warning when the HTML is longer. Returns the text twice,
+    as the body and the full body, or an empty body and None if the HTML has
+    no body tag or no text.
+    """
+    message = str(message)
+    max_size = helpdesk_settings.HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE
+    if max_size and len(message) > max_size:
+        logging.getLogger("helpdesk").warning(
+            "Only the first %d of the %d characters of an HTML e-mail were "
+            "parsed for its text, see HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE",
+            max_size,
+            len(message),
+        )
+        message = message[:max_size]
+    parser = HTMLTextExtractor()
+    parser.feed(message)
+    parser.close()
+    body = "".join(parser.text)
+    if not parser.has_body or not body:
+        return "", None
+    return body, body
+
+
+def mime_content_to_string(part: EmailMessage, from_bytes: bool = False) -> str:
     """
     Extract the content from the MIME body part
     :param part: the MIME part to extract the content from
+    :param from_bytes: the message was parsed from bytes, so the payload of
+           unencoded parts holds the original bytes
     """
     content_bytes = part.get_payload(decode=True)
     charset = part.get_content_charset()
     # The default for MIME email is 7bit which requires special decoding to utf-8 so make sure
     # we handle the decoding correctly
-    if part["Content-Transfer-Encoding"] in [None, "8bit", "7bit"] and (
-        charset == "utf-8" or charset is None
+    if (
+        not from_bytes
+        and part["Content-Transfer-Encoding"] in [None, "8bit", "7bit"]
+        and (charset == "utf-8" or charset is None)
     ):
         charset = "unicode_escape"
     content = decodeUnknown(charset, content_bytes)
@@ -854,6 +1892,7 @@ def extract_email_message_content(
     part: MIMEPart,
     files: list,
     include_chained_msgs: bool,
+    from_bytes: bool = False,
 ) -> (str, str):
     """
     Uses the get_body() method of the email package to extract the email message content.
@@ -866,6 +1905,7 @@ def extract_email_message_content(
     :param files: any MIME parts to be attached are added to this list
     :param include_chained_msgs: flag to indicate if the entire email message content including past
            replies must be extracted
+    :param from_bytes: the message was parsed from bytes rather than from a string
     """
     message_part: MIMEPart = part.get_body()
     # handle the case where there is no content, just an attachment
@@ -885,10 +1925,12 @@ def extract_email_message_content(
         )
         content_type = message_part.get_content_type()
     mime_content = None
+    # Text extracted from the HTML part, reused if the filtered body is empty
+    html_text = None
     formatted_body = None  # Retain the original content by using a secondary variable if the HTML needs wrapping
     if "text/html" == content_type:
         # add the HTML message as an attachment wrapping if necessary
-        mime_content = mime_content_to_string(message_part)
+        mime_content = mime_content_to_string(message_part, from_bytes)
         if "<body" not in mime_content:
             formatted_body = f"<body>{mime_content}</body>"
         if "<html" not in mime_content:
@@ -914,17 +1956,18 @@ def extract_email_message_content(
         )
         if plain_message_part:
             # Replace mime_content with the plain text part content
-            mime_content = mime_content_to_string(plain_message_part)
+            mime_content = mime_content_to_string(plain_message_part, from_bytes)
             message_part = plain_message_part
             content_type = "text/plain"
         else:
             # Try to constitute the HTML response as plain text
-            mime_content, _x = attempt_body_extract_from_html(
+            html_text = attempt_body_extract_from_html(
                 mime_content if formatted_body is None else formatted_body
             )
+            mime_content = html_text[0]
     else:
         # Is either text/plain or some random content-type so just decode the part content and store as is
-        mime_content = mime_content_to_string(message_part)
+        mime_content = mime_content_to_string(message_part, from_bytes)
     # We should now have the mime content
     filtered_body = (
         parse_email_content(mime_content, include_chained_msgs) if mime_content else ""
@@ -934,13 +1977,73 @@ def extract_email_message_content(
         # tools should retain the HTML to be consistent with the plain text but manage this as a special case
         # Try to constitute the HTML response as plain text
         if formatted_body:
-            filtered_body, _x = attempt_body_extract_from_html(formatted_body)
+            filtered_body, _x = html_text or attempt_body_extract_from_html(
+                formatted_body
+            )
         else:
             filtered_body = mime_content
     # Only need the full message if the message_body excludes the chained messages
     return filtered_body, mime_content
 
 
+def spool_base64_payload(upload, payload: str) -> int:
+    """
+    Decode a base64 payload into upload, a chunk at a time
+
+    Like the email package, characters outside the base64 alphabet are skipped
+    and missing padding is tolerated.
+    :returns the number of decoded bytes written
+    """
+    written = 0
+    pending = ""
+    for start in range(0, len(payload), ATTACHMENT_DECODE_CHUNK_SIZE):
+        chunk = payload[start : start + ATTACHMENT_DECODE_CHUNK_SIZE]
+        # padding ends the encoded data
+        chunk, padding, _ = chunk.partition("=")
+        data = pending + BASE64_JUNK_RE.sub("", chunk)
+        usable = len(data) - len(data) % 4
+        written += upload.write(binascii.a2b_base64(data[:usable]))
+        pending = data[usable:]
+        if padding:
+            break
+    if len(pending) > 1:
+        written += upload.write(
+            binascii.a2b_base64(pending + "=" * (-len(pending) % 4))
+        )
+    return written
+
+
+def attachment_from_part(part: MIMEPart, name: str, content_type: str | None):
+    """
+    Get the decoded content of a MIME part as an uploaded file
+
+    Content larger than HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE is written to a
+    temporary file, base64 payloads being decoded a chunk at a time, so that
+    large attachments are not held in memory. Smaller content is kept in
+    memory.
+    """
+    spool_size = helpdesk_settings.HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE
+    if (
+        not part.is_multipart()
+        and part.get("content-transfer-encoding", "").strip().lower() == "base64"
+        and len(part.get_payload()) * 3 // 4 > spool_size
+    ):
+        upload = TemporaryUploadedFile(name, content_type, 0, None)
+        upload.size = spool_base64_payload(upload, part.get_payload())
+        upload.seek(0)
+        return upload
+    # Extract payload accounting for attached multiparts
+    payload_bytes = (
+        part.as_bytes() if part.is_multipart() else part.get_payload(decode=True)
+    )
+    if len(payload_bytes) > spool_size:
+        upload = TemporaryUploadedFile(name, content_type, len(payload_bytes), None)
+        upload.write(payload_bytes)
+        upload.seek(0)
+        return upload
+    return SimpleUploadedFile(name, payload_bytes, content_type)
+
+
 def process_as_attachment(
     part: MIMEPart, counter: int, files: list, logger: logging.Logger
 ):
@@ -950,11 +2053,7 @@ def process_as_attachment(
     else:
         ext = mimetypes.guess_extension(part.get_content_type())
         name = f"part-{counter}{ext}"
-    # Extract payload accounting for attached multiparts
-    payload_bytes = (
-        part.as_bytes() if part.is_multipart() else part.get_payload(decode=True)
-    )
-    files.append(SimpleUploadedFile(name, payload_bytes, mimetypes.guess_type(name)[0]))
+    files.append(attachment_from_part(part, name, mimetypes.guess_type(name)[0]))
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug("Processed MIME as attachment: %s", name)
 
@@ -1038,37 +2137,148 @@ def extract_attachments(
     return (counter, content_parts_excluded)
 
 
-def extract_email_metadata(
-    message: str, queue: Queue, logger: logging.Logger
-) -> Ticket:
+def get_ingestion_key(message: str | bytes) -> tuple[str, str | None]:
     """
-    Extracts the text/plain  mime part if there is one as the ticket description and
-    stores the text/html part as an attachment if it is present.
-    If no text/plain  part is present then it will try to use the text/html part if
-    it is present as the ticket description by removing the HTML formatting.
-    If neither a text/plain or text/html is present then it will use the first text/*
-    MIME part that it finds as the ticket description.
-    By default it will always take only the actual message and drop any chained messages
-    from replies.
-    The HELPDESK_FULL_FIRST_MESSAGE_FROM_EMAIL settings can force the entire message to be
-    stored in the ticket if it is a new ticket by setting it to True.
-    In this scenario, if it is a reply that is a forwarded message with no actual message,
-    then the description will be sourced from the text/html part and the forwarded message
-    will be in the FollowUp record associated with the ticket.
-    It will iterate over every MIME part and store all MIME parts as attachments apart
-    from the text/plain part.
-    There may be a case for trying to exclude repeated signature images by checking if an
-    attachment of the same name already exists as an attachment on the ticket but that is
-    not implemented.
-    :param message: the raw email message received
-    :param queue: the queue that the message is assigned to
-    :param logger: the logger to be used
+    Get the hash of a raw e-mail and its Message-ID, which identify it in the
+    ingestion ledger. Only the headers are parsed.
+    """
+    if isinstance(message, bytes):
+        raw = message
+        headers = BytesHeaderParser(policy=policy.compat32).parsebytes(message)
+    else:
+        raw = message.encode("utf-8", "surrogatepass")
+        headers = HeaderParser(policy=policy.compat32).parsestr(message)
+    message_id = headers.get("Message-ID")
+    if message_id:
+        message_id = str(message_id).strip()[:256]
+    return hashlib.sha256(raw).hexdigest(), message_id or None
+
+
+def get_email_date(message) -> datetime | None:
+    """
+    Get the date of the Date header of a parsed e-mail, or None if it has no
+    valid one. A date without a time zone is taken as UTC.
+    """
+    try:
+        date = parsedate_to_datetime(str(message["Date"]))
+    except (TypeError, ValueError, IndexError):
+        return None
+    if timezone.is_naive(date):
+        date = date.replace(tzinfo=dt_timezone.utc)
+    if not settings.USE_TZ:
+        date = timezone.make_naive(date)
+    return date
+
+
+def get_ingested_ticket(
+    queue: Queue, content_hash: str, message_id: str | None
+) -> Ticket | None:
+    """
+    Get the ticket an e-mail was already turned into, if the ingestion ledger
+    of the queue has an entry with the same content or Message-ID
+    """
+    query = Q(content_hash=content_hash)
+    if message_id:
+        query |= Q(message_id=message_id)
+    entry = (
+        IngestedEmail.objects.filter(query, queue=queue)
+        .select_related("ticket__queue")
+        .first()
+    )
+    return entry.ticket if entry else None
+
+
+def exclude_ingested_emails(queue: Queue, messages: dict) -> dict:
+    """
+    Leave out of the raw e-mails, by any key, those already in the ingestion
+    ledger of the queue, looked up in a single query
+    """
+    keys = {key: get_ingestion_key(message) for key, message in messages.items()}
+    message_ids = {message_id for __, message_id in keys.values() if message_id}
+    ingested_hashes, ingested_ids = set(), set()
+    for content_hash, message_id in IngestedEmail.objects.filter(
+        Q(content_hash__in={content_hash for content_hash, __ in keys.values()})
+        | Q(message_id__in=message_ids),
+        queue=queue,
+    ).values_list("content_hash", "message_id"):
+        ingested_hashes.add(content_hash)
+        ingested_ids.add(message_id)
+    return {
+        key: message
+        for key, message in messages.items()
+        if keys[key][0] not in ingested_hashes
+        and not (keys[key][1] and keys[key][1] in ingested_ids)
+    }
+
+
+def record_message_failure(q: Queue, message: str | bytes, logger) -> bool:
+    """
+    Count a failure to process an e-mail of the queue, from within the except
+    block handling it.
+
+    Once the e-mail failed HELPDESK_EMAIL_QUARANTINE_FAILURES times, it is
+    stored in a QuarantinedEmail and True is returned: the caller then removes
+    it from the mailbox so that it is not parsed again on every poll.
+    """
+    limit = helpdesk_settings.HELPDESK_EMAIL_QUARANTINE_FAILURES
+    if not limit:
+        return False
+    content_hash, message_id = get_ingestion_key(message)
+    entry = QuarantinedEmail.objects.get_or_create(
+        queue=q, content_hash=content_hash, defaults={"message_id": message_id}
+    )[0]
+    entry.failures += 1
+    entry.last_error = traceback.format_exc()
+    entry.date = timezone.now()
+    if entry.failures >= limit and entry.quarantined is None:
+        if isinstance(message, str):
+            message = message.encode("utf-8", "surrogatepass")
+        entry.file.save(f"{content_hash}.eml", ContentFile(message), save=False)
+        entry.quarantined = entry.date
+        logger.error(
+            "Message %s failed %d times, it was quarantined and will be removed "
+            "from the mailbox.",
+            message_id or content_hash,
+            entry.failures,
+        )
+    entry.save()
+    return entry.quarantined is not None
+
+
+def reprocess_quarantined_email(entry: QuarantinedEmail, logger) -> Ticket | None:
+    """
+    Process a quarantined e-mail again, eg once the bug it triggered is fixed.
+    The quarantine entry is removed when a ticket or follow-up was created.
+    """
+    with entry.file.open("rb") as f:
+        message = f.read()
+    ticket = extract_email_metadata(message=message, queue=entry.queue, logger=logger)
+    if ticket:
+        entry.file.delete(save=False)
+        entry.delete()
+    return ticket
+
+
+def parse_email_message(message: str | bytes, logger: logging.Logger) -> dict:
+    """
+    Parse a raw e-mail into the subject, sender, priority, bodies and
+    attachments needed to create a ticket or follow-up from it.
+
+    Nothing is read from or written to the database, so that e-mails can be
+    parsed by parse worker processes while tickets are created in order.
+    The body excludes the chained messages of replies, the full body does not.
     """
     # 'message' must be an RFC822 formatted message to correctly parse.
     # NBot sure why but policy explicitly set to default is required for any messages with attachments in them
-    message_obj: EmailMessage = email.message_from_string(
-        message, EmailMessage, policy=policy.default
-    )
+    from_bytes = isinstance(message, bytes)
+    if from_bytes:
+        message_obj: EmailMessage = email.message_from_bytes(
+            message, EmailMessage, policy=policy.default
+        )
+    else:
+        message_obj: EmailMessage = email.message_from_string(
+            message, EmailMessage, policy=policy.default
+        )
 
     subject = extract_email_subject(message_obj)
 
@@ -1081,53 +2291,9 @@ def extract_email_metadata(
         # Since the spec requires that all email addresses are ASCII, they will not be encoded
         sender_email = email.utils.parseaddr(sender_hdr)[1]
 
-    for ignore in IgnoreEmail.objects.filter(Q(queues=queue) | Q(queues__isnull=True)):
-        if ignore.test(sender_email):
-            raise (
-                IgnoreTicketException()
-                if ignore.keep_in_mailbox
-                else DeleteIgnoredTicketException()
-            )
-
-    # First try to get ticket ID from the current queue's slug
-    ticket_id: int | None = get_ticket_id_from_subject_slug(queue.slug, subject, logger)
-
-    # If no ticket ID found in the current queue, check all other queues
-    original_queue = queue  # Store the original queue in case we need to revert
-    if ticket_id is None:
-        # Get all enabled queues except the current one, regardless of allow_email_submission
-        other_queues = Queue.objects.exclude(id=queue.id).filter(
-            email_box_type__isnull=False
-        )
-
-        for other_queue in other_queues:
-            ticket_id = get_ticket_id_from_subject_slug(
-                other_queue.slug, subject, logger
-            )
-            if ticket_id is not None:
-                # Found a matching ticket in another queue, use that queue instead
-                logger.info(
-                    f"Found ticket {ticket_id} matching subject in queue {other_queue.slug} "
-                    f"instead of current queue {queue.slug}"
-                )
-                queue = other_queue
-                break
-
-        # If no ticket ID was found in any queue, revert to the original queue for new ticket
-        if ticket_id is None:
-            queue = original_queue
-            logger.info(
-                f"No existing ticket found, reverting to original queue {queue.slug}"
-            )
-
     files = []
-    # first message in thread, we save full body to avoid losing forwards and things like that
-    include_chained_msgs = bool(
-        ticket_id is None
-        and getattr(settings, "HELPDESK_FULL_FIRST_MESSAGE_FROM_EMAIL", False)
-    )
     filtered_body, full_body = extract_email_message_content(
-        message_obj, files, include_chained_msgs
+        message_obj, files, False, from_bytes
     )
     # If the base part is not a multipart then it will have already been processed as the vbody content so
     # no need to process attachments
@@ -1158,16 +2324,302 @@ def extract_email_metadata(
     high_priority_types = {"high", "important", "1", "urgent"}
     priority = 2 if high_priority_types & {smtp_priority, smtp_importance} else 3
 
-    payload = {
+    return {
+        "message": message_obj,
         "body": filtered_body,
         "full_body": full_body,
         "subject": subject,
-        "queue": queue,
         "sender_email": sender_email,
         "priority": priority,
         "files": files,
     }
 
-    return create_object_from_email_message(
-        message_obj, ticket_id, payload, files, logger=logger
+
+def parse_email_message_in_worker(message: str | bytes, logger: logging.Logger) -> dict:
+    """
+    Parse a raw e-mail in a parse worker process
+
+    The parsed e-mail is returned in a picklable form: the message is reduced
+    to its raw headers, and attachments spooled to temporary files are given
+    a path that outlives this process' file objects.
+    """
+    parsed = parse_email_message(message, logger)
+    parsed["message"] = list(parsed["message"].raw_items())
+    files = []
+    for upload in parsed["files"]:
+        if isinstance(upload, TemporaryUploadedFile):
+            path = f"{upload.temporary_file_path()}.parsed"
+            try:
+                os.link(upload.temporary_file_path(), path)
+            except OSError:
+                shutil.copyfile(upload.temporary_file_path(), path)
+            upload.close()
+            upload = (path, upload.name, upload.content_type, upload.size)
+        files.append(upload)
+    parsed["files"] = files
+    return parsed
+
+
+class ParsedUploadedFile(UploadedFile):
+    """An attachment spooled by a parse worker, removed once closed"""
+
+    def close(self):
+        try:
+            return super().close()
+        finally:
+            with contextlib.suppress(OSError):
+                os.unlink(self.file.name)
+
+
+def restore_parsed_email(parsed: dict) -> dict:
+    """Turn an e-mail parsed by parse_email_message_in_worker back into the
+    form returned by parse_email_message"""
+    message_obj = EmailMessage(policy=policy.default)
+    for name, value in parsed["message"]:
+        message_obj.set_raw(name, value)
+    files = []
+    for upload in parsed["files"]:
+        if isinstance(upload, tuple):
+            path, name, content_type, size = upload
+            upload = ParsedUploadedFile(open(path, "rb"), name, content_type, size)  # noqa: SIM115 - closed with the other attachments
+        files.append(upload)
+    return {**parsed, "message": message_obj, "files": files}
+
+
+def get_parse_executor() -> ProcessPoolExecutor | None:
+    """
+    Get the pool of HELPDESK_EMAIL_PARSE_WORKERS processes parsing e-mails,
+    or None when e-mails are parsed by the process creating the tickets
+    """
+    global PARSE_EXECUTOR
+    if not helpdesk_settings.HELPDESK_EMAIL_PARSE_WORKERS:
+        return None
+    with PARSE_EXECUTOR_LOCK:
+        if PARSE_EXECUTOR is None:
+            PARSE_EXECUTOR = ProcessPoolExecutor(
+                max_workers=helpdesk_settings.HELPDESK_EMAIL_PARSE_WORKERS,
+                initializer=django.setup,
+            )
+        return PARSE_EXECUTOR
+
+
+def reset_parse_executor() -> None:
+    """
+    Discard the pool of parse workers, eg after one of them died. E-mails
+    still waiting to be parsed are parsed by the process creating the tickets,
+    and a new pool is started for the next ones.
+    """
+    global PARSE_EXECUTOR
+    with PARSE_EXECUTOR_LOCK:
+        executor, PARSE_EXECUTOR = PARSE_EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_email_messages(
+    messages: dict,
+    logger: logging.Logger,
+    executor: ProcessPoolExecutor | None = None,
+    queue: Queue | None = None,
+) -> dict:
+    """
+    Start parsing raw e-mails with the parse workers
+
+    The futures must be handed to discard_parsed_emails() once the e-mails
+    are processed, so that the attachments of those not used are removed.
+
+    :param messages: the raw e-mails, by any key such as their UID
+    :param executor: the pool of parse workers, instead of the one of
+           HELPDESK_EMAIL_PARSE_WORKERS
+    :param queue: the queue receiving the e-mails, so that those already in
+           its ingestion ledger are not parsed
+    :returns the future of each parsed e-mail to be passed on to
+             extract_email_metadata, by key. Empty when parse workers are not
+             enabled, so that e-mails are parsed as they are processed.
+    """
+    executor = executor or get_parse_executor()
+    if executor is None:
+        return {}
+    if queue is not None and helpdesk_settings.HELPDESK_EMAIL_INGESTION_LEDGER:
+        messages = exclude_ingested_emails(queue, messages)
+    try:
+        return {
+            key: executor.submit(parse_email_message_in_worker, message, logger)
+            for key, message in messages.items()
+        }
+    except BrokenProcessPool:
+        logger.warning("E-mail parse workers stopped, parsing e-mails in process")
+        reset_parse_executor()
+        return {}
+
+
+def discard_parsed_emails(futures) -> None:
+    """
+    Remove the attachments spooled by the parse workers for the e-mails whose
+    parsed form was not used, eg skipped by the ingestion ledger or left
+    unprocessed by an error. The attachments of the others were removed when
+    they were closed.
+
+    :param futures: the futures returned by parse_email_messages
+    """
+    for future in futures:
+        if future is None or future.cancel():
+            continue
+        try:
+            files = future.result()["files"]
+        except Exception:  # noqa: BLE001, S112 - nothing was spooled
+            continue
+        for upload in files:
+            if isinstance(upload, tuple):
+                with contextlib.suppress(OSError):
+                    os.unlink(upload[0])
+
+
+def get_parsed_email(
+    message: str | bytes, parsed: Future | None, logger: logging.Logger
+) -> dict:
+    """
+    Get the parsed e-mail from the future returned by parse_email_messages,
+    or parse the e-mail in process when there is none or the parse workers
+    stopped
+    """
+    if parsed is not None:
+        try:
+            return restore_parsed_email(parsed.result())
+        except CancelledError:
+            pass
+        except BrokenProcessPool:
+            logger.warning("E-mail parse workers stopped, parsing e-mail in process")
+            reset_parse_executor()
+    return parse_email_message(message, logger)
+
+
+def create_object_from_parsed_email(
+    parsed: dict,
+    queue: Queue,
+    logger: logging.Logger,
+    notify: bool = True,
+    date: datetime | None = None,
+) -> Ticket | None:
+    """
+    Create the ticket or follow-up of a parsed e-mail received by the queue
+
+    Raises IgnoreTicketException or DeleteIgnoredTicketException when the
+    sender is ignored. The attachments of the parsed e-mail are closed.
+    :param notify: send the e-mail notifications and the signals of the new
+           ticket or follow-up
+    :param date: date of the new ticket or follow-up, eg. the date of an
+           imported e-mail, rather than the current time
+    """
+    message_obj = parsed["message"]
+    files = parsed["files"]
+    try:
+        subject = parsed["subject"]
+        sender_email = parsed["sender_email"]
+
+        keep_in_mailbox = IgnoreEmail.objects.match(queue, sender_email)
+        if keep_in_mailbox is not None:
+            raise (
+                IgnoreTicketException()
+                if keep_in_mailbox
+                else DeleteIgnoredTicketException()
+            )
+
+        # Find the tracking ID of an existing ticket, possibly in another queue
+        queue, ticket_id = get_ticket_id_from_subject(queue, subject, logger)
+
+        filtered_body, full_body = parsed["body"], parsed["full_body"]
+        # first message in thread, we save full body to avoid losing forwards and things like that
+        if (
+            ticket_id is None
+            and getattr(settings, "HELPDESK_FULL_FIRST_MESSAGE_FROM_EMAIL", False)
+            and full_body
+            and full_body.strip()
+        ):
+            filtered_body = full_body
+
+        payload = {
+            "body": filtered_body,
+            "full_body": full_body,
+            "subject": subject,
+            "queue": queue,
+            "sender_email": sender_email,
+            "priority": parsed["priority"],
+            "files": files,
+        }
+
+        return create_object_from_email_message(
+            message_obj,
+            ticket_id,
+            payload,
+            files,
+            logger=logger,
+            notify=notify,
+            date=date,
+        )
+    finally:
+        # Removes the attachments spooled to temporary files
+        for file in files:
+            file.close()
+
+
+def extract_email_metadata(
+    message: str | bytes,
+    queue: Queue,
+    logger: logging.Logger,
+    parsed: Future | None = None,
+) -> Ticket:
+    """
+    Extracts the text/plain  mime part if there is one as the ticket description and
+    stores the text/html part as an attachment if it is present.
+    If no text/plain  part is present then it will try to use the text/html part if
+    it is present as the ticket description by removing the HTML formatting.
+    If neither a text/plain or text/html is present then it will use the first text/*
+    MIME part that it finds as the ticket description.
+    By default it will always take only the actual message and drop any chained messages
+    from replies.
+    The HELPDESK_FULL_FIRST_MESSAGE_FROM_EMAIL settings can force the entire message to be
+    stored in the ticket if it is a new ticket by setting it to True.
+    In this scenario, if it is a reply that is a forwarded message with no actual message,
+    then the description will be sourced from the text/html part and the forwarded message
+    will be in the FollowUp record associated with the ticket.
+    It will iterate over every MIME part and store all MIME parts as attachments apart
+    from the text/plain part.
+    There may be a case for trying to exclude repeated signature images by checking if an
+    attachment of the same name already exists as an attachment on the ticket but that is
+    not implemented.
+    :param message: the raw email message received, preferably as the bytes
+           read from the mail server so that 8bit parts are decoded with their
+           own charset
+    :param queue: the queue that the message is assigned to
+    :param logger: the logger to be used
+    :param parsed: the future returned by parse_email_messages for the message,
+           when it is parsed by the parse workers
+    """
+    ingestion_key = None
+    if helpdesk_settings.HELPDESK_EMAIL_INGESTION_LEDGER:
+        ingestion_key = get_ingestion_key(message)
+        ticket = get_ingested_ticket(queue, *ingestion_key)
+        if ticket is not None:
+            logger.info(
+                "Message %s was already processed into ticket %s, skipping it.",
+                ingestion_key[1] or ingestion_key[0],
+                ticket.ticket,
+            )
+            discard_parsed_emails([parsed])
+            return ticket
+        received_queue = queue
+
+    ticket = create_object_from_parsed_email(
+        get_parsed_email(message, parsed, logger), queue, logger
     )
+
+    if ingestion_key is not None and ticket is not None:
+        content_hash, message_id = ingestion_key
+        IngestedEmail.objects.create(
+            queue=received_queue,
+            message_id=message_id,
+            content_hash=content_hash,
+            ticket=ticket,
+        )
+    return ticket
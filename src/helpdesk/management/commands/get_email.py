@@ -37,11 +37,19 @@ class Command(BaseCommand):
             default=False,
             help="Log additional messaging to stdout.",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            dest="workers",
+            default=None,
+            help="Number of queues to poll concurrently (default: HELPDESK_EMAIL_POLL_WORKERS)",
+        )
 
     def handle(self, *args, **options):
         quiet = options.get("quiet")
         debug_to_stdout = options.get("debug_to_stdout")
-        process_email(quiet=quiet, debug_to_stdout=debug_to_stdout)
+        workers = options.get("workers")
+        process_email(quiet=quiet, debug_to_stdout=debug_to_stdout, workers=workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+helpdesk_import_mailbox.py - Import the e-mails of an mbox file or a Maildir
+                             directory into a queue, eg the mail history of a
+                             team moving to the helpdesk.
+"""
+
+import mailbox
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from helpdesk.email import (
+    close_queue_logger,
+    create_object_from_parsed_email,
+    discard_parsed_emails,
+    get_email_date,
+    get_ingestion_key,
+    get_parsed_email,
+    get_queue_logger,
+    parse_email_messages,
+)
+from helpdesk.exceptions import DeleteIgnoredTicketException, IgnoreTicketException
+from helpdesk.models import IngestedEmail, Queue
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the e-mails of an mbox file or a Maildir directory into a "
+        "queue, without sending notifications. E-mails already imported are "
+        "skipped, so an interrupted import can simply be run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue", help="Slug of the queue to import into")
+        parser.add_argument("path", help="Path of the mbox file or Maildir directory")
+        parser.add_argument(
+            "--format",
+            choices=("mbox", "maildir"),
+            help="Mailbox format (default: maildir for a directory, mbox otherwise)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="E-mails imported per database transaction (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Processes parsing the e-mails, 0 to parse them in this process (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--notify",
+            action="store_true",
+            default=False,
+            help="Send the e-mail notifications and signals of the imported tickets",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            queue = Queue.objects.get(slug=options["queue"])
+        except Queue.DoesNotExist:
+            raise CommandError(f"Queue '{options['queue']}' does not exist") from None
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError(f"Mailbox '{path}' does not exist")
+        mailbox_format = options["format"] or (
+            "maildir" if os.path.isdir(path) else "mbox"
+        )
+        if mailbox_format == "maildir":
+            box = mailbox.Maildir(path, factory=None, create=False)
+        else:
+            box = mailbox.mbox(path, factory=None, create=False)
+
+        # mbox keys follow the file, Maildir names start with the delivery time
+        keys = sorted(box.keys())
+        batch_size = max(options["batch_size"], 1)
+        executor = (
+            ProcessPoolExecutor(
+                max_workers=options["workers"], initializer=django.setup
+            )
+            if options["workers"] > 0
+            else None
+        )
+        logger, log_file_handler = get_queue_logger(
+            queue, quiet=options["verbosity"] < 2
+        )
+        counts = Counter()
+        started = time.monotonic()
+        try:
+            for start in range(0, len(keys), batch_size):
+                self.import_batch(
+                    queue,
+                    box,
+                    keys[start : start + batch_size],
+                    executor,
+                    options["notify"],
+                    counts,
+                    logger,
+                )
+                if options["verbosity"] > 0:
+                    done = min(start + batch_size, len(keys))
+                    rate = done / max(time.monotonic() - started, 0.001)
+                    self.stdout.write(
+                        f"{done}/{len(keys)} e-mails: {counts['imported']} imported, "
+                        f"{counts['skipped']} skipped, {counts['ignored']} ignored, "
+                        f"{counts['failed']} failed ({rate:.0f} e-mails/s)"
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            box.close()
+            close_queue_logger(logger, log_file_handler)
+
+    def import_batch(self, queue, box, keys, executor, notify, counts, logger):
+        """
+        Import a batch of e-mails in a single transaction, recording them in
+        the ingestion ledger so that they are skipped if the import is run again
+        """
+        messages, ingestion_keys = {}, {}
+        for key in keys:
+            messages[key] = box.get_bytes(key)
+            ingestion_keys[key] = get_ingestion_key(messages[key])
+        imported = set(
+            IngestedEmail.objects.filter(
+                queue=queue,
+                content_hash__in=[key[0] for key in ingestion_keys.values()],
+            ).values_list("content_hash", flat=True)
+        )
+        for key in keys:
+            # Already imported, or a copy of an e-mail of this batch
+            if ingestion_keys[key][0] in imported:
+                del messages[key]
+                counts["skipped"] += 1
+            imported.add(ingestion_keys[key][0])
+
+        parsed = parse_email_messages(messages, logger, executor) if executor else {}
+        try:
+            ingested = []
+            with transaction.atomic():
+                for key, message in messages.items():
+                    try:
+                        parsed_email = get_parsed_email(
+                            message, parsed.get(key), logger
+                        )
+                        with transaction.atomic():
+                            # The ticket history keeps the dates of the e-mails
+                            ticket = create_object_from_parsed_email(
+                                parsed_email,
+                                queue,
+                                logger,
+                                notify=notify,
+                                date=get_email_date(parsed_email["message"]),
+                            )
+                    except (IgnoreTicketException, DeleteIgnoredTicketException):
+                        counts["ignored"] += 1
+                    except Exception:
+                        logger.exception(f"Unexpected error importing e-mail {key}")
+                        counts["failed"] += 1
+                    else:
+                        if ticket:
+                            content_hash, message_id = ingestion_keys[key]
+                            ingested.append(
+                                IngestedEmail(
+                                    queue=queue,
+                                    message_id=message_id,
+                                    content_hash=content_hash,
+                                    ticket=ticket,
+                                )
+                            )
+                            counts["imported"] += 1
+                        else:
+                            counts["skipped"] += 1
+                IngestedEmail.objects.bulk_create(ingested)
+        finally:
+            discard_parsed_emails(parsed.values())
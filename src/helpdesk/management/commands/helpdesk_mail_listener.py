@@ -0,0 +1,115 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+scripts/helpdesk_mail_listener.py - Long running alternative to get_email for
+                                    IMAP queues. Keeps one connection open per
+                                    queue and uses IMAP IDLE to create tickets
+                                    as soon as new mail arrives.
+"""
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from helpdesk import settings as helpdesk_settings
+from helpdesk.email import (
+    IMAP_IDLE_TIMEOUT,
+    get_imap_listener_functions,
+    listen_to_queue,
+)
+from helpdesk.models import Queue
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep an IMAP IDLE connection open for every IMAP queue and process "
+        "new e-mails as soon as they arrive, instead of polling from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-q",
+            "--queues",
+            nargs="*",
+            help="Queues to listen to (default: all IMAP queues). Enter the queues slug as space separated list.",
+        )
+        parser.add_argument(
+            "--idle-timeout",
+            type=int,
+            default=IMAP_IDLE_TIMEOUT,
+            help="Seconds to wait in IDLE before re-issuing it (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--max-backoff",
+            type=int,
+            default=300,
+            help="Maximum seconds to wait between reconnection attempts (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--quiet",
+            action="store_true",
+            default=False,
+            help="Hide details about each queue/message as they are processed",
+        )
+
+    def handle(self, *args, **options):
+        listener_types = get_imap_listener_functions()
+        queues = Queue.objects.filter(
+            email_box_type__isnull=False, allow_email_submission=True
+        )
+        if options["queues"]:
+            queues = queues.filter(slug__in=options["queues"])
+        queues = [
+            q
+            for q in queues
+            if (helpdesk_settings.QUEUE_EMAIL_BOX_TYPE or q.email_box_type)
+            in listener_types
+        ]
+        if not queues:
+            self.stderr.write("No IMAP queues to listen to.")
+            return
+
+        stop_event = threading.Event()
+
+        def stop(signum, frame):
+            stop_event.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, stop)
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        listeners = [
+            threading.Thread(
+                target=listen_to_queue,
+                args=(q, stop_event),
+                kwargs={
+                    "idle_timeout": options["idle_timeout"],
+                    "max_backoff": options["max_backoff"],
+                    "quiet": options["quiet"],
+                },
+                name=f"helpdesk-mail-listener-{q.slug}",
+                daemon=True,
+            )
+            for q in queues
+        ]
+        try:
+            for listener in listeners:
+                listener.start()
+            if not options["quiet"]:
+                self.stdout.write(
+                    f"Listening for new mail on {len(listeners)} queue(s): "
+                    + ", ".join(q.slug for q in queues)
+                )
+            # The listeners use their own connections
+            connections.close_all()
+            while any(listener.is_alive() for listener in listeners):
+                for listener in listeners:
+                    listener.join(timeout=1)
+        finally:
+            stop_event.set()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
@@ -0,0 +1,106 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+helpdesk_mail_worker.py - Send the e-mails of the outbox in the background,
+                          when HELPDESK_EMAIL_OUTBOX is enabled.
+"""
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from helpdesk.templated_email import deliver_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Send the e-mails queued in the outbox, retrying the failed ones "
+        "with an increasing delay. Runs until interrupted, unless --once "
+        "is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Threads sending e-mails concurrently, each with its own connection to the mail server (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="E-mails reserved and sent by a thread at a time (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait when the outbox is empty (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            default=False,
+            help="Exit once the e-mails due have been sent, eg when run from cron",
+        )
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        counts = {"sent": 0, "failed": 0}
+        lock = threading.Lock()
+
+        def work():
+            while not stop_event.is_set():
+                sent, failed = deliver_outbox(max(options["batch_size"], 1))
+                with lock:
+                    counts["sent"] += sent
+                    counts["failed"] += failed
+                if sent or failed:
+                    continue
+                if options["once"]:
+                    return
+                stop_event.wait(options["interval"])
+
+        def work_in_thread():
+            try:
+                work()
+            finally:
+                connections.close_all()
+
+        def stop(signum, frame):
+            stop_event.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, stop)
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            if options["workers"] > 1:
+                workers = [
+                    threading.Thread(
+                        target=work_in_thread,
+                        name=f"helpdesk-mail-worker-{i}",
+                        daemon=True,
+                    )
+                    for i in range(options["workers"])
+                ]
+                for worker in workers:
+                    worker.start()
+                while any(worker.is_alive() for worker in workers):
+                    for worker in workers:
+                        worker.join(timeout=1)
+            else:
+                work()
+        finally:
+            stop_event.set()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        if options["verbosity"] > 0:
+            self.stdout.write(
+                f"Sent {counts['sent']} e-mail(s), {counts['failed']} failed."
+            )
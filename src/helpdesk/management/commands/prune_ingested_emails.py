@@ -0,0 +1,39 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+prune_ingested_emails.py - Remove old entries of the ingestion ledger of
+                           incoming e-mails, designed to be run from Cron or
+                           similar.
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import IngestedEmail
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove the entries of the ingestion ledger of incoming e-mails "
+        "that are older than the retention period."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-d",
+            "--days",
+            type=int,
+            default=helpdesk_settings.HELPDESK_EMAIL_INGESTION_LEDGER_DAYS,
+            help="Keep the entries of the last DAYS days (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        deleted, _ = IngestedEmail.objects.filter(date__lt=cutoff).delete()
+        if options["verbosity"] > 0:
+            self.stdout.write(f"Removed {deleted} ingested e-mail(s).")
@@ -0,0 +1,25 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+send_email_digests.py - Send the digest e-mails of the ticket updates to the
+                        queues and users that receive digests, designed to be
+                        run from Cron or similar.
+"""
+
+from django.core.management.base import BaseCommand
+
+from helpdesk.update_ticket import send_email_digests
+
+
+class Command(BaseCommand):
+    help = (
+        "Send each recipient of pending digest notifications a single e-mail "
+        "summarising the ticket updates since their previous digest."
+    )
+
+    def handle(self, *args, **options):
+        sent = send_email_digests()
+        if options["verbosity"] > 0:
+            self.stdout.write(f"Sent {sent} digest e-mail(s).")
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0039_alter_ticketchange_field"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queue",
+            name="email_box_imap_last_uid",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="queue",
+            name="email_box_imap_uidvalidity",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
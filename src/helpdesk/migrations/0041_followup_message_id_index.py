@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0040_queue_email_box_imap_uid"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="followup",
+            name="message_id",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="The Message ID of the submitter's email.",
+                max_length=256,
+                null=True,
+                verbose_name="E-Mail ID",
+            ),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0041_followup_message_id_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IngestedEmail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "message_id",
+                    models.CharField(
+                        blank=True, max_length=256, null=True, verbose_name="E-Mail ID"
+                    ),
+                ),
+                (
+                    "content_hash",
+                    models.CharField(
+                        help_text="SHA-256 hash of the raw e-mail.",
+                        max_length=64,
+                        verbose_name="Content hash",
+                    ),
+                ),
+                (
+                    "date",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="Date",
+                    ),
+                ),
+                (
+                    "queue",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="helpdesk.queue",
+                        verbose_name="Queue",
+                    ),
+                ),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="helpdesk.ticket",
+                        verbose_name="Ticket",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Ingested e-mail",
+                "verbose_name_plural": "Ingested e-mails",
+                "indexes": [
+                    models.Index(
+                        fields=["queue", "content_hash"],
+                        name="helpdesk_in_queue_i_91b078_idx",
+                    ),
+                    models.Index(
+                        fields=["queue", "message_id"],
+                        name="helpdesk_in_queue_i_99008e_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
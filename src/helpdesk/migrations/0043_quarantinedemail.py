@@ -0,0 +1,88 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:40
+
+import django.db.models.deletion
+import django.utils.timezone
+import helpdesk.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0042_ingestedemail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuarantinedEmail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "message_id",
+                    models.CharField(
+                        blank=True, max_length=256, null=True, verbose_name="E-Mail ID"
+                    ),
+                ),
+                (
+                    "content_hash",
+                    models.CharField(
+                        help_text="SHA-256 hash of the raw e-mail.",
+                        max_length=64,
+                        verbose_name="Content hash",
+                    ),
+                ),
+                (
+                    "failures",
+                    models.PositiveIntegerField(default=0, verbose_name="Failures"),
+                ),
+                ("last_error", models.TextField(blank=True, verbose_name="Last error")),
+                (
+                    "file",
+                    models.FileField(
+                        blank=True,
+                        help_text="The raw e-mail, once it has been quarantined.",
+                        max_length=1000,
+                        upload_to=helpdesk.models.quarantine_path,
+                        verbose_name="File",
+                    ),
+                ),
+                (
+                    "date",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="Last failure"
+                    ),
+                ),
+                (
+                    "quarantined",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Quarantined"
+                    ),
+                ),
+                (
+                    "queue",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="helpdesk.queue",
+                        verbose_name="Queue",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Quarantined e-mail",
+                "verbose_name_plural": "Quarantined e-mails",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("queue", "content_hash"),
+                        name="helpdesk_quarantinedemail_unique_hash",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:06
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0043_quarantinedemail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SeenPOP3Message",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "uidl",
+                    models.CharField(
+                        help_text="Unique id of the message on the POP3 server.",
+                        max_length=70,
+                        verbose_name="UIDL",
+                    ),
+                ),
+                (
+                    "date",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="Date"
+                    ),
+                ),
+                (
+                    "queue",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="helpdesk.queue",
+                        verbose_name="Queue",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Seen POP3 message",
+                "verbose_name_plural": "Seen POP3 messages",
+                "unique_together": {("queue", "uidl")},
+            },
+        ),
+    ]
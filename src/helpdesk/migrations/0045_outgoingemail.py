@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0044_seenpop3message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_email', models.CharField(max_length=1000, verbose_name='From')),
+                ('recipients', models.JSONField(default=list, verbose_name='Recipients')),
+                ('subject', models.CharField(blank=True, max_length=1000, verbose_name='Subject')),
+                ('message', models.BinaryField(help_text='The rendered e-mail, as sent to the mail server.', verbose_name='Message')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created')),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Next attempt')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+                ('failed', models.DateTimeField(blank=True, help_text='Set once the e-mail is no longer retried.', null=True, verbose_name='Failed')),
+            ],
+            options={
+                'verbose_name': 'Outgoing e-mail',
+                'verbose_name_plural': 'Outgoing e-mails',
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:30
+
+import django.db.models.deletion
+import django.utils.timezone
+import helpdesk.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0045_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='email_digest',
+            field=models.BooleanField(blank=True, default=False, help_text='Instead of one e-mail per ticket update, collect the updates and send everyone a single e-mail summarising them each time the send_email_digests command runs. Assignments, resolutions and closings are still sent straight away.', verbose_name='Send update notifications as digests'),
+        ),
+        migrations.AddField(
+            model_name='usersettings',
+            name='email_digest',
+            field=models.BooleanField(default=helpdesk.models.email_digest_default, help_text='Do you want to receive a single e-mail summarising the updates of your tickets from time to time, instead of one e-mail per update? Assignments, resolutions and closings are still sent straight away.', verbose_name='Receive ticket updates as a digest?'),
+        ),
+        migrations.CreateModel(
+            name='DigestNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.CharField(db_index=True, max_length=1000, verbose_name='Recipient')),
+                ('role', models.CharField(help_text='Why the recipient is notified, eg submitter or ticket_cc.', max_length=32, verbose_name='Role')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Date')),
+                ('followup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='helpdesk.followup', verbose_name='Follow-up')),
+            ],
+            options={
+                'verbose_name': 'Digest notification',
+                'verbose_name_plural': 'Digest notifications',
+            },
+        ),
+    ]
@@ -0,0 +1,147 @@
+from django.db import migrations
+
+
+PLAIN_TEXT = """{% autoescape off %}HELLO
+
+INTRO
+{% for update in updates %}
+{{ update.ticket.ticket }} {{ update.ticket.title }} ({{ update.ticket.get_status }})
+{{ update.url }}
+{% for followup in update.followups %}
+* {{ followup.date|date:"DATETIME_FORMAT" }}{% if followup.user %} - {{ followup.user }}{% endif %}: {{ followup.title }}{% if followup.comment %}
+
+{{ followup.comment }}
+{% endif %}{% endfor %}
+{% endfor %}
+FOOTER{% endautoescape %}"""
+
+HTML = """<p style="font-family: sans-serif; font-size: 1em;">HELLO</p>
+
+<p style="font-family: sans-serif; font-size: 1em;">INTRO</p>
+{% for update in updates %}
+<p style="font-family: sans-serif; font-size: 1em;"><b><a href="{{ update.url }}">{{ update.ticket.ticket }} {{ update.ticket.title }}</a></b> ({{ update.ticket.get_status }})</p>
+<ul style="font-family: sans-serif; font-size: 1em;">
+{% for followup in update.followups %}<li><b>{{ followup.date|date:"DATETIME_FORMAT" }}{% if followup.user %} - {{ followup.user }}{% endif %}: {{ followup.title }}</b>{% if followup.comment %}<br>{{ followup.comment|linebreaksbr }}{% endif %}</li>
+{% endfor %}</ul>
+{% endfor %}
+<p style="font-family: sans-serif; font-size: 1em;">FOOTER</p>"""
+
+# locale, subject, heading, greeting, introduction, footer
+DIGESTS = [
+    (
+        "cs",
+        "{{ queue.title }}: {{ count }} aktualizací u {{ updates|length }} ticketů",
+        "Aktualizace ticketů",
+        "Dobrý den,",
+        "následující tickety byly od Vašeho posledního přehledu aktualizovány.",
+        "Tento přehled dostáváte místo e-mailu o každé aktualizaci.",
+    ),
+    (
+        "de",
+        "{{ queue.title }}: {{ count }} Aktualisierung(en) an {{ updates|length }} Ticket(s)",
+        "Ticket-Aktualisierungen",
+        "Hallo,",
+        "Die folgenden Tickets wurden seit Ihrer letzten Zusammenfassung aktualisiert.",
+        "Sie erhalten diese Zusammenfassung anstelle einer E-Mail für jede Aktualisierung.",
+    ),
+    (
+        "en",
+        "{{ queue.title }} digest: {{ count }} update(s) on {{ updates|length }} ticket(s)",
+        "Ticket updates",
+        "Hello,",
+        "The following tickets were updated since your last digest.",
+        "You receive this digest instead of an e-mail for each update.",
+    ),
+    (
+        "es",
+        "{{ queue.title }}: {{ count }} actualización(es) en {{ updates|length }} ticket(s)",
+        "Actualizaciones de tickets",
+        "Hola,",
+        "Los siguientes tickets se han actualizado desde su último resumen.",
+        "Recibe este resumen en lugar de un e-mail por cada actualización.",
+    ),
+    (
+        "fi",
+        "{{ queue.title }}: {{ count }} päivitystä {{ updates|length }} palvelupyyntöön",
+        "Palvelupyyntöjen päivitykset",
+        "Hei,",
+        "Seuraavia palvelupyyntöjä on päivitetty edellisen koosteesi jälkeen.",
+        "Saat tämän koosteen erillisen sähköpostin sijaan jokaisesta päivityksestä.",
+    ),
+    (
+        "fr",
+        "{{ queue.title }} : {{ count }} mise(s) à jour sur {{ updates|length }} ticket(s)",
+        "Mises à jour des tickets",
+        "Bonjour,",
+        "Les tickets suivants ont été mis à jour depuis votre dernier résumé.",
+        "Vous recevez ce résumé au lieu d'un courriel pour chaque mise à jour.",
+    ),
+    (
+        "it",
+        "{{ queue.title }}: {{ count }} aggiornamento/i su {{ updates|length }} ticket",
+        "Aggiornamenti dei ticket",
+        "Salve,",
+        "I seguenti ticket sono stati aggiornati dal tuo ultimo riepilogo.",
+        "Ricevi questo riepilogo invece di un'email per ogni aggiornamento.",
+    ),
+    (
+        "pl",
+        "{{ queue.title }}: aktualizacje: {{ count }}, zgłoszenia: {{ updates|length }}",
+        "Aktualizacje zgłoszeń",
+        "Dzień dobry,",
+        "Następujące zgłoszenia zostały zaktualizowane od czasu ostatniego podsumowania.",
+        "Otrzymujesz to podsumowanie zamiast wiadomości e-mail o każdej aktualizacji.",
+    ),
+    (
+        "ru",
+        "{{ queue.title }}: обновлений: {{ count }}, заявок: {{ updates|length }}",
+        "Обновления заявок",
+        "Здравствуйте,",
+        "Следующие заявки были обновлены с момента Вашей последней сводки.",
+        "Вы получаете эту сводку вместо отдельного письма о каждом обновлении.",
+    ),
+    (
+        "zh",
+        "{{ queue.title }}: {{ updates|length }} 个工单有 {{ count }} 项更新",
+        "工单更新",
+        "您好,",
+        "自您上次收到摘要以来, 以下工单已更新.",
+        "您收到此摘要, 而不是每次更新的单独邮件.",
+    ),
+]
+
+
+def forwards_func(apps, schema_editor):
+    EmailTemplate = apps.get_model("helpdesk", "EmailTemplate")
+    db_alias = schema_editor.connection.alias
+    for locale, subject, heading, hello, intro, footer in DIGESTS:
+        last = EmailTemplate.objects.using(db_alias).order_by("-id").first()
+        EmailTemplate.objects.using(db_alias).create(
+            id=last.id + 1 if last else 1,  # because PG sequences are not reset
+            template_name="digest",
+            subject=subject,
+            heading=heading,
+            plain_text=PLAIN_TEXT.replace("HELLO", hello)
+            .replace("INTRO", intro)
+            .replace("FOOTER", footer),
+            html=HTML.replace("HELLO", hello)
+            .replace("INTRO", intro)
+            .replace("FOOTER", footer),
+            locale=locale,
+        )
+
+
+def reverse_func(apps, schema_editor):
+    EmailTemplate = apps.get_model("helpdesk", "EmailTemplate")
+    db_alias = schema_editor.connection.alias
+    EmailTemplate.objects.using(db_alias).filter(template_name="digest").delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("helpdesk", "0046_email_digests"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, reverse_func),
+    ]
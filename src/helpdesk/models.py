@@ -11,6 +11,7 @@ import datetime
 import mimetypes
 import os
 import re
+import time
 import uuid
 from io import StringIO
 
@@ -18,6 +19,7 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import models
 from django.utils import timezone
@@ -31,7 +33,12 @@ from rest_framework import serializers
 from helpdesk import settings as helpdesk_settings
 
 from .lib import convert_value, daily_time_spent_calculation, format_time_spent
-from .templated_email import send_templated_mail
+from .templated_email import (
+    build_templated_mail,
+    clear_email_template_cache,
+    copy_email_message,
+    send_email_messages,
+)
 from .validators import validate_file_extension
 
 User = get_user_model()
@@ -81,6 +88,34 @@ def get_markdown(text):
     )
 
 
+QUEUE_EMAIL_SLUGS_CACHE_KEY = "helpdesk:queue-email-slugs"
+
+
+class QueueManager(models.Manager):
+    def get_email_slugs(self):
+        """
+        Map the slug of every queue with an e-mail box to its primary key.
+
+        The mapping is used to resolve ticket tracking IDs in the subject of
+        incoming e-mail, and is cached until a queue is saved or deleted.
+        """
+        slugs = cache.get(QUEUE_EMAIL_SLUGS_CACHE_KEY)
+        if slugs is None:
+            slugs = dict(
+                self.filter(email_box_type__isnull=False).values_list("slug", "pk")
+            )
+            cache.set(
+                QUEUE_EMAIL_SLUGS_CACHE_KEY,
+                slugs,
+                helpdesk_settings.HELPDESK_QUEUE_SLUGS_CACHE_TIMEOUT,
+            )
+        return slugs
+
+    def clear_cache(self):
+        """Clear the cached mapping of queue slugs."""
+        cache.delete(QUEUE_EMAIL_SLUGS_CACHE_KEY)
+
+
 class Queue(models.Model):
     """
     A queue is a collection of tickets into what would generally be business
@@ -188,6 +223,18 @@ class Queue(models.Model):
         ),
     )
 
+    email_digest = models.BooleanField(
+        _("Send update notifications as digests"),
+        blank=True,
+        default=False,
+        help_text=_(
+            "Instead of one e-mail per ticket update, collect the updates and "
+            "send everyone a single e-mail summarising them each time the "
+            "send_email_digests command runs. Assignments, resolutions and "
+            "closings are still sent straight away."
+        ),
+    )
+
     email_box_type = models.CharField(
         _("E-Mail Box Type"),
         max_length=5,
@@ -303,6 +350,22 @@ class Queue(models.Model):
         # This is updated by management/commands/get_mail.py.
     )
 
+    email_box_imap_uidvalidity = models.BigIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+        # UIDVALIDITY of the IMAP folder when email_box_imap_last_uid was
+        # recorded. Updated by helpdesk.email when HELPDESK_IMAP_INCREMENTAL_SYNC
+        # is enabled.
+    )
+
+    email_box_imap_last_uid = models.BigIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+        # Highest UID of the IMAP folder already processed.
+    )
+
     socks_proxy_type = models.CharField(
         _("Socks Proxy Type"),
         max_length=8,
@@ -373,6 +436,8 @@ class Queue(models.Model):
         help_text=_("Time to be spent on this Queue in total"), blank=True, null=True
     )
 
+    objects = QueueManager()
+
     def __str__(self):
         return f"{self.title}"
 
@@ -474,6 +539,22 @@ class Queue(models.Model):
                 pass
 
 
+def clear_queue_slugs_cache(sender, instance, update_fields=None, **kwargs):
+    """
+    Clear the cached queue slugs when a queue is deleted, or saved with
+    fields that may change them.
+    """
+    if update_fields is not None and not {"slug", "email_box_type"} & set(
+        update_fields
+    ):
+        return
+    Queue.objects.clear_cache()
+
+
+models.signals.post_save.connect(clear_queue_slugs_cache, sender=Queue)
+models.signals.post_delete.connect(clear_queue_slugs_cache, sender=Queue)
+
+
 def mk_secret():
     return str(uuid.uuid4())
 
@@ -660,12 +741,26 @@ class Ticket(models.Model):
             'assigned_to': (template_name2, context),
         }
 
-        **kwargs are passed to send_templated_mail defined in templated_email.py
+        **kwargs, apart from fail_silently and digest_followup, are passed to
+        build_templated_mail defined in templated_email.py
+
+        Each recipient gets their own e-mail, but the recipients sharing the
+        same template and context get copies of an e-mail rendered once. The
+        e-mails are sent together by send_email_messages(); with fail_silently,
+        an e-mail that is refused does not prevent the others from being sent.
+
+        If digest_followup is given, the recipients who receive the updates of
+        this ticket as a digest (see get_digest_recipients) get no e-mail; the
+        follow-up is recorded for their next digest instead.
 
         returns the set of email addresses the notification was delivered to.
 
         """
+        fail_silently = kwargs.pop("fail_silently", False)
+        digest_followup = kwargs.pop("digest_followup", None)
+        messages = []
         recipients = set()
+        targets = []
 
         if dont_send_to is not None:
             recipients.update(dont_send_to)
@@ -677,14 +772,7 @@ class Ticket(models.Model):
 
         def send(role, recipient):
             if recipient and recipient not in recipients and role in roles:
-                template, context = roles[role]
-                send_templated_mail(
-                    template,
-                    context,
-                    recipient,
-                    sender=self.queue.from_address,
-                    **kwargs,
-                )
+                targets.append((role, recipient))
                 recipients.add(recipient)
 
         send("submitter", self.submitter_email)
@@ -695,8 +783,58 @@ class Ticket(models.Model):
         if self.queue.enable_notifications_on_email_events:
             for cc in self.ticketcc_set.all():
                 send("ticket_cc", cc.email_address)
+
+        digest_recipients = (
+            self.get_digest_recipients([recipient for _, recipient in targets])
+            if digest_followup is not None and targets
+            else set()
+        )
+        digests = []
+        rendered = {}
+        for role, recipient in targets:
+            if recipient in digest_recipients:
+                digests.append(
+                    DigestNotification(
+                        followup=digest_followup, recipient=recipient, role=role
+                    )
+                )
+                continue
+            template, context = roles[role]
+            key = (template, id(context))
+            if key in rendered:
+                msg = rendered[key] and copy_email_message(rendered[key], recipient)
+            else:
+                msg = rendered[key] = build_templated_mail(
+                    template,
+                    context,
+                    recipient,
+                    sender=self.queue.from_address,
+                    **kwargs,
+                )
+            if msg is not None:
+                messages.append(msg)
+        if digests:
+            DigestNotification.objects.bulk_create(digests)
+        if messages:
+            send_email_messages(messages, fail_silently=fail_silently)
         return recipients
 
+    def get_digest_recipients(self, emails):
+        """
+        The addresses among emails that receive the updates of this ticket as
+        a digest: all of them if the queue sends digests, otherwise those of
+        the users who chose to in their settings.
+        """
+        if self.queue.email_digest:
+            return set(emails)
+        return set(
+            User.objects.filter(
+                email__in=emails,
+                is_active=True,
+                usersettings_helpdesk__email_digest=True,
+            ).values_list("email", flat=True)
+        )
+
     def _get_assigned_to(self):
         """Custom property to allow us to easily print 'Unassigned' if a
         ticket has no owner, or the users name if it's assigned. If the user
@@ -1050,6 +1188,7 @@ class FollowUp(models.Model):
         null=True,
         help_text=_("The Message ID of the submitter's email."),
         editable=False,
+        db_index=True,
     )
 
     objects = FollowUpManager()
@@ -1481,6 +1620,10 @@ class EmailTemplate(models.Model):
         verbose_name_plural = _("e-mail templates")
 
 
+models.signals.post_save.connect(clear_email_template_cache, sender=EmailTemplate)
+models.signals.post_delete.connect(clear_email_template_cache, sender=EmailTemplate)
+
+
 class KBCategory(models.Model):
     """
     Lets help users help themselves: the Knowledge Base is a categorised
@@ -1730,6 +1873,10 @@ def use_email_as_submitter_default():
     return get_default_setting("use_email_as_submitter")
 
 
+def email_digest_default():
+    return get_default_setting("email_digest")
+
+
 class UserSettings(models.Model):
     """
     A bunch of user-specific settings that we want to be able to define, such
@@ -1798,6 +1945,16 @@ class UserSettings(models.Model):
         default=use_email_as_submitter_default,
     )
 
+    email_digest = models.BooleanField(
+        verbose_name=_("Receive ticket updates as a digest?"),
+        help_text=_(
+            "Do you want to receive a single e-mail summarising the updates of "
+            "your tickets from time to time, instead of one e-mail per update? "
+            "Assignments, resolutions and closings are still sent straight away."
+        ),
+        default=email_digest_default,
+    )
+
     def __str__(self):
         return f"Preferences for {self.user}"
 
@@ -1822,6 +1979,86 @@ def create_usersettings(sender, instance, created, **kwargs):
 models.signals.post_save.connect(create_usersettings, sender=settings.AUTH_USER_MODEL)
 
 
+IGNORE_EMAIL_CACHE = {}
+
+
+class IgnoreEmailManager(models.Manager):
+    def _build_index(self, queue):
+        """
+        Index the rules that apply to the queue by the kind of pattern.
+
+        Each key maps to the (pk, keep_in_mailbox) of the oldest rule
+        using it, which is the one that used to be tested first.
+        """
+        exact, any_user, any_domain, match_all = {}, {}, {}, None
+        rules = (
+            self.filter(models.Q(queues=queue) | models.Q(queues__isnull=True))
+            .distinct()
+            .order_by("pk")
+            .values_list("pk", "email_address", "keep_in_mailbox")
+        )
+        for pk, email_address, keep_in_mailbox in rules:
+            rule = (pk, keep_in_mailbox)
+            exact.setdefault(email_address, rule)
+            own_parts = email_address.split("@")
+            if len(own_parts) < 2:
+                continue
+            if own_parts[0] == "*" and own_parts[1] == "*":
+                match_all = match_all or rule
+            elif own_parts[0] == "*":
+                any_user.setdefault(own_parts[1], rule)
+            elif own_parts[1] == "*":
+                any_domain.setdefault(own_parts[0], rule)
+        return exact, any_user, any_domain, match_all
+
+    def _get_index(self, queue):
+        """
+        Get the index of the queue's rules, which is kept in memory until an
+        ignored address is changed, or HELPDESK_IGNORE_EMAIL_CACHE_TIMEOUT
+        expires.
+        """
+        cached = IGNORE_EMAIL_CACHE.get(queue.pk)
+        if cached is None or cached[0] < time.monotonic():
+            cached = (
+                time.monotonic()
+                + helpdesk_settings.HELPDESK_IGNORE_EMAIL_CACHE_TIMEOUT,
+                self._build_index(queue),
+            )
+            IGNORE_EMAIL_CACHE[queue.pk] = cached
+        return cached[1]
+
+    def has_rules(self, queue):
+        """Whether any ignored address applies to the queue"""
+        # Every rule is indexed by its exact address
+        return bool(self._get_index(queue)[0])
+
+    def match(self, queue, email):
+        """
+        Find the rule ignoring the e-mail address in the queue, as
+        IgnoreEmail.test() would, without testing every rule.
+
+        Returns the keep_in_mailbox flag of the matching rule, or None if
+        the address is not ignored.
+        """
+        exact, any_user, any_domain, match_all = self._get_index(queue)
+        email_parts = email.split("@")
+        rules = [
+            exact.get(email),
+            any_domain.get(email_parts[0]),
+            match_all,
+        ]
+        if len(email_parts) > 1:
+            rules.append(any_user.get(email_parts[1]))
+        rules = [rule for rule in rules if rule is not None]
+        if not rules:
+            return None
+        return min(rules)[1]
+
+    def clear_cache(self):
+        """Clear the in-memory index of ignored e-mail addresses."""
+        IGNORE_EMAIL_CACHE.clear()
+
+
 class IgnoreEmail(models.Model):
     """
     This model lets us easily ignore e-mails from certain senders when
@@ -1873,6 +2110,8 @@ class IgnoreEmail(models.Model):
         ),
     )
 
+    objects = IgnoreEmailManager()
+
     def __str__(self):
         return f"{self.name}"
 
@@ -1905,10 +2144,13 @@ class IgnoreEmail(models.Model):
 
         own_parts = self.email_address.split("@")
         email_parts = email.split("@")
+        if len(own_parts) < 2:
+            return self.email_address == email
 
         return bool(
             self.email_address == email
             or own_parts[0] == "*"
+            and len(email_parts) > 1
             and own_parts[1] == email_parts[1]
             or own_parts[1] == "*"
             and own_parts[0] == email_parts[0]
@@ -1917,6 +2159,286 @@ class IgnoreEmail(models.Model):
         )
 
 
+def clear_ignore_email_cache(sender, **kwargs):
+    """
+    Clear the index of ignored e-mail addresses when a rule, or the queues it
+    applies to, change. A new queue may reuse the pk of a deleted one.
+    """
+    if sender is Queue and not kwargs.get("created"):
+        return
+    IgnoreEmail.objects.clear_cache()
+
+
+models.signals.post_save.connect(clear_ignore_email_cache, sender=IgnoreEmail)
+models.signals.post_delete.connect(clear_ignore_email_cache, sender=IgnoreEmail)
+models.signals.m2m_changed.connect(
+    clear_ignore_email_cache, sender=IgnoreEmail.queues.through
+)
+models.signals.post_save.connect(clear_ignore_email_cache, sender=Queue)
+
+
+class IngestedEmail(models.Model):
+    """
+    A ledger of the e-mails already turned into tickets or follow-ups, so
+    that an e-mail left on the mail server, eg because deleting it failed or
+    the process died before it could, is not processed a second time.
+    """
+
+    class Meta:
+        verbose_name = _("Ingested e-mail")
+        verbose_name_plural = _("Ingested e-mails")
+        indexes = (
+            models.Index(fields=["queue", "content_hash"]),
+            models.Index(fields=["queue", "message_id"]),
+        )
+
+    queue = models.ForeignKey(
+        Queue,
+        on_delete=models.CASCADE,
+        verbose_name=_("Queue"),
+    )
+
+    message_id = models.CharField(
+        _("E-Mail ID"),
+        max_length=256,
+        blank=True,
+        null=True,
+    )
+
+    content_hash = models.CharField(
+        _("Content hash"),
+        max_length=64,
+        help_text=_("SHA-256 hash of the raw e-mail."),
+    )
+
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.CASCADE,
+        verbose_name=_("Ticket"),
+    )
+
+    date = models.DateTimeField(
+        _("Date"),
+        default=timezone.now,
+        db_index=True,
+    )
+
+    def __str__(self):
+        return f"{self.message_id or self.content_hash}"
+
+
+def quarantine_path(instance, filename):
+    return f"helpdesk/quarantine/{instance.queue.slug}/{filename}"
+
+
+class QuarantinedEmail(models.Model):
+    """
+    Counts the failures to process an incoming e-mail. Once it failed
+    HELPDESK_EMAIL_QUARANTINE_FAILURES times the raw e-mail is stored with it
+    and removed from the mailbox, so that it is not parsed again on every
+    poll. Quarantined e-mails can be re-processed from the admin.
+    """
+
+    class Meta:
+        verbose_name = _("Quarantined e-mail")
+        verbose_name_plural = _("Quarantined e-mails")
+        constraints = (
+            models.UniqueConstraint(
+                fields=["queue", "content_hash"],
+                name="helpdesk_quarantinedemail_unique_hash",
+            ),
+        )
+
+    queue = models.ForeignKey(
+        Queue,
+        on_delete=models.CASCADE,
+        verbose_name=_("Queue"),
+    )
+
+    message_id = models.CharField(
+        _("E-Mail ID"),
+        max_length=256,
+        blank=True,
+        null=True,
+    )
+
+    content_hash = models.CharField(
+        _("Content hash"),
+        max_length=64,
+        help_text=_("SHA-256 hash of the raw e-mail."),
+    )
+
+    failures = models.PositiveIntegerField(
+        _("Failures"),
+        default=0,
+    )
+
+    last_error = models.TextField(
+        _("Last error"),
+        blank=True,
+    )
+
+    file = models.FileField(
+        _("File"),
+        upload_to=quarantine_path,
+        max_length=1000,
+        blank=True,
+        help_text=_("The raw e-mail, once it has been quarantined."),
+    )
+
+    date = models.DateTimeField(
+        _("Last failure"),
+        default=timezone.now,
+    )
+
+    quarantined = models.DateTimeField(
+        _("Quarantined"),
+        blank=True,
+        null=True,
+    )
+
+    def __str__(self):
+        return f"{self.message_id or self.content_hash}"
+
+
+class SeenPOP3Message(models.Model):
+    """
+    A message left on the POP3 server of a queue, eg because its sender is
+    ignored, identified by its UIDL so that it is not downloaded again on
+    every poll.
+    """
+
+    class Meta:
+        verbose_name = _("Seen POP3 message")
+        verbose_name_plural = _("Seen POP3 messages")
+        unique_together = ("queue", "uidl")
+
+    queue = models.ForeignKey(
+        Queue,
+        on_delete=models.CASCADE,
+        verbose_name=_("Queue"),
+    )
+
+    uidl = models.CharField(
+        _("UIDL"),
+        max_length=70,
+        help_text=_("Unique id of the message on the POP3 server."),
+    )
+
+    date = models.DateTimeField(
+        _("Date"),
+        default=timezone.now,
+    )
+
+    def __str__(self):
+        return self.uidl
+
+
+class OutgoingEmail(models.Model):
+    """
+    An e-mail waiting in the outbox, when HELPDESK_EMAIL_OUTBOX is enabled.
+    Notifications are rendered and stored here, in the transaction that
+    sends them, and delivered in the background by helpdesk_mail_worker.
+    E-mails that could not be delivered are retried with an increasing
+    delay, until HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS is reached; they are then
+    kept as failed and can be retried from the admin.
+    """
+
+    class Meta:
+        verbose_name = _("Outgoing e-mail")
+        verbose_name_plural = _("Outgoing e-mails")
+
+    from_email = models.CharField(
+        _("From"),
+        max_length=1000,
+    )
+
+    recipients = models.JSONField(
+        _("Recipients"),
+        default=list,
+    )
+
+    subject = models.CharField(
+        _("Subject"),
+        max_length=1000,
+        blank=True,
+    )
+
+    message = models.BinaryField(
+        _("Message"),
+        help_text=_("The rendered e-mail, as sent to the mail server."),
+    )
+
+    created = models.DateTimeField(
+        _("Created"),
+        default=timezone.now,
+    )
+
+    next_attempt = models.DateTimeField(
+        _("Next attempt"),
+        default=timezone.now,
+        db_index=True,
+    )
+
+    attempts = models.PositiveIntegerField(
+        _("Attempts"),
+        default=0,
+    )
+
+    last_error = models.TextField(
+        _("Last error"),
+        blank=True,
+    )
+
+    failed = models.DateTimeField(
+        _("Failed"),
+        blank=True,
+        null=True,
+        help_text=_("Set once the e-mail is no longer retried."),
+    )
+
+    def __str__(self):
+        return self.subject or f"{self.pk}"
+
+
+class DigestNotification(models.Model):
+    """
+    A ticket update waiting to be included in the next digest e-mail of a
+    recipient, when the queue or the user receives updates as digests. The
+    digests are sent, and these removed, by send_email_digests.
+    """
+
+    class Meta:
+        verbose_name = _("Digest notification")
+        verbose_name_plural = _("Digest notifications")
+
+    followup = models.ForeignKey(
+        FollowUp,
+        on_delete=models.CASCADE,
+        verbose_name=_("Follow-up"),
+    )
+
+    recipient = models.CharField(
+        _("Recipient"),
+        max_length=1000,
+        db_index=True,
+    )
+
+    role = models.CharField(
+        _("Role"),
+        max_length=32,
+        help_text=_("Why the recipient is notified, eg submitter or ticket_cc."),
+    )
+
+    date = models.DateTimeField(
+        _("Date"),
+        default=timezone.now,
+    )
+
+    def __str__(self):
+        return f"{self.recipient}: {self.followup}"
+
+
 class TicketCC(models.Model):
     """
     Often, there are people who wish to follow a ticket who aren't the
@@ -19,6 +19,7 @@ DEFAULT_USER_SETTINGS = {
     "email_on_ticket_assign": True,
     "tickets_per_page": 25,
     "use_email_as_submitter": True,
+    "email_digest": False,
 }
 
 try:
@@ -380,6 +381,37 @@ HELPDESK_MAX_EMAIL_ATTACHMENT_SIZE = getattr(
     settings, "HELPDESK_MAX_EMAIL_ATTACHMENT_SIZE", 512000
 )
 
+# Attachments of incoming emails larger than this size, in bytes, are decoded
+# to a temporary file instead of being held in memory
+HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE = getattr(
+    settings,
+    "HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE",
+    settings.FILE_UPLOAD_MAX_MEMORY_SIZE,
+)
+
+# Only the first characters, up to this many, of the HTML of incoming emails
+# without a plain text part are parsed to extract their text. Set to 0 for no limit
+HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE = getattr(
+    settings, "HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE", 1000000
+)
+
+# Record every processed incoming email, by Message-ID and hash of its raw
+# content, so that an email left on the mail server is not processed twice
+HELPDESK_EMAIL_INGESTION_LEDGER = getattr(
+    settings, "HELPDESK_EMAIL_INGESTION_LEDGER", False
+)
+
+# Number of days the prune_ingested_emails command keeps ledger entries for
+HELPDESK_EMAIL_INGESTION_LEDGER_DAYS = getattr(
+    settings, "HELPDESK_EMAIL_INGESTION_LEDGER_DAYS", 30
+)
+
+# Number of times processing an incoming email may fail before it is moved from
+# the mailbox to the quarantine. Default to '0' to leave failing emails in place
+HELPDESK_EMAIL_QUARANTINE_FAILURES = getattr(
+    settings, "HELPDESK_EMAIL_QUARANTINE_FAILURES", 0
+)
+
 # Send email notifications for internal ticket submitter.
 HELPDESK_NOTIFY_SUBMITTER_FOR_ALL_TICKET_CHANGES = getattr(
     settings,
@@ -483,9 +515,100 @@ HELPDESK_OAUTH = getattr(
     {"token_url": "", "client_id": "", "secret": "", "scope": [""]},
 )
 
+# Seconds before expiry at which a cached OAUTH access token is fetched again
+HELPDESK_OAUTH_TOKEN_EXPIRY_MARGIN = getattr(
+    settings, "HELPDESK_OAUTH_TOKEN_EXPIRY_MARGIN", 300
+)
+
+# Seconds for which the slugs of the queues, used to match ticket tracking IDs
+# in the subject of incoming e-mail, are cached. They are also refreshed
+# whenever a queue is saved or deleted
+HELPDESK_QUEUE_SLUGS_CACHE_TIMEOUT = getattr(
+    settings, "HELPDESK_QUEUE_SLUGS_CACHE_TIMEOUT", 300
+)
+
+# Seconds for which the ignored e-mail addresses of a queue are indexed in
+# memory. The index is also refreshed whenever an ignored address is changed
+HELPDESK_IGNORE_EMAIL_CACHE_TIMEOUT = getattr(
+    settings, "HELPDESK_IGNORE_EMAIL_CACHE_TIMEOUT", 300
+)
+
+# Seconds for which the compiled e-mail templates are kept in memory. They are
+# also recompiled whenever an e-mail template is changed
+HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT = getattr(
+    settings, "HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT", 300
+)
+
+# Store the outgoing e-mails in the database and send them in the background
+# with the helpdesk_mail_worker command, instead of while the request or the
+# mail poll waits for the mail server
+HELPDESK_EMAIL_OUTBOX = getattr(settings, "HELPDESK_EMAIL_OUTBOX", False)
+
+# Attempts to deliver an e-mail of the outbox before giving up on it, and the
+# delay in seconds before the first retry. The delay doubles on every retry
+HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS = getattr(
+    settings, "HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS", 8
+)
+HELPDESK_EMAIL_OUTBOX_RETRY_DELAY = getattr(
+    settings, "HELPDESK_EMAIL_OUTBOX_RETRY_DELAY", 60
+)
+
+# Number of queues polled concurrently by get_email. Default to '1' to poll
+# the queues one after the other
+HELPDESK_EMAIL_POLL_WORKERS = getattr(settings, "HELPDESK_EMAIL_POLL_WORKERS", 1)
+
+# Number of processes parsing incoming emails while tickets are created, one
+# email after the other, in the polling process. Default to '0' to parse emails
+# in the polling process
+HELPDESK_EMAIL_PARSE_WORKERS = getattr(settings, "HELPDESK_EMAIL_PARSE_WORKERS", 0)
+
+# Maximum number of messages read from a local directory or Maildir per poll.
+# Default to '0' for no limit
+HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES = getattr(
+    settings, "HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES", 0
+)
+
+# Seconds after which a Maildir message claimed by a poll that did not finish
+# processing it, eg. because it was killed, is processed again
+HELPDESK_MAILDIR_CLAIM_TIMEOUT = getattr(
+    settings, "HELPDESK_MAILDIR_CLAIM_TIMEOUT", 3600
+)
+
+# Timeout, in seconds, of every network operation on a queue's mail server, so
+# that a hanging mailbox cannot stall polling. Default to 'None' for no timeout
+HELPDESK_EMAIL_POLL_TIMEOUT = getattr(settings, "HELPDESK_EMAIL_POLL_TIMEOUT", None)
+
 # Set Debug Logging Level for IMAP Services. Default to '0' for No Debugging
 HELPDESK_IMAP_DEBUG_LEVEL = getattr(settings, "HELPDESK_IMAP_DEBUG_LEVEL", 0)
 
+# Fetch IMAP messages by UID in batches of up to this many messages per FETCH
+# round trip. Default to '0' to fetch the messages one at a time
+HELPDESK_IMAP_FETCH_BATCH_SIZE = getattr(settings, "HELPDESK_IMAP_FETCH_BATCH_SIZE", 0)
+
+# Upper bound, in bytes, for the messages pulled in a single batched FETCH.
+# A message larger than this is fetched in a batch of its own.
+HELPDESK_IMAP_FETCH_BATCH_MAX_BYTES = getattr(
+    settings, "HELPDESK_IMAP_FETCH_BATCH_MAX_BYTES", 10 * 1024 * 1024
+)
+
+# Only fetch the IMAP messages that arrived since the previous poll, using the
+# UIDVALIDITY and highest processed UID recorded on each queue. Messages left in
+# the mailbox are not processed again. Default to 'False' to scan the whole folder
+HELPDESK_IMAP_INCREMENTAL_SYNC = getattr(
+    settings, "HELPDESK_IMAP_INCREMENTAL_SYNC", False
+)
+
+# Record the UIDL of the POP3 messages left on the server, eg those ignored with
+# 'keep in mailbox', so that they are not downloaded again on every poll.
+# Default to 'False' to download every message on every poll
+HELPDESK_POP3_UIDL_TRACKING = getattr(settings, "HELPDESK_POP3_UIDL_TRACKING", False)
+
+# Upper bound, in bytes, for the POP3 messages retrieved together, according
+# to the sizes the server lists. A message larger than this is retrieved alone
+HELPDESK_POP3_RETR_BATCH_MAX_BYTES = getattr(
+    settings, "HELPDESK_POP3_RETR_BATCH_MAX_BYTES", 10 * 1024 * 1024
+)
+
 #############################################
 # file permissions - Attachment directories #
 #############################################
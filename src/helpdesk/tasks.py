@@ -1,8 +1,27 @@
 from celery import shared_task
 
 from .email import process_email
+from .templated_email import deliver_outbox
+from .update_ticket import send_email_digests
 
 
 @shared_task
 def helpdesk_process_email():
     process_email()
+
+
+# Batches of e-mails sent by a run of helpdesk_send_outbox at most, the next
+# runs send the rest of the outbox
+OUTBOX_TASK_BATCHES = 10
+
+
+@shared_task
+def helpdesk_send_outbox():
+    for __ in range(OUTBOX_TASK_BATCHES):
+        if not any(deliver_outbox()):
+            break
+
+
+@shared_task
+def helpdesk_send_email_digests():
+    send_email_digests()
@@ -1,67 +1,59 @@
 from django.conf import settings
+from django.core.mail import EmailMessage
+from django.utils import timezone
 from django.utils.safestring import mark_safe
+import contextlib
+import copy
+from datetime import timedelta
+import email
+from email.generator import BytesGenerator
+from io import BytesIO
 import logging
 import os
-from smtplib import SMTPException
+from smtplib import SMTPException, SMTPServerDisconnected
+import threading
+import time
 
 
 logger = logging.getLogger("helpdesk")
 
+# The compiled (subject, text, html) templates of each (template name, locale),
+# or None if no EmailTemplate matches, with the time they expire at
+EMAIL_TEMPLATE_CACHE = {}
 
-def send_templated_mail(
-    template_name,
-    context,
-    recipients,
-    sender=None,
-    bcc=None,
-    fail_silently=False,
-    files=None,
-    extra_headers=None,
-):
-    """
-    send_templated_mail() is a wrapper around Django's e-mail routines that
-    allows us to easily send multipart (text/plain & text/html) e-mails using
-    templates that are stored in the database. This lets the admin provide
-    both a text and a HTML template for each message.
-
-    template_name is the slug of the template to use for this message (see
-        models.EmailTemplate)
+# The connection of the current notification_batch() of each thread
+NOTIFICATION_BATCH = threading.local()
 
-    context is a dictionary to be used when rendering the template
+# Seconds for which deliver_outbox() reserves the e-mails it is sending, so
+# that other workers skip them. The reservation of an e-mail is renewed right
+# before it is sent; e-mails of a worker that died are sent again once their
+# reservation expires
+OUTBOX_LEASE = 600
 
-    recipients can be either a string, eg 'a@b.com', or a list of strings.
 
-    sender should contain a string, eg 'My Site <me@z.com>'. If you leave it
-        blank, it'll use settings.DEFAULT_FROM_EMAIL as a fallback.
-
-    bcc is an optional list of addresses that will receive this message as a
-        blind carbon copy.
-
-    fail_silently is passed to Django's mail routine. Set to 'True' to ignore
-        any errors at send time.
-
-    files can be a list of tuples. Each tuple should be a filename to attach,
-        along with the File objects to be read. files can be blank.
-
-    extra_headers is a dictionary of extra email headers, needed to process
-        email replies and keep proper threading.
+def get_email_templates(template_name, locale):
+    """
+    Get the compiled subject, plain text and HTML templates of an e-mail,
+    from the EmailTemplate of the locale or else the one without a locale.
+    Returns None if neither exists.
 
+    The templates are compiled once and kept in memory until an EmailTemplate
+    is changed, or HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT expires.
     """
-    from django.core.mail import EmailMultiAlternatives
     from django.template import engines
 
-    from_string = engines["django"].from_string
-
     from helpdesk.models import EmailTemplate
     from helpdesk.settings import (
-        HELPDESK_EMAIL_FALLBACK_LOCALE,
         HELPDESK_EMAIL_SUBJECT_TEMPLATE,
+        HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT,
     )
 
-    headers = extra_headers or {}
-
-    locale = context["queue"].get("locale") or HELPDESK_EMAIL_FALLBACK_LOCALE
+    key = (template_name.lower(), locale)
+    cached = EMAIL_TEMPLATE_CACHE.get(key)
+    if cached is not None and cached[0] >= time.monotonic():
+        return cached[1]
 
+    from_string = engines["django"].from_string
     try:
         t = EmailTemplate.objects.get(
             template_name__iexact=template_name, locale=locale
@@ -72,33 +64,283 @@ def send_templated_mail(
                 template_name__iexact=template_name, locale__isnull=True
             )
         except EmailTemplate.DoesNotExist:
-            logger.warning('template "%s" does not exist, no mail sent', template_name)
-            return  # just ignore if template doesn't exist
+            t = None
 
-    subject_part = (
-        from_string(HELPDESK_EMAIL_SUBJECT_TEMPLATE % {"subject": t.subject})
-        .render(context)
-        .replace("\n", "")
-        .replace("\r", "")
+    templates = None
+    if t is not None:
+        footer_file = os.path.join("helpdesk", locale, "email_text_footer.txt")
+        email_html_base_file = os.path.join("helpdesk", locale, "email_html_base.html")
+        templates = (
+            from_string(HELPDESK_EMAIL_SUBJECT_TEMPLATE % {"subject": t.subject}),
+            from_string("%s\n\n{%% include '%s' %%}" % (t.plain_text, footer_file)),
+            from_string(
+                "{%% extends '%s' %%}"
+                "{%% block title %%}%s{%% endblock %%}"
+                "{%% block content %%}%s{%% endblock %%}"
+                % (email_html_base_file, t.heading, t.html)
+            ),
+        )
+    EMAIL_TEMPLATE_CACHE[key] = (
+        time.monotonic() + HELPDESK_EMAIL_TEMPLATE_CACHE_TIMEOUT,
+        templates,
     )
+    return templates
+
+
+def clear_email_template_cache(sender=None, **kwargs):
+    """Clear the compiled e-mail templates, eg when an EmailTemplate changes."""
+    EMAIL_TEMPLATE_CACHE.clear()
+
+
+@contextlib.contextmanager
+def notification_batch():
+    """
+    Send all the e-mails of the block through a single connection to the mail
+    server, eg all the notifications of a bulk update, instead of connecting
+    once per e-mail. The connection is opened by the first e-mail and closed
+    at the end of the block. Nested blocks use the connection of the
+    outermost one.
+    """
+    from django.core.mail import get_connection
+
+    if getattr(NOTIFICATION_BATCH, "connection", None) is not None:
+        yield NOTIFICATION_BATCH.connection
+        return
+    connection = NOTIFICATION_BATCH.connection = get_connection()
+    try:
+        yield connection
+    finally:
+        NOTIFICATION_BATCH.connection = None
+        connection.close()
+
+
+class RenderedMIMEMessage(email.message.Message):
+    """A stored MIME message, written out without mangling 'From ' lines"""
+
+    def as_bytes(self, unixfrom=False, linesep="\n"):
+        fp = BytesIO()
+        BytesGenerator(fp, mangle_from_=False).flatten(
+            self, unixfrom=unixfrom, linesep=linesep
+        )
+        return fp.getvalue()
+
+
+class OutboxEmailMessage(EmailMessage):
+    """
+    An e-mail of the outbox, sent exactly as it was rendered when it was
+    queued, to the recipients (including the Bcc ones) it was queued for.
+    """
+
+    def __init__(self, outgoing_email):
+        super().__init__(
+            subject=outgoing_email.subject,
+            from_email=outgoing_email.from_email,
+            to=outgoing_email.recipients,
+        )
+        self.raw_message = bytes(outgoing_email.message)
+
+    def message(self):
+        return email.message_from_bytes(self.raw_message, _class=RenderedMIMEMessage)
+
+
+def enqueue_email_messages(messages):
+    """
+    Store e-mail messages in the outbox, in the current transaction, for
+    deliver_outbox() to send them.
+
+    Returns the number of messages queued.
+    """
+    from helpdesk.models import OutgoingEmail
+
+    queued = OutgoingEmail.objects.bulk_create(
+        OutgoingEmail(
+            from_email=msg.from_email,
+            recipients=msg.recipients(),
+            subject=str(msg.subject)[:1000],
+            message=msg.message().as_bytes(),
+        )
+        for msg in messages
+        if msg.recipients()
+    )
+    return len(queued)
+
+
+def deliver_outbox(batch_size=100):
+    """
+    Send the e-mails of the outbox that are due, at most batch_size of them,
+    through a single connection to the mail server. Several workers can
+    deliver the outbox at once, each e-mail is reserved by the worker that
+    sends it, for OUTBOX_LEASE seconds renewed right before it is sent.
+
+    An e-mail that fails is retried after HELPDESK_EMAIL_OUTBOX_RETRY_DELAY
+    seconds, doubled on every attempt, and marked as failed after
+    HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS attempts.
+
+    Returns the number of e-mails sent and failed.
+    """
+    from django.core.mail import get_connection
+
+    from helpdesk.models import OutgoingEmail
+    from helpdesk.settings import (
+        HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS,
+        HELPDESK_EMAIL_OUTBOX_RETRY_DELAY,
+    )
+
+    now = timezone.now()
+    due = OutgoingEmail.objects.filter(failed__isnull=True, next_attempt__lte=now)
+    lease = now + timedelta(seconds=OUTBOX_LEASE)
+    # Reserve the e-mails by moving their next attempt past the lease; the
+    # update only matches if no other worker reserved them in the meantime
+    claimed = [
+        pk
+        for pk, next_attempt in due.order_by("next_attempt", "pk").values_list(
+            "pk", "next_attempt"
+        )[:batch_size]
+        if due.filter(pk=pk, next_attempt=next_attempt).update(next_attempt=lease)
+    ]
+    if not claimed:
+        return 0, 0
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        for outgoing in OutgoingEmail.objects.filter(pk__in=claimed).order_by("pk"):
+            # Renew the reservation, unless it expired while the previous
+            # e-mails were sent and another worker reserved the e-mail since
+            if not OutgoingEmail.objects.filter(
+                pk=outgoing.pk, next_attempt=lease
+            ).update(next_attempt=timezone.now() + timedelta(seconds=OUTBOX_LEASE)):
+                continue
+            try:
+                # Keep the connection open for the next e-mails
+                connection.open()
+                connection.send_messages([OutboxEmailMessage(outgoing)])
+            except (SMTPException, OSError) as e:
+                connection.close()
+                outgoing.attempts += 1
+                outgoing.last_error = str(e)
+                if outgoing.attempts >= HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS:
+                    outgoing.failed = timezone.now()
+                    logger.error(
+                        "Giving up sending email to %s after %d attempts: %s",
+                        outgoing.recipients,
+                        outgoing.attempts,
+                        e,
+                    )
+                else:
+                    outgoing.next_attempt = timezone.now() + timedelta(
+                        seconds=HELPDESK_EMAIL_OUTBOX_RETRY_DELAY
+                        * 2 ** (outgoing.attempts - 1)
+                    )
+                    logger.warning(
+                        "Failed to send email to %s, retrying at %s: %s",
+                        outgoing.recipients,
+                        outgoing.next_attempt,
+                        e,
+                    )
+                outgoing.save(
+                    update_fields=["attempts", "last_error", "failed", "next_attempt"]
+                )
+                failed += 1
+            else:
+                outgoing.delete()
+                sent += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def send_email_messages(messages, fail_silently=False):
+    """
+    Send e-mail messages one at a time over a single connection, the one of
+    the current notification_batch() if there is one. A message that fails is
+    logged and, with fail_silently, does not prevent the next ones from being
+    sent; after a disconnection only the unsent messages are retried.
+
+    With HELPDESK_EMAIL_OUTBOX, the messages are queued in the outbox instead,
+    and sent in the background by deliver_outbox().
 
-    footer_file = os.path.join("helpdesk", locale, "email_text_footer.txt")
+    Returns the number of messages sent or queued.
+    """
+    from django.core.mail import get_connection
 
-    text_part = from_string(
-        "%s\n\n{%% include '%s' %%}" % (t.plain_text, footer_file)
-    ).render(context)
+    from helpdesk.settings import HELPDESK_EMAIL_OUTBOX
+
+    if HELPDESK_EMAIL_OUTBOX:
+        return enqueue_email_messages(messages)
+
+    connection = getattr(NOTIFICATION_BATCH, "connection", None)
+    batched = connection is not None
+    if not batched:
+        connection = get_connection()
+    sent = 0
+    try:
+        for message in messages:
+            try:
+                try:
+                    # Keep the connection open for the next messages
+                    connection.open()
+                    sent += connection.send_messages([message])
+                except SMTPServerDisconnected:
+                    # The server dropped the connection while it was idle
+                    connection.close()
+                    connection.open()
+                    sent += connection.send_messages([message])
+            except SMTPException as e:
+                logger.exception(
+                    "SMTPException raised while sending email to {}".format(
+                        message.recipients()
+                    )
+                )
+                # Send the next messages on a new connection
+                connection.close()
+                if not fail_silently:
+                    raise e
+    finally:
+        if not batched:
+            connection.close()
+    return sent
+
+
+def build_templated_mail(
+    template_name,
+    context,
+    recipients,
+    sender=None,
+    bcc=None,
+    files=None,
+    extra_headers=None,
+):
+    """
+    Build the e-mail message send_templated_mail() sends, see its arguments.
+    Returns None if the template does not exist.
+    """
+    from django.core.mail import EmailMultiAlternatives
+
+    from helpdesk.settings import HELPDESK_EMAIL_FALLBACK_LOCALE
+
+    headers = extra_headers or {}
+
+    locale = context["queue"].get("locale") or HELPDESK_EMAIL_FALLBACK_LOCALE
+
+    templates = get_email_templates(template_name, locale)
+    if templates is None:
+        logger.warning('template "%s" does not exist, no mail sent', template_name)
+        return None  # just ignore if template doesn't exist
+    subject_template, text_template, html_template = templates
+
+    # Stripped of the empty ticket of the e-mails not about a ticket, eg digests
+    subject_part = (
+        subject_template.render(context).replace("\n", "").replace("\r", "").strip()
+    )
+
+    text_part = text_template.render(context)
 
-    email_html_base_file = os.path.join("helpdesk", locale, "email_html_base.html")
     # keep new lines in html emails
     if "comment" in context:
         context["comment"] = mark_safe(context["comment"].replace("\r\n", "<br>"))
 
-    html_part = from_string(
-        "{%% extends '%s' %%}"
-        "{%% block title %%}%s{%% endblock %%}"
-        "{%% block content %%}%s{%% endblock %%}"
-        % (email_html_base_file, t.heading, t.html)
-    ).render(context)
+    html_part = html_template.render(context)
 
     if isinstance(recipients, str):
         if recipients.find(","):
@@ -123,13 +365,71 @@ def send_templated_mail(
             msg.attach(filename, content)
             filefield.close()
     logger.debug("Sending email to: {!r}".format(recipients))
+    return msg
 
-    try:
-        return msg.send()
-    except SMTPException as e:
-        logger.exception(
-            "SMTPException raised while sending email to {}".format(recipients)
-        )
-        if not fail_silently:
-            raise e
-        return 0
+
+def copy_email_message(msg, recipients):
+    """
+    Copy an e-mail built by build_templated_mail() for other recipients,
+    without rendering its templates and reading its attachments again.
+    """
+    if isinstance(recipients, str):
+        recipients = recipients.split(",")
+    msg = copy.copy(msg)
+    msg.to = list(recipients)
+    return msg
+
+
+def send_templated_mail(
+    template_name,
+    context,
+    recipients,
+    sender=None,
+    bcc=None,
+    fail_silently=False,
+    files=None,
+    extra_headers=None,
+):
+    """
+    send_templated_mail() is a wrapper around Django's e-mail routines that
+    allows us to easily send multipart (text/plain & text/html) e-mails using
+    templates that are stored in the database. This lets the admin provide
+    both a text and a HTML template for each message.
+
+    template_name is the slug of the template to use for this message (see
+        models.EmailTemplate)
+
+    context is a dictionary to be used when rendering the template
+
+    recipients can be either a string, eg 'a@b.com', or a list of strings.
+
+    sender should contain a string, eg 'My Site <me@z.com>'. If you leave it
+        blank, it'll use settings.DEFAULT_FROM_EMAIL as a fallback.
+
+    bcc is an optional list of addresses that will receive this message as a
+        blind carbon copy.
+
+    fail_silently is passed to Django's mail routine. Set to 'True' to ignore
+        any errors at send time.
+
+    files can be a list of tuples. Each tuple should be a filename to attach,
+        along with the File objects to be read. files can be blank.
+
+    extra_headers is a dictionary of extra email headers, needed to process
+        email replies and keep proper threading.
+
+    Inside a notification_batch(), the e-mail is sent through the connection
+    of the batch. With HELPDESK_EMAIL_OUTBOX, it is queued in the outbox.
+    """
+    msg = build_templated_mail(
+        template_name,
+        context,
+        recipients,
+        sender=sender,
+        bcc=bcc,
+        files=files,
+        extra_headers=extra_headers,
+    )
+    if msg is None:
+        return None
+    return send_email_messages([msg], fail_silently=fail_silently)
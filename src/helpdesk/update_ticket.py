@@ -1,3 +1,5 @@
+from itertools import groupby
+
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.utils import timezone
@@ -7,13 +9,19 @@ from helpdesk import settings as helpdesk_settings
 from helpdesk.decorators import (
     is_helpdesk_staff,
 )
-from helpdesk.lib import process_attachments, safe_template_context
+from helpdesk.lib import (
+    process_attachments,
+    queue_template_context,
+    safe_template_context,
+)
 from helpdesk.models import (
+    DigestNotification,
     FollowUp,
     Ticket,
     TicketCC,
 )
 from helpdesk.signals import update_ticket_done
+from helpdesk.templated_email import notification_batch, send_templated_mail
 
 User = get_user_model()
 
@@ -121,6 +129,7 @@ def get_and_set_ticket_status(
     return old_status_str, old_status
 
 
+@notification_batch()
 def process_email_notifications_for_ticket_update(
     public: bool,
     ticket: Ticket,
@@ -138,6 +147,9 @@ def process_email_notifications_for_ticket_update(
         return
 
     template_prefix = get_email_template_prefix(reassigned, follow_up)
+    # Plain updates can wait for the digest of the recipients who want one,
+    # assignments, resolutions and closings are sent straight away
+    digest_followup = follow_up if template_prefix == "updated_" else None
     if helpdesk_settings.HELPDESK_NOTIFY_SUBMITTER_FOR_ALL_TICKET_CHANGES or (
         public
         and (
@@ -154,6 +166,7 @@ def process_email_notifications_for_ticket_update(
                 dont_send_to=messages_sent_to,
                 fail_silently=True,
                 files=files,
+                digest_followup=digest_followup,
             )
         )
     if ticket.assigned_to and (
@@ -169,6 +182,7 @@ def process_email_notifications_for_ticket_update(
                 dont_send_to=messages_sent_to,
                 fail_silently=True,
                 files=files,
+                digest_followup=digest_followup,
             )
         )
 
@@ -178,10 +192,80 @@ def process_email_notifications_for_ticket_update(
             dont_send_to=messages_sent_to,
             fail_silently=True,
             files=files,
+            digest_followup=digest_followup,
         )
     )
 
 
+@notification_batch()
+def send_email_digests() -> int:
+    """
+    Send every recipient of pending digest notifications an e-mail per queue
+    summarising the ticket updates since their previous digest, from the
+    address of the queue and with its "digest" EmailTemplate. The notifications of a digest that could not be sent
+    are kept for the next run.
+
+    Returns the number of digests sent.
+    """
+    pending = DigestNotification.objects.select_related(
+        "followup__ticket__queue", "followup__user"
+    ).order_by(
+        "recipient",
+        "followup__ticket__queue_id",
+        "followup__ticket_id",
+        "followup__date",
+        "pk",
+    )
+    sent = 0
+    for (recipient, queue), notifications in groupby(
+        pending, key=lambda n: (n.recipient, n.followup.ticket.queue)
+    ):
+        notifications = list(notifications)
+        updates = []
+        for ticket, ticket_notifications in groupby(
+            notifications, key=lambda n: n.followup.ticket
+        ):
+            ticket_notifications = list(ticket_notifications)
+            context = safe_template_context(ticket)["ticket"]
+            updates.append(
+                {
+                    "ticket": context,
+                    "url": context["ticket_url"]
+                    if ticket_notifications[0].role == "submitter"
+                    else context["staff_url"],
+                    "followups": [
+                        {
+                            "date": n.followup.date,
+                            "user": n.followup.user.get_full_name()
+                            or n.followup.user.get_username()
+                            if n.followup.user
+                            else "",
+                            "title": n.followup.title,
+                            "comment": n.followup.comment,
+                        }
+                        for n in ticket_notifications
+                    ],
+                }
+            )
+        context = {
+            "queue": queue_template_context(queue),
+            "updates": updates,
+            "count": len(notifications),
+        }
+        if send_templated_mail(
+            "digest",
+            context,
+            recipient,
+            sender=queue.from_address,
+            fail_silently=True,
+        ):
+            DigestNotification.objects.filter(
+                pk__in=[n.pk for n in notifications]
+            ).delete()
+            sent += 1
+    return sent
+
+
 def get_email_template_prefix(reassigned, follow_up: FollowUp) -> str:
     if reassigned:
         return "assigned_"
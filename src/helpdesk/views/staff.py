@@ -104,7 +104,7 @@ from helpdesk.views import abstract_views
 from helpdesk.views.permissions import MustBeStaffMixin
 
 from ..lib import format_time_spent
-from ..templated_email import send_templated_mail
+from ..templated_email import notification_batch, send_templated_mail
 
 if helpdesk_settings.HELPDESK_KB_ENABLED:
     from helpdesk.models import KBItem
@@ -833,91 +833,93 @@ def mass_update(request):
         )
 
     huser = HelpdeskUser(request.user)
-    for t in Ticket.objects.filter(id__in=tickets):
-        if not huser.can_access_queue(t.queue):
-            continue
-
-        if action == "assign" and t.assigned_to != user:
-            t.assigned_to = user
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Assigned to {username} in bulk update").format(
-                    username=user.get_username()
-                ),
-                public=True,
-                user=request.user,
-            )
-        elif action == "unassign" and t.assigned_to is not None:
-            t.assigned_to = None
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Unassigned in bulk update"),
-                public=True,
-                user=request.user,
-            )
-        elif action == "set_kbitem":
-            t.kbitem = kbitem
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("KBItem set in bulk update"),
-                public=False,
-                user=request.user,
-            )
-        elif action == "close" and t.status != Ticket.CLOSED_STATUS:
-            t.status = Ticket.CLOSED_STATUS
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Closed in bulk update"),
-                public=False,
-                user=request.user,
-                new_status=Ticket.CLOSED_STATUS,
-            )
-        elif action == "close_public" and t.status != Ticket.CLOSED_STATUS:
-            t.status = Ticket.CLOSED_STATUS
-            t.save()
-            t.followup_set.create(
-                date=timezone.now(),
-                title=_("Closed in bulk update"),
-                public=True,
-                user=request.user,
-                new_status=Ticket.CLOSED_STATUS,
-            )
-            # Send email to Submitter, Owner, Queue CC
-            context = safe_template_context(t)
-            context.update(
-                resolution=t.resolution, queue=queue_template_context(t.queue)
-            )
+    # One connection to the mail server for all the notifications
+    with notification_batch():
+        for t in Ticket.objects.filter(id__in=tickets):
+            if not huser.can_access_queue(t.queue):
+                continue
 
-            messages_sent_to = set()
-            try:
-                messages_sent_to.add(request.user.email)
-            except AttributeError:
-                pass
+            if action == "assign" and t.assigned_to != user:
+                t.assigned_to = user
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Assigned to {username} in bulk update").format(
+                        username=user.get_username()
+                    ),
+                    public=True,
+                    user=request.user,
+                )
+            elif action == "unassign" and t.assigned_to is not None:
+                t.assigned_to = None
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Unassigned in bulk update"),
+                    public=True,
+                    user=request.user,
+                )
+            elif action == "set_kbitem":
+                t.kbitem = kbitem
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("KBItem set in bulk update"),
+                    public=False,
+                    user=request.user,
+                )
+            elif action == "close" and t.status != Ticket.CLOSED_STATUS:
+                t.status = Ticket.CLOSED_STATUS
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Closed in bulk update"),
+                    public=False,
+                    user=request.user,
+                    new_status=Ticket.CLOSED_STATUS,
+                )
+            elif action == "close_public" and t.status != Ticket.CLOSED_STATUS:
+                t.status = Ticket.CLOSED_STATUS
+                t.save()
+                t.followup_set.create(
+                    date=timezone.now(),
+                    title=_("Closed in bulk update"),
+                    public=True,
+                    user=request.user,
+                    new_status=Ticket.CLOSED_STATUS,
+                )
+                # Send email to Submitter, Owner, Queue CC
+                context = safe_template_context(t)
+                context.update(
+                    resolution=t.resolution, queue=queue_template_context(t.queue)
+                )
 
-            roles = {
-                "submitter": ("closed_submitter", context),
-                "ticket_cc": ("closed_cc", context),
-            }
-            if (
-                t.assigned_to
-                and t.assigned_to.usersettings_helpdesk.email_on_ticket_change
-            ):
-                roles["assigned_to"] = ("closed_owner", context)
-
-            messages_sent_to.update(
-                t.send(
-                    roles,
-                    dont_send_to=messages_sent_to,
-                    fail_silently=True,
+                messages_sent_to = set()
+                try:
+                    messages_sent_to.add(request.user.email)
+                except AttributeError:
+                    pass
+
+                roles = {
+                    "submitter": ("closed_submitter", context),
+                    "ticket_cc": ("closed_cc", context),
+                }
+                if (
+                    t.assigned_to
+                    and t.assigned_to.usersettings_helpdesk.email_on_ticket_change
+                ):
+                    roles["assigned_to"] = ("closed_owner", context)
+
+                messages_sent_to.update(
+                    t.send(
+                        roles,
+                        dont_send_to=messages_sent_to,
+                        fail_silently=True,
+                    )
                 )
-            )
 
-        elif action == "delete":
-            t.delete()
+            elif action == "delete":
+                t.delete()
 
     return HttpResponseRedirect(reverse("helpdesk:list"))
 
@@ -1021,45 +1023,46 @@ def redirect_from_chosen_ticket(
 
     # For other tickets, save the link to the ticket in which they have been merged to
     # and set status to DUPLICATE
-    for ticket in tickets.exclude(id=chosen_ticket.id):
-        ticket.merged_to = chosen_ticket
-        ticket.status = Ticket.DUPLICATE_STATUS
-        ticket.save()
-
-        # Send mail to submitter email and ticket CC to let them
-        # know ticket has been merged
-        context = safe_template_context(ticket)
-        if ticket.submitter_email:
-            send_templated_mail(
-                template_name="merged",
-                context=context,
-                recipients=[ticket.submitter_email],
-                bcc=[
-                    cc.email_address
-                    for cc in ticket.ticketcc_set.select_related("user")
-                ],
-                sender=ticket.queue.from_address,
-                fail_silently=True,
-            )
-
-        # Move all followups and update their title to know they
-        # come from another ticket
-        ticket.followup_set.update(
-            ticket=chosen_ticket,
-            # Next might exceed maximum 200 characters limit
-            title=_("[Merged from #%(id)d] %(title)s")
-            % {"id": ticket.id, "title": ticket.title},
-        )
+    with notification_batch():
+        for ticket in tickets.exclude(id=chosen_ticket.id):
+            ticket.merged_to = chosen_ticket
+            ticket.status = Ticket.DUPLICATE_STATUS
+            ticket.save()
+
+            # Send mail to submitter email and ticket CC to let them
+            # know ticket has been merged
+            context = safe_template_context(ticket)
+            if ticket.submitter_email:
+                send_templated_mail(
+                    template_name="merged",
+                    context=context,
+                    recipients=[ticket.submitter_email],
+                    bcc=[
+                        cc.email_address
+                        for cc in ticket.ticketcc_set.select_related("user")
+                    ],
+                    sender=ticket.queue.from_address,
+                    fail_silently=True,
+                )
 
-        # Add submitter_email, assigned_to email and ticketcc to
-        # chosen ticket if necessary
-        chosen_ticket.add_email_to_ticketcc_if_not_in(email=ticket.submitter_email)
-        if ticket.assigned_to and ticket.assigned_to.email:
-            chosen_ticket.add_email_to_ticketcc_if_not_in(
-                email=ticket.assigned_to.email
+            # Move all followups and update their title to know they
+            # come from another ticket
+            ticket.followup_set.update(
+                ticket=chosen_ticket,
+                # Next might exceed maximum 200 characters limit
+                title=_("[Merged from #%(id)d] %(title)s")
+                % {"id": ticket.id, "title": ticket.title},
             )
-        for ticketcc in ticket.ticketcc_set.all():
-            chosen_ticket.add_email_to_ticketcc_if_not_in(ticketcc=ticketcc)
+
+            # Add submitter_email, assigned_to email and ticketcc to
+            # chosen ticket if necessary
+            chosen_ticket.add_email_to_ticketcc_if_not_in(email=ticket.submitter_email)
+            if ticket.assigned_to and ticket.assigned_to.email:
+                chosen_ticket.add_email_to_ticketcc_if_not_in(
+                    email=ticket.assigned_to.email
+                )
+            for ticketcc in ticket.ticketcc_set.all():
+                chosen_ticket.add_email_to_ticketcc_if_not_in(ticketcc=ticketcc)
     return redirect(chosen_ticket)
 
 
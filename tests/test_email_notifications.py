@@ -1,13 +1,36 @@
 import logging
+from contextlib import nullcontext
+from datetime import timedelta
+from smtplib import SMTPException, SMTPRecipientsRefused, SMTPServerDisconnected
+from unittest import mock
 
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.mail import EmailMessage, get_connection
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
 
 from helpdesk import settings as helpdesk_settings
 from helpdesk.forms import TicketForm
-from helpdesk.models import Queue, Ticket
-from helpdesk.update_ticket import update_ticket
+from helpdesk.lib import safe_template_context
+from helpdesk.models import (
+    DigestNotification,
+    EmailTemplate,
+    OutgoingEmail,
+    Queue,
+    Ticket,
+)
+from helpdesk.tasks import OUTBOX_TASK_BATCHES, helpdesk_send_outbox
+from helpdesk.templated_email import (
+    build_templated_mail,
+    clear_email_template_cache,
+    deliver_outbox,
+    notification_batch,
+    send_email_messages,
+    send_templated_mail,
+)
+from helpdesk.update_ticket import send_email_digests, update_ticket
 from helpdesk.views.staff import get_user_queues
 
 User = get_user_model()
@@ -625,3 +648,402 @@ class TicketEmailNotificationTests(TestCase):
             helpdesk_settings.HELPDESK_PRIVATE_FOLLOWUP_MEANS_NO_EMAILS = (
                 original_setting
             )
+
+
+class TemplatedEmailCacheTests(TestCase):
+    def setUp(self):
+        queue = Queue.objects.create(title="Queue", slug="queue")
+        self.ticket = Ticket.objects.create(title="Cached", queue=queue)
+        self.context = safe_template_context(self.ticket)
+        clear_email_template_cache()
+
+    def test_templates_compiled_once(self):
+        send_templated_mail("newticket_cc", self.context, "cc1@example.com")
+        with self.assertNumQueries(0):
+            send_templated_mail("newticket_cc", self.context, "cc2@example.com")
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, mail.outbox[1].subject)
+
+    def test_cache_cleared_when_template_changes(self):
+        send_templated_mail("newticket_cc", self.context, "cc@example.com")
+        EmailTemplate.objects.filter(template_name="newticket_cc").update(
+            subject="(Changed)"
+        )
+        # update() does not send post_save, the cached template is still used
+        send_templated_mail("newticket_cc", self.context, "cc@example.com")
+        self.assertNotIn("(Changed)", mail.outbox[1].subject)
+
+        for template in EmailTemplate.objects.filter(template_name="newticket_cc"):
+            template.save()
+        send_templated_mail("newticket_cc", self.context, "cc@example.com")
+        self.assertIn("(Changed)", mail.outbox[2].subject)
+
+
+class NotificationBatchTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(
+            title="Queue", slug="queue", updated_ticket_cc="updates@example.com"
+        )
+        self.tickets = [
+            Ticket.objects.create(
+                title=f"Ticket {i}",
+                queue=self.queue,
+                submitter_email=f"submitter{i}@example.com",
+            )
+            for i in range(3)
+        ]
+
+    def send_notifications(self):
+        for ticket in self.tickets:
+            context = safe_template_context(ticket)
+            ticket.send(
+                {
+                    "submitter": ("closed_submitter", context),
+                    "ticket_cc": ("closed_cc", context),
+                },
+                fail_silently=True,
+            )
+
+    def test_batch_shares_one_connection(self):
+        with (
+            mock.patch(
+                "django.core.mail.get_connection", wraps=get_connection
+            ) as mocked_get_connection,
+            notification_batch(),
+        ):
+            self.send_notifications()
+        mocked_get_connection.assert_called_once()
+        self.assertEqual(len(mail.outbox), 6)
+
+    def test_batch_reconnects_when_disconnected(self):
+        connection = mock.Mock()
+        # Disconnected once the first e-mail of the second ticket was sent
+        disconnected = SMTPServerDisconnected()
+        connection.send_messages.side_effect = [1, 1, 1, disconnected, 1, 1, 1]
+        with (
+            mock.patch("django.core.mail.get_connection", return_value=connection),
+            notification_batch(),
+        ):
+            self.send_notifications()
+        # One send_messages() per e-mail, plus the retry of the unsent one only
+        sent = [c.args[0] for c in connection.send_messages.call_args_list]
+        self.assertEqual([len(messages) for messages in sent], [1] * 7)
+        self.assertIs(sent[3][0], sent[4][0])
+        self.assertEqual(
+            sorted(messages[0].to[0] for messages in sent[:3] + sent[4:]),
+            sorted(
+                [f"submitter{i}@example.com" for i in range(3)]
+                + ["updates@example.com"] * 3
+            ),
+        )
+        self.assertEqual(connection.close.call_count, 2)
+
+    def refusing_connection(self):
+        """A mocked SMTP connection refusing the e-mails to bad@example.com"""
+
+        def send_messages(messages):
+            refused = {
+                recipient: (550, b"No such user")
+                for msg in messages
+                for recipient in msg.recipients()
+                if recipient == "bad@example.com"
+            }
+            if refused:
+                raise SMTPRecipientsRefused(refused)
+            return len(messages)
+
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        return connection
+
+    def test_refused_recipient_does_not_stop_the_others(self):
+        messages = [
+            EmailMessage("Subject", "Body", to=[recipient])
+            for recipient in (
+                "good1@example.com",
+                "bad@example.com",
+                "good2@example.com",
+            )
+        ]
+        for batched in (False, True):
+            connection = self.refusing_connection()
+            with (
+                mock.patch("django.core.mail.get_connection", return_value=connection),
+                notification_batch() if batched else nullcontext(),
+                self.assertLogs("helpdesk", logging.ERROR),
+            ):
+                self.assertEqual(send_email_messages(messages, fail_silently=True), 2)
+            self.assertEqual(
+                [c.args[0][0].to for c in connection.send_messages.call_args_list],
+                [["good1@example.com"], ["bad@example.com"], ["good2@example.com"]],
+            )
+
+        connection = self.refusing_connection()
+        with (
+            mock.patch("django.core.mail.get_connection", return_value=connection),
+            self.assertRaises(SMTPRecipientsRefused),
+            self.assertLogs("helpdesk", logging.ERROR),
+        ):
+            send_email_messages(messages)
+        self.assertEqual(connection.send_messages.call_count, 2)
+
+    def test_refused_cc_does_not_stop_the_next_ccs(self):
+        self.queue.enable_notifications_on_email_events = True
+        self.queue.save()
+        ticket = self.tickets[0]
+        for email in ("good1@example.com", "bad@example.com", "good2@example.com"):
+            ticket.ticketcc_set.create(email=email)
+        context = safe_template_context(ticket)
+        connection = self.refusing_connection()
+        with (
+            mock.patch("django.core.mail.get_connection", return_value=connection),
+            self.assertLogs("helpdesk", logging.ERROR),
+        ):
+            ticket.send({"ticket_cc": ("closed_cc", context)}, fail_silently=True)
+        self.assertEqual(
+            [c.args[0][0].to for c in connection.send_messages.call_args_list],
+            [
+                ["updates@example.com"],
+                ["good1@example.com"],
+                ["bad@example.com"],
+                ["good2@example.com"],
+            ],
+        )
+
+    def test_recipients_of_the_same_notification_share_one_rendering(self):
+        self.queue.enable_notifications_on_email_events = True
+        self.queue.save()
+        ticket = self.tickets[0]
+        for i in range(5):
+            ticket.ticketcc_set.create(email=f"cc{i}@example.com")
+        context = safe_template_context(ticket)
+        with mock.patch(
+            "helpdesk.models.build_templated_mail", wraps=build_templated_mail
+        ) as mocked_build:
+            ticket.send(
+                {
+                    "submitter": ("closed_submitter", context),
+                    "ticket_cc": ("closed_cc", context),
+                },
+                fail_silently=True,
+            )
+        # Once for the submitter, once for the queue and the five CCs
+        self.assertEqual(mocked_build.call_count, 2)
+        self.assertEqual(
+            [msg.to for msg in mail.outbox],
+            [["submitter0@example.com"], ["updates@example.com"]]
+            + [[f"cc{i}@example.com"] for i in range(5)],
+        )
+        self.assertEqual(len({msg.subject for msg in mail.outbox[1:]}), 1)
+        self.assertIn("cc4@example.com", mail.outbox[-1].message()["To"])
+
+
+@mock.patch.object(helpdesk_settings, "HELPDESK_EMAIL_OUTBOX", True)
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(title="Queue", slug="queue")
+        self.ticket = Ticket.objects.create(
+            title="Outbox ticket",
+            queue=self.queue,
+            submitter_email="submitter@example.com",
+        )
+
+    def send_notification(self):
+        context = safe_template_context(self.ticket)
+        return send_templated_mail(
+            "closed_submitter",
+            context,
+            recipients="submitter@example.com",
+            bcc=["hidden@example.com"],
+            sender=self.queue.from_address,
+        )
+
+    def test_outbox_queues_then_worker_sends(self):
+        self.assertEqual(self.send_notification(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            OutgoingEmail.objects.get().recipients,
+            ["submitter@example.com", "hidden@example.com"],
+        )
+
+        call_command("helpdesk_mail_worker", "--once", verbosity=0)
+        self.assertFalse(OutgoingEmail.objects.exists())
+        self.assertEqual(len(mail.outbox), 1)
+        sent = mail.outbox[0]
+        self.assertIn("Outbox ticket", sent.subject)
+        self.assertEqual(
+            sent.recipients(), ["submitter@example.com", "hidden@example.com"]
+        )
+        message = sent.message()
+        self.assertIn("Outbox ticket", message["Subject"])
+        self.assertIsNone(message["Bcc"])
+        self.assertIn(b"\r\nContent-Type: text/html", message.as_bytes(linesep="\r\n"))
+
+    @mock.patch.object(helpdesk_settings, "HELPDESK_EMAIL_OUTBOX_MAX_ATTEMPTS", 2)
+    def test_outbox_retries_with_backoff_then_fails(self):
+        self.send_notification()
+        connection = mock.Mock()
+        connection.send_messages.side_effect = SMTPException("Server unavailable")
+        with mock.patch("django.core.mail.get_connection", return_value=connection):
+            self.assertEqual(deliver_outbox(), (0, 1))
+            outgoing = OutgoingEmail.objects.get()
+            self.assertEqual(outgoing.attempts, 1)
+            self.assertEqual(outgoing.last_error, "Server unavailable")
+            self.assertGreater(outgoing.next_attempt, timezone.now())
+            self.assertIsNone(outgoing.failed)
+            # Not due yet
+            self.assertEqual(deliver_outbox(), (0, 0))
+
+            OutgoingEmail.objects.update(next_attempt=timezone.now())
+            self.assertEqual(deliver_outbox(), (0, 1))
+        outgoing.refresh_from_db()
+        self.assertEqual(outgoing.attempts, 2)
+        self.assertIsNotNone(outgoing.failed)
+        # Failed e-mails are no longer retried
+        self.assertEqual(deliver_outbox(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_outbox_skips_emails_reserved_by_another_worker(self):
+        self.send_notification()
+        self.send_notification()
+        __, second = OutgoingEmail.objects.order_by("pk")
+
+        def send_messages(messages):
+            # The reservation expired while the first e-mail was sent, and
+            # another worker reserved the second one
+            OutgoingEmail.objects.filter(pk=second.pk).update(
+                next_attempt=timezone.now() + timedelta(seconds=600)
+            )
+            return 1
+
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        with mock.patch("django.core.mail.get_connection", return_value=connection):
+            self.assertEqual(deliver_outbox(), (1, 0))
+        connection.send_messages.assert_called_once()
+        self.assertEqual(list(OutgoingEmail.objects.all()), [second])
+
+    def test_outbox_task_sends_a_bounded_number_of_batches(self):
+        with mock.patch(
+            "helpdesk.tasks.deliver_outbox", return_value=(100, 0)
+        ) as mocked_deliver:
+            helpdesk_send_outbox()
+        self.assertEqual(mocked_deliver.call_count, OUTBOX_TASK_BATCHES)
+
+
+@mock.patch.object(
+    helpdesk_settings, "HELPDESK_NOTIFY_SUBMITTER_FOR_ALL_TICKET_CHANGES", False
+)
+class EmailDigestTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(title="Queue", slug="queue")
+        self.owner = User.objects.create_user(
+            username="owner", email="owner@example.com", is_staff=True
+        )
+        self.staff = User.objects.create_user(
+            username="staff", email="staff@example.com", is_staff=True
+        )
+        self.ticket = Ticket.objects.create(
+            title="Busy ticket",
+            queue=self.queue,
+            submitter_email="submitter@example.com",
+            assigned_to=self.owner,
+        )
+
+    def test_user_digest_collects_updates(self):
+        self.owner.usersettings_helpdesk.email_digest = True
+        self.owner.usersettings_helpdesk.save()
+        update_ticket(self.staff, self.ticket, comment="First update", public=True)
+        update_ticket(self.staff, self.ticket, comment="Second update", public=True)
+        # The submitter is still notified of each update
+        self.assertEqual(
+            [msg.to for msg in mail.outbox],
+            [["submitter@example.com"], ["submitter@example.com"]],
+        )
+        self.assertEqual(
+            DigestNotification.objects.filter(recipient="owner@example.com").count(),
+            2,
+        )
+
+        mail.outbox.clear()
+        self.assertEqual(send_email_digests(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        digest = mail.outbox[0]
+        self.assertEqual(digest.to, ["owner@example.com"])
+        self.assertEqual(digest.from_email, self.queue.from_address)
+        self.assertIn("2 update(s) on 1 ticket(s)", digest.subject)
+        self.assertIn("First update", digest.body)
+        self.assertIn("Second update", digest.body)
+        self.assertIn(self.ticket.staff_url, digest.body)
+        self.assertFalse(DigestNotification.objects.exists())
+
+    def test_user_digest_per_queue(self):
+        self.owner.usersettings_helpdesk.email_digest = True
+        self.owner.usersettings_helpdesk.save()
+        other_queue = Queue.objects.create(
+            title="Other", slug="other", email_address="other@example.com"
+        )
+        other_ticket = Ticket.objects.create(
+            title="Other ticket", queue=other_queue, assigned_to=self.owner
+        )
+        update_ticket(self.staff, self.ticket, comment="First queue", public=True)
+        update_ticket(self.staff, other_ticket, comment="Other queue", public=True)
+
+        mail.outbox.clear()
+        self.assertEqual(send_email_digests(), 2)
+        digests = {msg.from_email: msg for msg in mail.outbox}
+        self.assertEqual(
+            set(digests), {self.queue.from_address, other_queue.from_address}
+        )
+        self.assertIn("Other queue", digests[other_queue.from_address].body)
+        self.assertNotIn("First queue", digests[other_queue.from_address].body)
+        self.assertTrue(digests[other_queue.from_address].subject.startswith("Other"))
+        self.assertFalse(DigestNotification.objects.exists())
+
+    def test_digest_uses_the_email_template_of_the_queue_locale(self):
+        self.queue.locale = "fr"
+        self.queue.email_digest = True
+        self.queue.save()
+        update_ticket(self.staff, self.ticket, comment="Une mise à jour", public=True)
+        EmailTemplate.objects.filter(template_name="digest", locale="fr").update(
+            subject="Résumé de {{ queue.title }}"
+        )
+        clear_email_template_cache()
+
+        self.assertEqual(send_email_digests(), 2)
+        digest = next(msg for msg in mail.outbox if msg.to == ["submitter@example.com"])
+        self.assertEqual(digest.subject, "Résumé de Queue")
+        self.assertIn("Les tickets suivants ont été mis à jour", digest.body)
+        self.assertIn("Une mise à jour", digest.body)
+        self.assertIn("Les tickets suivants", digest.alternatives[0][0])
+
+    def test_queue_digest_sends_closing_straight_away(self):
+        self.queue.email_digest = True
+        self.queue.save()
+        update_ticket(self.staff, self.ticket, comment="An update", public=True)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            set(DigestNotification.objects.values_list("recipient", "role")),
+            {
+                ("submitter@example.com", "submitter"),
+                ("owner@example.com", "assigned_to"),
+            },
+        )
+
+        update_ticket(
+            self.staff, self.ticket, new_status=Ticket.CLOSED_STATUS, public=True
+        )
+        self.assertEqual(
+            sorted(msg.to[0] for msg in mail.outbox),
+            ["owner@example.com", "submitter@example.com"],
+        )
+        self.assertEqual(DigestNotification.objects.count(), 2)
+
+        mail.outbox.clear()
+        call_command("send_email_digests", verbosity=0)
+        self.assertEqual(len(mail.outbox), 2)
+        submitter_digest = next(
+            msg for msg in mail.outbox if msg.to == ["submitter@example.com"]
+        )
+        self.assertIn(self.ticket.ticket_url, submitter_digest.body)
+        self.assertNotIn(self.ticket.staff_url, submitter_digest.body)
@@ -1,11 +1,23 @@
+import imaplib
 import itertools
+import json
 import logging
+import mailbox
 import os
+import poplib
+import socket
 import sys
+import threading
 import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from email.mime.application import MIMEApplication
 from email.mime.message import MIMEMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
 from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import mock
@@ -13,10 +25,14 @@ from unittest import mock
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.core import mail
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
 from django.core.management import call_command
 from django.shortcuts import get_object_or_404
 from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
 from mock.mock import patch
 from oauthlib.oauth2 import BackendApplicationClient
 
@@ -25,10 +41,14 @@ from helpdesk.email import extract_email_metadata, process_as_attachment
 from helpdesk.exceptions import DeleteIgnoredTicketException, IgnoreTicketException
 from helpdesk.management.commands.get_email import Command
 from helpdesk.models import (
+    QUEUE_EMAIL_SLUGS_CACHE_KEY,
     FollowUp,
     FollowUpAttachment,
     IgnoreEmail,
+    IngestedEmail,
+    QuarantinedEmail,
     Queue,
+    SeenPOP3Message,
     Ticket,
     TicketCC,
 )
@@ -45,6 +65,20 @@ unused_port = "49151"
 fake_time = time.time()
 
 
+def mock_imap_uid(imap_emails):
+    """Mock of imaplib.IMAP4.uid answering UID SEARCH and FETCH from the
+    responses of imap_emails, keyed by UID"""
+
+    def uid(command, *args):
+        if command == "SEARCH":
+            return "OK", (" ".join(imap_emails),)
+        if command == "FETCH":
+            return imap_emails[args[0]]
+        return "OK", [None]
+
+    return mock.Mock(side_effect=uid)
+
+
 class GetEmailCommonTests(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -93,6 +127,235 @@ class GetEmailCommonTests(TestCase):
         )
         self.assertEqual(ticket.description.strip(), "", msg=ticket.description)
 
+    def test_email_as_bytes_with_8bit_body(self):
+        """
+        Tests that raw 8bit messages are decoded with their own charset.
+        """
+        body = "Příliš žluťoučký kůň, see C:\\temp\\new"
+        test_email = (
+            b"From: sender@example.com\r\n"
+            b"To: helpdesk@example.com\r\n"
+            b"Subject: 8bit body\r\n"
+            b"MIME-Version: 1.0\r\n"
+            b'Content-Type: text/plain; charset="iso-8859-2"\r\n'
+            b"Content-Transfer-Encoding: 8bit\r\n"
+            b"\r\n" + body.encode("iso-8859-2") + b"\r\n"
+        )
+        with override_settings(HELPDESK_ALWAYS_SAVE_INCOMING_EMAIL_MESSAGE=True):
+            ticket = helpdesk.email.extract_email_metadata(
+                test_email, self.queue_public, self.logger
+            )
+        self.assertEqual(ticket.description.strip(), body)
+        attachment = FollowUpAttachment.objects.get(followup__ticket=ticket)
+        self.assertEqual(attachment.file.read(), test_email)
+
+    def test_ingestion_ledger_skips_processed_email(self):
+        """
+        Tests that an email still on the mail server after it was processed
+        is not turned into a second ticket.
+        """
+        test_email = (
+            b"From: sender@example.com\r\n"
+            b"To: helpdesk@example.com\r\n"
+            b"Subject: Left on the server\r\n"
+            b"Message-ID: <ledger-1@example.com>\r\n"
+            b"\r\n"
+            b"Deleting me from the mail server failed\r\n"
+        )
+        with mock.patch.object(
+            helpdesk.email.helpdesk_settings, "HELPDESK_EMAIL_INGESTION_LEDGER", True
+        ):
+            ticket = extract_email_metadata(test_email, self.queue_public, self.logger)
+            with self.assertNumQueries(1):
+                again = extract_email_metadata(
+                    test_email, self.queue_public, self.logger
+                )
+            # Relayed with other headers, but the same Message-ID
+            relayed = extract_email_metadata(
+                b"Received: from relay\r\n" + test_email,
+                self.queue_public,
+                self.logger,
+            )
+        self.assertEqual(again, ticket)
+        self.assertEqual(relayed, ticket)
+        self.assertEqual(Ticket.objects.count(), 1)
+        self.assertEqual(FollowUp.objects.filter(ticket=ticket).count(), 1)
+
+        IngestedEmail.objects.update(date=timezone.now() - timedelta(days=31))
+        call_command("prune_ingested_emails", verbosity=0)
+        self.assertFalse(IngestedEmail.objects.exists())
+
+    def test_unused_parsed_attachments_are_removed(self):
+        """
+        Tests that the attachments spooled by a parse worker are removed when
+        the parsed e-mail is not used, and that e-mails in the ingestion
+        ledger are not handed to the parse workers.
+        """
+        message = MIMEMultipart()
+        message["From"] = "sender@example.com"
+        message["Subject"] = "Spooled"
+        message["Message-ID"] = "<spooled@example.com>"
+        message.attach(MIMEText("With an attachment", "plain"))
+        message.attach(MIMEApplication(os.urandom(5000), "pdf", Name="large.pdf"))
+        test_email = message.as_bytes()
+
+        def parse_in_worker():
+            future = Future()
+            future.set_result(
+                helpdesk.email.parse_email_message_in_worker(test_email, self.logger)
+            )
+            path = future.result()["files"][0][0]
+            self.assertTrue(os.path.exists(path))
+            return future, path
+
+        with (
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings,
+                "HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE",
+                1000,
+            ),
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings,
+                "HELPDESK_EMAIL_INGESTION_LEDGER",
+                True,
+            ),
+        ):
+            future, path = parse_in_worker()
+            helpdesk.email.discard_parsed_emails([future])
+            self.assertFalse(os.path.exists(path))
+
+            future, path = parse_in_worker()
+            ticket = extract_email_metadata(
+                test_email, self.queue_public, self.logger, parsed=future
+            )
+            self.assertFalse(os.path.exists(path))
+
+            # Already ingested: not parsed, and the ledger short-circuits
+            future, path = parse_in_worker()
+            again = extract_email_metadata(
+                test_email, self.queue_public, self.logger, parsed=future
+            )
+            self.assertEqual(again, ticket)
+            self.assertFalse(os.path.exists(path))
+
+            executor = mock.Mock()
+            parsed = helpdesk.email.parse_email_messages(
+                {1: test_email, 2: b"Subject: New\r\n\r\nNew e-mail\r\n"},
+                self.logger,
+                executor,
+                queue=self.queue_public,
+            )
+        self.assertEqual(list(parsed), [2])
+        executor.submit.assert_called_once()
+
+    def test_failing_email_is_quarantined(self):
+        """
+        Tests that an email failing on every poll is moved to the quarantine
+        after HELPDESK_EMAIL_QUARANTINE_FAILURES polls, and can be re-processed.
+        """
+        mail_dir = mkdtemp()
+        self.addCleanup(rmtree, mail_dir)
+        queue = Queue.objects.create(
+            title="Local",
+            slug="local",
+            email_box_type="local",
+            email_box_local_dir=mail_dir,
+        )
+        test_email = (
+            b"From: sender@example.com\r\n"
+            b"To: helpdesk@example.com\r\n"
+            b"Subject: Poison\r\n"
+            b"Message-ID: <poison@example.com>\r\n"
+            b"\r\n"
+            b"Crashes the parser\r\n"
+        )
+        path = os.path.join(mail_dir, "poison.eml")
+        with open(path, "wb") as f:
+            f.write(test_email)
+
+        with mock.patch.object(
+            helpdesk.email,
+            "extract_email_metadata",
+            side_effect=ValueError("broken MIME"),
+        ):
+            # Failing emails are left in the mailbox by default
+            helpdesk.email.process_queue(queue, self.logger)
+            self.assertTrue(os.path.exists(path))
+            self.assertFalse(QuarantinedEmail.objects.exists())
+
+        with (
+            mock.patch.object(
+                helpdesk.email,
+                "extract_email_metadata",
+                side_effect=ValueError("broken MIME"),
+            ),
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings,
+                "HELPDESK_EMAIL_QUARANTINE_FAILURES",
+                3,
+            ),
+        ):
+            for _ in range(2):
+                helpdesk.email.process_queue(queue, self.logger)
+            self.assertTrue(os.path.exists(path))
+            entry = QuarantinedEmail.objects.get(queue=queue)
+            self.assertEqual(entry.failures, 2)
+            self.assertIsNone(entry.quarantined)
+
+            helpdesk.email.process_queue(queue, self.logger)
+        self.assertFalse(os.path.exists(path))
+        entry.refresh_from_db()
+        self.assertEqual(entry.failures, 3)
+        self.assertIsNotNone(entry.quarantined)
+        self.assertIn("broken MIME", entry.last_error)
+        with entry.file.open("rb") as f:
+            self.assertEqual(f.read(), test_email)
+
+        admin_user = User.objects.create_superuser(
+            "quarantine-admin", "admin@example.com", "password"
+        )
+        self.client.force_login(admin_user)
+        response = self.client.post(
+            reverse("admin:helpdesk_quarantinedemail_changelist"),
+            {"action": "reprocess", "_selected_action": [entry.pk]},
+            follow=True,
+        )
+        self.assertContains(response, "was processed into ticket")
+        ticket = Ticket.objects.get(queue=queue)
+        self.assertEqual(ticket.title, "Poison")
+        self.assertFalse(QuarantinedEmail.objects.exists())
+
+    def test_reprocessed_email_of_ignored_sender_is_reported(self):
+        """
+        Tests that re-processing a quarantined email whose sender is now
+        ignored is reported as ignored rather than as a failure.
+        """
+        entry = QuarantinedEmail.objects.create(
+            queue=self.queue_public,
+            content_hash="0" * 64,
+            failures=3,
+            quarantined=timezone.now(),
+        )
+        entry.file.save(
+            "ignored.eml",
+            ContentFile(b"From: spam@example.com\r\nSubject: Spam\r\n\r\nBuy\r\n"),
+        )
+        self.addCleanup(entry.file.storage.delete, entry.file.name)
+        IgnoreEmail.objects.create(name="Spam", email_address="spam@example.com")
+
+        admin_user = User.objects.create_superuser(
+            "quarantine-admin", "admin@example.com", "password"
+        )
+        self.client.force_login(admin_user)
+        response = self.client.post(
+            reverse("admin:helpdesk_quarantinedemail_changelist"),
+            {"action": "reprocess", "_selected_action": [entry.pk]},
+            follow=True,
+        )
+        self.assertContains(response, "was ignored")
+        self.assertNotContains(response, "failed again")
+        self.assertFalse(Ticket.objects.filter(title="Spam").exists())
+
     def test_email_with_quoted_printable_body(self):
         """
         Tests that emails with quoted-printable bodies work.
@@ -232,6 +495,43 @@ class GetEmailCommonTests(TestCase):
         with self.assertRaises(IgnoreTicketException):
             extract_email_metadata(message.as_string(), self.queue_public, self.logger)
 
+    def test_ignore_email_index_matches_rules(self):
+        """
+        Tests the index of ignored addresses agrees with IgnoreEmail.test()
+        """
+        other_queue = Queue.objects.create(title="Other", slug="other")
+        rules = [
+            IgnoreEmail.objects.create(name="Exact", email_address="spam@example.com"),
+            IgnoreEmail.objects.create(
+                name="Domain", email_address="*@junk.example", keep_in_mailbox=True
+            ),
+            IgnoreEmail.objects.create(name="User", email_address="postmaster@*"),
+        ]
+        other_rule = IgnoreEmail.objects.create(
+            name="Other queue", email_address="*@*", keep_in_mailbox=True
+        )
+        other_rule.queues.add(other_queue)
+        # the index is built once, then answers without any query
+        IgnoreEmail.objects.match(self.queue_public, "warm@up.example")
+        for address in [
+            "spam@example.com",
+            "ham@example.com",
+            "anyone@junk.example",
+            "postmaster@example.org",
+            "postmaster",
+            "Unknown Sender",
+        ]:
+            expected = next((r.keep_in_mailbox for r in rules if r.test(address)), None)
+            with self.assertNumQueries(0):
+                keep_in_mailbox = IgnoreEmail.objects.match(self.queue_public, address)
+            self.assertEqual(keep_in_mailbox, expected, address)
+        # the oldest of several matching rules wins
+        self.assertFalse(IgnoreEmail.objects.match(other_queue, "spam@example.com"))
+        self.assertTrue(IgnoreEmail.objects.match(other_queue, "ham@example.com"))
+        # changing the queues of a rule clears the index
+        other_rule.queues.add(self.queue_public)
+        self.assertTrue(IgnoreEmail.objects.match(self.queue_public, "ham@example.com"))
+
     def test_utf8_filename_attachment(self):
         """
         Tests if an attachment correctly sent with a UTF8 filename in disposition is extracted correctly
@@ -247,6 +547,283 @@ class GetEmailCommonTests(TestCase):
             f"Filename extracted does not match: {sent_file.name}",
         )
 
+    @mock.patch.object(helpdesk.email, "ATTACHMENT_DECODE_CHUNK_SIZE", 1001)
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE", 1000
+    )
+    def test_large_attachment_is_spooled_to_disk(self):
+        """
+        Tests that attachments above the spool size are decoded to a temporary file
+        """
+        content = os.urandom(100000)
+        part = MIMEApplication(content, Name="large.bin")
+        part["Content-Disposition"] = 'attachment; filename="large.bin"'
+        small_part = MIMEApplication(content[:100], Name="small.bin")
+        files = []
+        process_as_attachment(part, counter=1, files=files, logger=self.logger)
+        process_as_attachment(small_part, counter=2, files=files, logger=self.logger)
+        spooled, in_memory = files
+        self.assertIsInstance(spooled, TemporaryUploadedFile)
+        self.assertEqual(spooled.size, len(content))
+        self.assertEqual(spooled.read(), content)
+        self.assertIsInstance(in_memory, SimpleUploadedFile)
+        self.assertEqual(in_memory.read(), content[:100])
+        temporary_file_path = spooled.temporary_file_path()
+        spooled.close()
+        self.assertFalse(os.path.exists(temporary_file_path))
+
+    def test_emails_parsed_by_parse_workers(self):
+        """
+        Tests that emails parsed by parse worker processes create their tickets
+        in arrival order, with their spooled attachments, and that a reply is
+        threaded into the ticket created just before it.
+        """
+        mail_dir = mkdtemp()
+        self.addCleanup(rmtree, mail_dir)
+        queue = Queue.objects.create(
+            title="Local",
+            slug="local",
+            email_box_type="local",
+            email_box_local_dir=mail_dir,
+        )
+        content = os.urandom(5000)
+        first = MIMEMultipart()
+        first["From"] = "sender@example.com"
+        first["Subject"] = "First"
+        first["Message-ID"] = "<first@example.com>"
+        first.attach(MIMEText("With an attachment", "plain"))
+        attachment = MIMEApplication(content, "pdf", Name="large.pdf")
+        attachment["Content-Disposition"] = 'attachment; filename="large.pdf"'
+        first.attach(attachment)
+        reply = MIMEText("A reply", "plain")
+        reply["From"] = "sender@example.com"
+        reply["Subject"] = "Re: First"
+        reply["In-Reply-To"] = "<first@example.com>"
+        for name, message in (("1.eml", first), ("2.eml", reply)):
+            with open(os.path.join(mail_dir, name), "wb") as f:
+                f.write(message.as_bytes())
+
+        helpdesk.email.reset_parse_executor()
+        self.addCleanup(helpdesk.email.reset_parse_executor)
+        with (
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings, "HELPDESK_EMAIL_PARSE_WORKERS", 2
+            ),
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings,
+                "HELPDESK_EMAIL_ATTACHMENT_SPOOL_SIZE",
+                1000,
+            ),
+            # The directory scan order is arbitrary, the reply must come second
+            mock.patch.object(
+                helpdesk.email,
+                "iter_local_messages",
+                return_value=iter(
+                    [os.path.join(mail_dir, "1.eml"), os.path.join(mail_dir, "2.eml")]
+                ),
+            ),
+        ):
+            helpdesk.email.process_queue(queue, self.logger)
+        self.assertIsNotNone(helpdesk.email.PARSE_EXECUTOR)
+
+        self.assertEqual(os.listdir(mail_dir), [])
+        ticket = Ticket.objects.get(queue=queue)
+        self.assertEqual(ticket.title, "First")
+        self.assertEqual(
+            list(ticket.followup_set.values_list("comment", flat=True)),
+            ["With an attachment", "A reply"],
+        )
+        attachment = FollowUpAttachment.objects.get(followup__ticket=ticket)
+        self.assertEqual(attachment.file.read(), content)
+
+    def test_local_maildir(self):
+        """
+        Tests that the messages of a local Maildir are claimed from new and
+        removed once processed, that kept ignored messages are left in cur
+        flagged as seen, and that HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES caps a poll.
+        """
+        mail_dir = mkdtemp()
+        self.addCleanup(rmtree, mail_dir)
+        for sub in ("new", "cur", "tmp"):
+            os.mkdir(os.path.join(mail_dir, sub))
+        queue = Queue.objects.create(
+            title="Maildir",
+            slug="maildir",
+            email_box_type="local",
+            email_box_local_dir=mail_dir,
+        )
+        IgnoreEmail.objects.create(
+            name="Kept", email_address="kept@example.com", keep_in_mailbox=True
+        )
+        for i, sender in enumerate(
+            ("one@example.com", "kept@example.com", "two@example.com")
+        ):
+            message = MIMEText(f"Message {i}", "plain")
+            message["From"] = sender
+            message["Subject"] = f"Message {i}"
+            with open(os.path.join(mail_dir, "new", f"{i}.host"), "wb") as f:
+                f.write(message.as_bytes())
+
+        with mock.patch.object(
+            helpdesk.email.helpdesk_settings, "HELPDESK_LOCAL_MAILBOX_MAX_MESSAGES", 2
+        ):
+            helpdesk.email.process_queue(queue, self.logger)
+        self.assertEqual(len(os.listdir(os.path.join(mail_dir, "new"))), 1)
+
+        helpdesk.email.process_queue(queue, self.logger)
+        self.assertEqual(os.listdir(os.path.join(mail_dir, "new")), [])
+        self.assertEqual(os.listdir(os.path.join(mail_dir, "cur")), ["1.host:2,S"])
+        self.assertEqual(
+            sorted(Ticket.objects.filter(queue=queue).values_list("title", flat=True)),
+            ["Message 0", "Message 2"],
+        )
+
+    def test_maildir_message_claimed_once(self):
+        """
+        Tests that a Maildir message already claimed by another poller is skipped
+        """
+        mail_dir = mkdtemp()
+        self.addCleanup(rmtree, mail_dir)
+        for sub in ("new", "cur", "tmp"):
+            os.mkdir(os.path.join(mail_dir, sub))
+        path = os.path.join(mail_dir, "new", "1.host")
+        with open(path, "wb") as f:
+            f.write(b"Subject: Claimed\n\nBody")
+
+        claimed = helpdesk.email.claim_maildir_message(path)
+        self.assertEqual(claimed, os.path.join(mail_dir, "cur", "1.host:2,"))
+        self.assertIsNone(helpdesk.email.claim_maildir_message(path))
+        helpdesk.email.release_maildir_message(claimed, keep=False)
+        self.assertEqual(os.listdir(os.path.join(mail_dir, "new")), ["1.host"])
+
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_EMAIL_QUARANTINE_FAILURES", 3
+    )
+    def test_failed_maildir_message_released_after_scan(self):
+        """
+        Tests that a failing Maildir message is put back in new only once the
+        scan is over, so that it is not picked up again by the same poll
+        """
+        mail_dir = mkdtemp()
+        self.addCleanup(rmtree, mail_dir)
+        for sub in ("new", "cur", "tmp"):
+            os.mkdir(os.path.join(mail_dir, sub))
+        queue = Queue.objects.create(
+            title="Maildir",
+            slug="maildir",
+            email_box_type="local",
+            email_box_local_dir=mail_dir,
+        )
+        with open(os.path.join(mail_dir, "new", "1.host"), "wb") as f:
+            f.write(b"From: sender@example.com\nSubject: Poison\n\nBody")
+
+        def live_scan(path):
+            # A directory scan that lists the files added while it runs
+            for _ in range(3):
+                names = sorted(os.listdir(path))
+                if not names:
+                    return
+                yield os.path.join(path, names[0])
+
+        with (
+            mock.patch.object(
+                helpdesk.email, "iter_local_messages", side_effect=live_scan
+            ),
+            mock.patch.object(
+                helpdesk.email,
+                "extract_email_metadata",
+                side_effect=ValueError("broken MIME"),
+            ) as mocked_extract,
+        ):
+            helpdesk.email.process_queue(queue, self.logger)
+        mocked_extract.assert_called_once()
+        self.assertEqual(QuarantinedEmail.objects.get(queue=queue).failures, 1)
+        self.assertEqual(os.listdir(os.path.join(mail_dir, "new")), ["1.host"])
+
+    def test_orphaned_maildir_claim_is_recovered(self):
+        """
+        Tests that a message claimed by a poll that was killed before
+        releasing it is processed by a later poll, once the claim is stale
+        """
+        mail_dir = mkdtemp()
+        self.addCleanup(rmtree, mail_dir)
+        for sub in ("new", "cur", "tmp"):
+            os.mkdir(os.path.join(mail_dir, sub))
+        queue = Queue.objects.create(
+            title="Maildir",
+            slug="maildir",
+            email_box_type="local",
+            email_box_local_dir=mail_dir,
+            allow_email_submission=True,
+        )
+        cur = os.path.join(mail_dir, "cur")
+        for name in ("1.host:2,", "2.host:2,S", "3.host:2,"):
+            with open(os.path.join(cur, name), "wb") as f:
+                f.write(f"From: sender@example.com\nSubject: {name}\n\nBody".encode())
+        # 1 and 2 were claimed two hours ago, 3 is being processed
+        stale = time.time() - 7200
+        os.utime(os.path.join(cur, "1.host:2,"), (stale, stale))
+        os.utime(os.path.join(cur, "2.host:2,S"), (stale, stale))
+
+        helpdesk.email.process_queue(queue, self.logger)
+        self.assertEqual(Ticket.objects.get(queue=queue).title, "1.host:2,")
+        self.assertEqual(sorted(os.listdir(cur)), ["2.host:2,S", "3.host:2,"])
+        self.assertEqual(os.listdir(os.path.join(mail_dir, "new")), [])
+
+    def test_import_mailbox_command(self):
+        """
+        Tests that the e-mails of an mbox are imported in order without sending
+        notifications, and that running the import again skips them.
+        """
+        mbox_dir = mkdtemp()
+        self.addCleanup(rmtree, mbox_dir)
+        path = os.path.join(mbox_dir, "history.mbox")
+        first = MIMEText("First message", "plain")
+        first["From"] = "sender@example.com"
+        first["Subject"] = "History"
+        first["Message-ID"] = "<history-1@example.com>"
+        first["Date"] = "Mon, 03 Feb 2020 10:00:00 +0100"
+        reply = MIMEText("The reply", "plain")
+        reply["From"] = "sender@example.com"
+        reply["Subject"] = "Re: History"
+        reply["In-Reply-To"] = "<history-1@example.com>"
+        reply["Date"] = "Tue, 04 Feb 2020 09:30:00 +0000"
+        other = MIMEText("Another thread", "plain")
+        other["From"] = "other@example.com"
+        other["Subject"] = "Other"
+        box = mailbox.mbox(path)
+        for message in (first, reply, other, first):
+            box.add(message)
+        box.close()
+
+        out = StringIO()
+        call_command(
+            "helpdesk_import_mailbox", "test", path, workers=0, batch_size=2, stdout=out
+        )
+        self.assertIn("4/4 e-mails: 3 imported, 1 skipped", out.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
+        history, other_ticket = Ticket.objects.filter(queue=self.queue_public).order_by(
+            "id"
+        )
+        self.assertEqual(history.title, "History")
+        self.assertEqual(history.followup_set.count(), 2)
+        self.assertEqual(other_ticket.title, "Other")
+        # The history keeps the dates of the e-mails, now if they have none
+        opened = datetime(2020, 2, 3, 9, tzinfo=dt_timezone.utc)
+        replied = datetime(2020, 2, 4, 9, 30, tzinfo=dt_timezone.utc)
+        self.assertEqual(history.created, opened)
+        self.assertEqual(history.modified, replied)
+        self.assertEqual(
+            list(history.followup_set.values_list("date", flat=True)),
+            [opened, replied],
+        )
+        self.assertGreater(other_ticket.created, replied)
+
+        out = StringIO()
+        call_command("helpdesk_import_mailbox", "test", path, workers=1, stdout=out)
+        self.assertIn("4/4 e-mails: 0 imported, 4 skipped", out.getvalue())
+        self.assertEqual(FollowUp.objects.count(), 3)
+
     def test_wrong_extension_attachment(self):
         """
         Tests if an attachment with a wrong extension doesn't stop the email process
@@ -546,11 +1123,8 @@ class GetEmailCommonTests(TestCase):
             "Email attachment file not found in ticket attachment for empty body.",
         )
 
-    @patch("helpdesk.email.get_ticket_id_from_subject_slug")
     @patch("helpdesk.email.create_object_from_email_message")
-    def test_ticket_id_lookup_across_queues(
-        self, mock_create_object, mock_get_ticket_id
-    ):
+    def test_ticket_id_lookup_across_queues(self, mock_create_object):
         """
         Tests the logic for finding a ticket ID:
         1. Not found in the current queue.
@@ -561,81 +1135,71 @@ class GetEmailCommonTests(TestCase):
         queue_other1 = Queue.objects.create(
             title="Other Queue 1", slug="other1", email_box_type="local"
         )
-        queue_other2 = Queue.objects.create(
+        Queue.objects.create(
             title="Other Queue 2", slug="other2", email_box_type="local"
         )
 
         # Scenario 1: Ticket ID not found in current queue, then found in another queue
-        mock_get_ticket_id.side_effect = [
-            None,  # Not found in self.queue_public
-            123,  # Found in queue_other1
-        ]
-
-        # We need to mock Queue.objects.exclude().filter() to return our specific other queues
-        with patch("helpdesk.models.Queue.objects") as mock_queue_objects:
-            mock_queue_objects.exclude.return_value.filter.return_value = [
-                queue_other1,
-                queue_other2,
-            ]
-
-            message, _, _ = utils.generate_email_with_subject(
-                subject="[other1-123] Test Subject"
-            )
-            ticket = extract_email_metadata(
-                message.as_string(), self.queue_public, self.logger
-            )
-
-            # Assert get_ticket_id_from_subject_slug was called for current and then other1
-            mock_get_ticket_id.assert_has_calls(
-                [
-                    mock.call(self.queue_public.slug, mock.ANY, self.logger),
-                    mock.call(queue_other1.slug, mock.ANY, self.logger),
-                ]
-            )
+        message, _, _ = utils.generate_email_with_subject(
+            subject="Re: [unknown-7] [other1-123] Test Subject"
+        )
+        extract_email_metadata(message.as_string(), self.queue_public, self.logger)
 
-            # Assert that create_object_from_email_message was called with the ticket ID and the other queue
-            mock_create_object.assert_called_once()
-            args, _kwargs = mock_create_object.call_args
-            self.assertEqual(args[1], 123)  # ticket_id
-            self.assertEqual(args[2]["queue"], queue_other1)  # payload
+        # Assert that create_object_from_email_message was called with the ticket ID and the other queue
+        mock_create_object.assert_called_once()
+        args, _kwargs = mock_create_object.call_args
+        self.assertEqual(args[1], 123)  # ticket_id
+        self.assertEqual(args[2]["queue"], queue_other1)  # payload
 
-        mock_get_ticket_id.reset_mock()
         mock_create_object.reset_mock()
 
         # Scenario 2: Ticket ID not found in any queue, leading to a new ticket in the original queue
-        mock_get_ticket_id.side_effect = [
-            None,  # Not found in self.queue_public
-            None,  # Not found in queue_other1
-            None,  # Not found in queue_other2
-        ]
+        message, _, _ = utils.generate_email_with_subject(
+            subject="[nonexistent-456] New Ticket Subject"
+        )
+        extract_email_metadata(message.as_string(), self.queue_public, self.logger)
 
-        with patch("helpdesk.models.Queue.objects") as mock_queue_objects:
-            mock_queue_objects.exclude.return_value.filter.return_value = [
-                queue_other1,
-                queue_other2,
-            ]
+        # Assert that create_object_from_email_message was called with None ticket_id and the original queue
+        mock_create_object.assert_called_once()
+        args, _kwargs = mock_create_object.call_args
+        self.assertIsNone(args[1])
+        self.assertEqual(args[2]["queue"], self.queue_public)
 
-            message, _, _ = utils.generate_email_with_subject(
-                subject="[nonexistent-456] New Ticket Subject"
-            )
-            ticket = extract_email_metadata(  # noqa
-                message.as_string(), self.queue_public, self.logger
-            )
+    def test_ticket_id_lookup_prefers_current_queue(self):
+        Queue.objects.create(title="Other", slug="other", email_box_type="local")
+        queue, ticket_id = helpdesk.email.get_ticket_id_from_subject(
+            self.queue_public, "Fwd: [other-5] Re: [test-42] Subject", self.logger
+        )
+        self.assertEqual((queue, ticket_id), (self.queue_public, 42))
 
-            # Assert get_ticket_id_from_subject_slug was called for all queues
-            mock_get_ticket_id.assert_has_calls(
-                [
-                    mock.call(self.queue_public.slug, mock.ANY, self.logger),
-                    mock.call(queue_other1.slug, mock.ANY, self.logger),
-                    mock.call(queue_other2.slug, mock.ANY, self.logger),
-                ]
+    def test_ticket_id_lookup_queue_slugs_are_cached(self):
+        subject = "Re: [sales-team-9] Subject"
+        queue, ticket_id = helpdesk.email.get_ticket_id_from_subject(
+            self.queue_public, subject, self.logger
+        )
+        self.assertIsNone(ticket_id)
+        # a new queue clears the cached slugs
+        sales = Queue.objects.create(
+            title="Sales", slug="sales-team", email_box_type="imap"
+        )
+        queue, ticket_id = helpdesk.email.get_ticket_id_from_subject(
+            self.queue_public, subject, self.logger
+        )
+        self.assertEqual((queue, ticket_id), (sales, 9))
+        # only the queue is read once the slugs are cached
+        with self.assertNumQueries(1):
+            helpdesk.email.get_ticket_id_from_subject(
+                self.queue_public, subject, self.logger
             )
-
-            # Assert that create_object_from_email_message was called with None ticket_id and the original queue
-            mock_create_object.assert_called_once()
-            args, _kwargs = mock_create_object.call_args
-            self.assertIsNone(args[1])
-            self.assertEqual(args[2]["queue"], self.queue_public)
+        # polling a queue does not clear the cached slugs
+        sales.email_box_last_check = timezone.now()
+        sales.save(update_fields=["email_box_last_check"])
+        self.assertIsNotNone(cache.get(QUEUE_EMAIL_SLUGS_CACHE_KEY))
+        sales.delete()
+        queue, ticket_id = helpdesk.email.get_ticket_id_from_subject(
+            self.queue_public, subject, self.logger
+        )
+        self.assertIsNone(ticket_id)
 
 
 class EmailTaskTests(TestCase):
@@ -692,6 +1256,704 @@ class EmailTaskTests(TestCase):
             "Incorrect number of queues that did not get processed due to a forced exception.",
         )
 
+    @patch("helpdesk.email.connections")
+    @patch("helpdesk.email.poll_queue")
+    def test_get_email_with_workers(self, mocked_poll_queue, mocked_connections):
+        """Test queues are polled concurrently by the worker pool"""
+        threads = {}
+
+        def poll(q, quiet=False, debug_to_stdout=False):
+            threads[q.id] = threading.current_thread().name
+            if q.id == self.q_ids[1]:
+                raise OSError("Error Q2")
+
+        mocked_poll_queue.side_effect = poll
+        call_command("get_email", "--workers", "3")
+        self.assertEqual(sorted(threads), sorted(self.q_ids))
+        for name in threads.values():
+            self.assertTrue(name.startswith("helpdesk-get-email"))
+        # every worker releases its own database connections
+        self.assertEqual(mocked_connections.close_all.call_count, self.num_queues)
+
+    @patch("helpdesk.email.imaplib")
+    def test_mail_server_connection_timeout(self, mocked_imaplib):
+        """Test the poll timeout is passed to the mail server connection"""
+        q = Queue.objects.get(id=self.q_ids[0])
+        q.email_box_host = "imap.example.com"
+        q.email_box_ssl = True
+        with mock.patch.object(
+            helpdesk.email.helpdesk_settings, "HELPDESK_EMAIL_POLL_TIMEOUT", 10
+        ):
+            helpdesk.email.connect_to_mail_server(q, self.logger, "imap")
+        mocked_imaplib.IMAP4_SSL.assert_called_once_with(
+            "imap.example.com", 993, timeout=10
+        )
+
+
+class GetEmailImapBatchTests(TestCase):
+    """Checks the UID based batched FETCH mode of the IMAP sync."""
+
+    def setUp(self):
+        self.queue_public = Queue.objects.create(
+            title="Batch Queue",
+            slug="batch",
+            email_box_type="imap",
+            allow_email_submission=True,
+        )
+        self.logger = logging.getLogger("helpdesk")
+        self.messages = {}
+        for uid in (3, 4, 5, 9):
+            message, _, _ = utils.generate_email_with_subject(
+                subject=f"Batched message {uid}"
+            )
+            self.messages[uid] = message.as_bytes()
+        self.uidvalidity = b"1000"
+
+    def mocked_server(self):
+        def uid(command, *args):
+            if command == "SEARCH":
+                return "OK", [b" ".join(str(u).encode() for u in self.messages)]
+            if command == "FETCH" and args[1] == "(RFC822.SIZE)":
+                return "OK", [
+                    f"{i} (UID {u} RFC822.SIZE {len(m)})".encode()
+                    for i, (u, m) in enumerate(self.messages.items(), 1)
+                ]
+            if command == "FETCH":
+                uids = []
+                for part in args[0].split(","):
+                    first, _, last = part.partition(":")
+                    uids += range(int(first), int(last or first) + 1)
+                data = []
+                for uid in uids:
+                    if uid in self.messages:
+                        data.append(
+                            (f"1 (UID {uid} RFC822 {{0}}".encode(), self.messages[uid])
+                        )
+                        data.append(b")")
+                return "OK", data
+            return "OK", [None]
+
+        server = mock.Mock()
+        server.uid = mock.Mock(side_effect=uid)
+        server.response.return_value = ("UIDVALIDITY", [self.uidvalidity])
+        return server
+
+    def test_message_set(self):
+        self.assertEqual(
+            helpdesk.email.imap_message_set([7, 1, 2, 3, 9, 10]), "1:3,7,9:10"
+        )
+        self.assertEqual(helpdesk.email.imap_message_set([b"4"]), "4")
+
+    def test_message_batches_respect_count_and_size(self):
+        batches = list(
+            helpdesk.email.message_batches(
+                [(1, 10), (2, 10), (3, 10), (4, 100), (5, 10)], 2, 50
+            )
+        )
+        self.assertEqual(batches, [[1, 2], [3], [4], [5]])
+
+    def test_parse_fetch_response_with_trailing_uid(self):
+        data = [
+            (b"1 (RFC822 {3}", b"abc"),
+            b" UID 12)",
+            (b"2 (UID 13 RFC822 {3}", b"def"),
+            b")",
+        ]
+        self.assertEqual(
+            helpdesk.email.imap_parse_fetch_response(data), {12: b"abc", 13: b"def"}
+        )
+
+    def test_imap_sync_fetches_in_batches(self):
+        server = self.mocked_server()
+        with mock.patch.object(
+            helpdesk.email.helpdesk_settings, "HELPDESK_IMAP_FETCH_BATCH_SIZE", 3
+        ):
+            helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+
+        self.assertEqual(Ticket.objects.count(), 4)
+        calls = [c.args for c in server.uid.call_args_list]
+        self.assertEqual(
+            calls,
+            [
+                ("SEARCH", "NOT", "DELETED"),
+                ("FETCH", "3:5,9", "(RFC822.SIZE)"),
+                ("FETCH", "3:5", "(RFC822)"),
+                ("STORE", "3:5", "+FLAGS", "(\\Deleted)"),
+                ("FETCH", "9", "(RFC822)"),
+                ("STORE", "9", "+FLAGS", "(\\Deleted)"),
+            ],
+        )
+        server.fetch.assert_not_called()
+        server.expunge.assert_called_once()
+
+    def test_oauth_sync_flags_messages_once(self):
+        server = self.mocked_server()
+        with mock.patch.object(helpdesk.email, "imap_oauth_login"):
+            helpdesk.email.imap_oauth_sync(self.queue_public, self.logger, server)
+
+        self.assertEqual(Ticket.objects.count(), 4)
+        calls = [c.args for c in server.uid.call_args_list]
+        self.assertEqual(
+            calls,
+            [
+                ("SEARCH", "NOT", "DELETED"),
+                ("FETCH", "3", "(RFC822)"),
+                ("FETCH", "4", "(RFC822)"),
+                ("FETCH", "5", "(RFC822)"),
+                ("FETCH", "9", "(RFC822)"),
+                ("STORE", "3:5,9", "+FLAGS", "(\\Deleted)"),
+            ],
+        )
+        server.store.assert_not_called()
+        server.expunge.assert_called_once()
+
+    def test_imap_sync_batch_leaves_ignored_messages(self):
+        IgnoreEmail.objects.create(
+            name="Keep", email_address="*@*", keep_in_mailbox=True
+        )
+        server = self.mocked_server()
+        with mock.patch.object(
+            helpdesk.email.helpdesk_settings, "HELPDESK_IMAP_FETCH_BATCH_SIZE", 10
+        ):
+            helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+
+        self.assertEqual(Ticket.objects.count(), 0)
+        self.assertNotIn("STORE", [c.args[0] for c in server.uid.call_args_list])
+
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_IMAP_INCREMENTAL_SYNC", True
+    )
+    def test_incremental_sync_only_fetches_new_uids(self):
+        IgnoreEmail.objects.create(
+            name="Keep", email_address="*@*", keep_in_mailbox=True
+        )
+        server = self.mocked_server()
+        helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+        self.assertEqual(
+            server.uid.call_args_list[0].args, ("SEARCH", "NOT", "DELETED")
+        )
+        self.queue_public.refresh_from_db()
+        self.assertEqual(self.queue_public.email_box_imap_uidvalidity, 1000)
+        self.assertEqual(self.queue_public.email_box_imap_last_uid, 9)
+
+        # the ignored messages are still in the folder, but none of them is
+        # above the recorded UID so nothing is fetched again
+        server = self.mocked_server()
+        helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+        calls = [c.args for c in server.uid.call_args_list]
+        self.assertEqual(calls, [("SEARCH", "UID", "10:*", "NOT", "DELETED")])
+
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_IMAP_INCREMENTAL_SYNC", True
+    )
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_EMAIL_QUARANTINE_FAILURES", 2
+    )
+    def test_incremental_sync_retries_failed_message(self):
+        poison = self.messages[5]
+
+        def extract(message, queue, logger, parsed=None):
+            if message == poison:
+                raise ValueError("broken MIME")
+            return extract_email_metadata(message, queue, logger, parsed)
+
+        with mock.patch.object(
+            helpdesk.email, "extract_email_metadata", side_effect=extract
+        ):
+            helpdesk.email.imap_sync(
+                self.queue_public, self.logger, self.mocked_server()
+            )
+            self.assertEqual(Ticket.objects.count(), 3)
+            self.queue_public.refresh_from_db()
+            # UID 9 was processed, but UID 5 must be searched again
+            self.assertEqual(self.queue_public.email_box_imap_last_uid, 4)
+
+            # The processed messages were flagged and expunged
+            self.messages = {5: poison}
+            server = self.mocked_server()
+            helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+        self.assertEqual(
+            server.uid.call_args_list[0].args,
+            ("SEARCH", "UID", "5:*", "NOT", "DELETED"),
+        )
+        # Quarantined on its second failure, and removed from the server
+        self.assertIn(
+            ("STORE", "5", "+FLAGS", "(\\Deleted)"),
+            [c.args for c in server.uid.call_args_list],
+        )
+        self.assertIsNotNone(QuarantinedEmail.objects.get().quarantined)
+        self.queue_public.refresh_from_db()
+        self.assertEqual(self.queue_public.email_box_imap_last_uid, 5)
+
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_IMAP_INCREMENTAL_SYNC", True
+    )
+    @override_settings(QUEUE_EMAIL_BOX_UPDATE_ONLY=True)
+    def test_incremental_sync_skips_messages_left_in_update_only_mode(self):
+        ticket = Ticket.objects.create(title="Existing", queue=self.queue_public)
+        message, _, _ = utils.generate_email_with_subject(
+            subject=f"Re: [{ticket.ticket_for_url}] Existing"
+        )
+        self.messages[9] = message.as_bytes()
+        server = self.mocked_server()
+        helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+
+        # The new messages are left on the server, the reply is processed
+        self.assertEqual(ticket.followup_set.count(), 1)
+        self.assertIn(
+            ("STORE", "9", "+FLAGS", "(\\Deleted)"),
+            [c.args for c in server.uid.call_args_list],
+        )
+        self.queue_public.refresh_from_db()
+        self.assertEqual(self.queue_public.email_box_imap_last_uid, 9)
+
+        server = self.mocked_server()
+        helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+        calls = [c.args for c in server.uid.call_args_list]
+        self.assertEqual(calls, [("SEARCH", "UID", "10:*", "NOT", "DELETED")])
+        self.assertFalse(QuarantinedEmail.objects.exists())
+
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_IMAP_INCREMENTAL_SYNC", True
+    )
+    def test_incremental_sync_rescans_on_uidvalidity_change(self):
+        self.queue_public.email_box_imap_uidvalidity = 999
+        self.queue_public.email_box_imap_last_uid = 4
+        self.queue_public.save()
+        server = self.mocked_server()
+        helpdesk.email.imap_sync(self.queue_public, self.logger, server)
+        self.assertEqual(
+            server.uid.call_args_list[0].args, ("SEARCH", "NOT", "DELETED")
+        )
+        self.assertEqual(Ticket.objects.count(), 4)
+        self.queue_public.refresh_from_db()
+        self.assertEqual(self.queue_public.email_box_imap_uidvalidity, 1000)
+        self.assertEqual(self.queue_public.email_box_imap_last_uid, 9)
+
+
+class FakePOP3(poplib.POP3):
+    """poplib.POP3 reading canned responses, to exercise pipelined commands."""
+
+    def __init__(self, responses):
+        self._debugging = 0
+        self.file = BytesIO(responses)
+        self.sock = mock.Mock()
+
+
+class GetEmailPop3Tests(TestCase):
+    """Checks the UIDL tracking, TOP pre-screening and pipelining of POP3."""
+
+    def setUp(self):
+        self.queue = Queue.objects.create(
+            title="POP3 Queue",
+            slug="pop3",
+            email_box_type="pop3",
+            allow_email_submission=True,
+        )
+        self.logger = logging.getLogger("helpdesk")
+        self.raw = {}
+        self.messages = {}
+        for num, sender in (
+            ("1", "customer@example.com"),
+            ("2", "kept@example.com"),
+            ("3", "spam@example.com"),
+        ):
+            message = MIMEText(f"Message {num}", "plain")
+            message["From"] = sender
+            message["Subject"] = f"Message {num}"
+            self.raw[num] = message.as_bytes()
+            self.messages[num] = self.raw[num].split(b"\n")
+        IgnoreEmail.objects.create(
+            name="Kept", email_address="kept@example.com", keep_in_mailbox=True
+        )
+        IgnoreEmail.objects.create(
+            name="Spam", email_address="spam@example.com", keep_in_mailbox=False
+        )
+
+    def mocked_server(self, nums):
+        server = mock.Mock()
+        server.capa.return_value = {"TOP": [], "UIDL": []}
+        server.list.return_value = (
+            b"+OK",
+            [f"{num} {len(self.raw[num])}".encode() for num in nums],
+            0,
+        )
+        server.uidl.return_value = (
+            b"+OK",
+            [f"{num} uid-{num}".encode() for num in nums],
+            0,
+        )
+        server.top.side_effect = lambda num, __: (
+            b"+OK",
+            self.messages[num][: self.messages[num].index(b"")],
+            0,
+        )
+        server.retr.side_effect = lambda num: (b"+OK", self.messages[num], 0)
+        return server
+
+    @mock.patch.object(
+        helpdesk.email.helpdesk_settings, "HELPDESK_POP3_UIDL_TRACKING", True
+    )
+    def test_ignored_messages_are_not_downloaded(self):
+        server = self.mocked_server(["1", "2", "3"])
+        helpdesk.email.pop3_sync(self.queue, self.logger, server)
+
+        self.assertEqual(Ticket.objects.get(queue=self.queue).title, "Message 1")
+        server.retr.assert_called_once_with("1")
+        self.assertEqual([c.args for c in server.dele.call_args_list], [("3",), ("1",)])
+        self.assertEqual(
+            list(SeenPOP3Message.objects.values_list("uidl", flat=True)), ["uid-2"]
+        )
+
+        # The kept message is not even screened again
+        server = self.mocked_server(["2"])
+        helpdesk.email.pop3_sync(self.queue, self.logger, server)
+        server.top.assert_not_called()
+        server.retr.assert_not_called()
+
+        # and is forgotten once it is removed from the server
+        server = self.mocked_server([])
+        helpdesk.email.pop3_sync(self.queue, self.logger, server)
+        self.assertFalse(SeenPOP3Message.objects.exists())
+
+    def test_retrieval_is_capped_by_listed_sizes(self):
+        server = self.mocked_server(["1", "2", "3"])
+        server.capa.return_value = {}
+        size = max(len(raw) for raw in self.raw.values())
+        with (
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings,
+                "HELPDESK_POP3_RETR_BATCH_MAX_BYTES",
+                2 * size,
+            ),
+            mock.patch.object(
+                helpdesk.email,
+                "parse_email_messages",
+                wraps=helpdesk.email.parse_email_messages,
+            ) as parse,
+        ):
+            helpdesk.email.pop3_sync(self.queue, self.logger, server)
+
+        # Two messages fit in the budget, the third one is retrieved on its own
+        self.assertEqual(
+            [list(c.args[0]) for c in parse.call_args_list], [["1", "2"], ["3"]]
+        )
+        self.assertEqual(server.retr.call_count, 3)
+
+    def test_pipelined_commands(self):
+        server = FakePOP3(
+            b"+OK\r\nfirst\r\n.\r\n-ERR no such message\r\n+OK\r\nthird\r\n.\r\n"
+        )
+        results = helpdesk.email.pop3_long_commands(
+            server, "RETR", [(1,), (2,), (3,)], pipelining=True
+        )
+        self.assertEqual(results, [[b"first"], None, [b"third"]])
+        self.assertEqual(
+            [c.args[0] for c in server.sock.sendall.call_args_list],
+            [b"RETR 1\r\n", b"RETR 2\r\n", b"RETR 3\r\n"],
+        )
+
+
+class FakeIdleServer:
+    """Minimal stand in for imaplib.IMAP4 to exercise IMAP IDLE handling."""
+
+    def __init__(self, lines):
+        self.sock, self.remote = socket.socketpair()
+        self.lines = list(lines)
+        self.sent = []
+        self.tagged_commands = {}
+
+    def _new_tag(self):
+        self.tagged_commands[b"A001"] = None
+        return b"A001"
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def readline(self):
+        return self.lines.pop(0)
+
+    def close(self):
+        self.sock.close()
+        self.remote.close()
+
+
+class InstantEvent(threading.Event):
+    """Event whose wait() returns straight away, recording the timeouts."""
+
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return self.is_set()
+
+
+class MailListenerTests(TestCase):
+    def setUp(self):
+        self.queue_imap = Queue.objects.create(
+            title="Listened Queue",
+            slug="listened",
+            email_box_type="imap",
+            allow_email_submission=True,
+        )
+
+    def test_idle_returns_on_new_mail(self):
+        server = FakeIdleServer(
+            [b"+ idling\r\n", b"* 3 EXISTS\r\n", b"A001 OK IDLE terminated\r\n"]
+        )
+        self.addCleanup(server.close)
+        server.remote.send(b"*")
+        self.assertTrue(helpdesk.email.imap_idle(server, timeout=5))
+        self.assertEqual(server.sent, [b"A001 IDLE\r\n", b"DONE\r\n"])
+        self.assertEqual(server.tagged_commands, {})
+
+    def test_idle_returns_on_timeout(self):
+        server = FakeIdleServer([b"+ idling\r\n", b"A001 OK IDLE terminated\r\n"])
+        self.addCleanup(server.close)
+        self.assertFalse(helpdesk.email.imap_idle(server, timeout=0.05))
+        self.assertEqual(server.sent, [b"A001 IDLE\r\n", b"DONE\r\n"])
+
+    def test_idle_rejected(self):
+        server = FakeIdleServer([b"A001 BAD unknown command\r\n"])
+        self.addCleanup(server.close)
+        with self.assertRaises(helpdesk.email.imaplib.IMAP4.error):
+            helpdesk.email.imap_idle(server, timeout=5)
+
+    @mock.patch("helpdesk.email.connections")
+    @mock.patch("helpdesk.email.imap_idle")
+    @mock.patch("helpdesk.email.imap_fetch_messages")
+    @mock.patch("helpdesk.email.imap_login")
+    @mock.patch("helpdesk.email.connect_to_mail_server")
+    def test_listener_processes_mail_and_reconnects(
+        self, mocked_connect, mocked_login, mocked_fetch, mocked_idle, mocked_conns
+    ):
+        stop_event = InstantEvent()
+        server = mock.Mock(capabilities=("IMAP4REV1", "IDLE"), untagged_responses={})
+        mocked_connect.side_effect = [OSError("connection refused"), server]
+        mocked_idle.side_effect = lambda *args: stop_event.set()
+
+        helpdesk.email.listen_to_queue(self.queue_imap, stop_event)
+
+        # the first connection failed and was retried after a backoff
+        self.assertEqual(mocked_connect.call_count, 2)
+        self.assertEqual(stop_event.waits, [1])
+        mocked_login.assert_called_once_with(self.queue_imap, mock.ANY, server)
+        mocked_fetch.assert_called_once_with(self.queue_imap, mock.ANY, server)
+        server.expunge.assert_called_once()
+        mocked_idle.assert_called_once_with(
+            server, helpdesk.email.IMAP_IDLE_TIMEOUT, stop_event
+        )
+        server.logout.assert_called_once()
+        # database connections are handed back while waiting for mail
+        self.assertTrue(mocked_conns.close_all.called)
+
+    @mock.patch("helpdesk.email.connections")
+    @mock.patch("helpdesk.email.imap_idle")
+    @mock.patch("helpdesk.email.imap_fetch_messages")
+    @mock.patch("helpdesk.email.imap_login")
+    @mock.patch("helpdesk.email.connect_to_mail_server")
+    def test_listener_fetches_mail_announced_during_fetch(
+        self, mocked_connect, mocked_login, mocked_fetch, mocked_idle, mocked_conns
+    ):
+        stop_event = InstantEvent()
+        # EXISTS left over from SELECT is covered by the first fetch
+        server = mock.Mock(
+            capabilities=("IMAP4REV1", "IDLE"),
+            untagged_responses={"EXISTS": [b"2"]},
+        )
+        mocked_connect.return_value = server
+
+        def fetch(q, logger, server):
+            if mocked_fetch.call_count == 1:
+                # New mail announced while the first fetch runs
+                server.untagged_responses["EXISTS"] = [b"3"]
+
+        mocked_fetch.side_effect = fetch
+        mocked_idle.side_effect = lambda *args: stop_event.set()
+
+        helpdesk.email.listen_to_queue(self.queue_imap, stop_event)
+
+        self.assertEqual(mocked_fetch.call_count, 2)
+        mocked_idle.assert_called_once()
+        self.assertEqual(server.untagged_responses, {})
+
+    def test_idle_returns_on_mail_announced_before_idling(self):
+        server = FakeIdleServer(
+            [
+                b"* 4 EXISTS\r\n",
+                b"+ idling\r\n",
+                b"A001 OK IDLE terminated\r\n",
+            ]
+        )
+        self.addCleanup(server.close)
+        self.assertTrue(helpdesk.email.imap_idle(server, timeout=5))
+        self.assertEqual(server.sent, [b"A001 IDLE\r\n", b"DONE\r\n"])
+
+    @mock.patch("helpdesk.management.commands.helpdesk_mail_listener.connections")
+    @mock.patch("helpdesk.management.commands.helpdesk_mail_listener.listen_to_queue")
+    def test_listener_command_only_listens_to_imap_queues(
+        self, mocked_listen, mocked_conns
+    ):
+        Queue.objects.create(
+            title="POP3 Queue",
+            slug="pop",
+            email_box_type="pop3",
+            allow_email_submission=True,
+        )
+        call_command("helpdesk_mail_listener", "--quiet")
+        mocked_listen.assert_called_once()
+        self.assertEqual(mocked_listen.call_args.args[0], self.queue_imap)
+
+
+class FakeSocks5Server(threading.Thread):
+    """SOCKS5 proxy accepting one connection and greeting like a POP3 server."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.destination = None
+
+    def run(self):
+        conn, _ = self.listener.accept()
+        with conn:
+            conn.recv(3)  # version, 1 method, no authentication
+            conn.sendall(b"\x05\x00")
+            request = conn.recv(4)
+            length = conn.recv(1)[0]  # domain name address type
+            host = conn.recv(length).decode()
+            port = int.from_bytes(conn.recv(2), "big")
+            self.destination = (request[1], host, port)
+            conn.sendall(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+            conn.sendall(b"+OK POP3 server ready\r\n")
+            conn.recv(1024)
+        self.listener.close()
+
+
+class GetEmailSocksProxyTests(TestCase):
+    """Checks SOCKS proxies are applied per connection, not process wide."""
+
+    def test_proxied_connection(self):
+        proxy = FakeSocks5Server()
+        proxy.start()
+        q = Queue.objects.create(
+            title="Proxied",
+            slug="proxied",
+            email_box_type="pop3",
+            email_box_host="pop.example.com",
+            email_box_port=110,
+            socks_proxy_type="socks5",
+            socks_proxy_host="127.0.0.1",
+            socks_proxy_port=proxy.port,
+        )
+        default_socket = socket.socket
+        server = helpdesk.email.connect_to_mail_server(
+            q, logging.getLogger("helpdesk"), "pop3"
+        )
+        try:
+            self.assertIsInstance(server, helpdesk.email.ProxiedPOP3)
+            self.assertEqual(server.getwelcome(), b"+OK POP3 server ready")
+        finally:
+            server.close()
+        proxy.join(timeout=5)
+        # CONNECT to the mail server of the queue, resolved by the proxy
+        self.assertEqual(proxy.destination, (1, "pop.example.com", 110))
+        self.assertIs(socket.socket, default_socket)
+
+
+class FakeTokenEndpoint(ThreadingHTTPServer):
+    """OAuth2 token endpoint stand-in counting the tokens it hands out."""
+
+    def __init__(self, expires_in):
+        self.expires_in = expires_in
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                server.requests += 1
+                body = json.dumps(
+                    {
+                        "access_token": f"token-{server.requests}",
+                        "token_type": "Bearer",
+                        "expires_in": server.expires_in,
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/token"
+
+
+class OAuthTokenCacheTests(TestCase):
+    """Checks OAuth access tokens are reused until they are about to expire."""
+
+    def start_endpoint(self, expires_in):
+        endpoint = FakeTokenEndpoint(expires_in)
+        self.addCleanup(endpoint.server_close)
+        self.addCleanup(endpoint.shutdown)
+        oauth = {
+            "token_url": endpoint.url,
+            "client_id": "helpdesk",
+            "secret": "secret",
+            "scope": ["https://outlook.office365.com/.default"],
+        }
+        patcher = mock.patch.object(
+            helpdesk.email.helpdesk_settings, "HELPDESK_OAUTH", oauth
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return endpoint
+
+    def setUp(self):
+        self.logger = logging.getLogger("helpdesk")
+        self.queue = Queue.objects.create(
+            title="OAuth", slug="oauth", email_box_type="oauth"
+        )
+        patcher = mock.patch.dict(os.environ, {"OAUTHLIB_INSECURE_TRANSPORT": "1"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_token_is_cached(self):
+        endpoint = self.start_endpoint(3600)
+        for _ in range(3):
+            helpdesk.email.imap_oauth_login(self.queue, self.logger, mock.Mock())
+        token = helpdesk.email.get_oauth_token(self.logger)
+        self.assertEqual(endpoint.requests, 1)
+        self.assertEqual(token["access_token"], "token-1")
+
+    def test_token_about_to_expire_is_not_cached(self):
+        endpoint = self.start_endpoint(60)
+        helpdesk.email.get_oauth_token(self.logger)
+        token = helpdesk.email.get_oauth_token(self.logger)
+        self.assertEqual(endpoint.requests, 2)
+        self.assertEqual(token["access_token"], "token-2")
+
+    def test_rejected_token_is_dropped(self):
+        endpoint = self.start_endpoint(3600)
+        server = mock.Mock()
+        server.authenticate.side_effect = imaplib.IMAP4.error("AUTHENTICATE failed")
+        with self.assertRaises(imaplib.IMAP4.error):
+            helpdesk.email.imap_oauth_login(self.queue, self.logger, server)
+        helpdesk.email.get_oauth_token(self.logger)
+        self.assertEqual(endpoint.requests, 2)
+
 
 class GetEmailParametricTemplate:
     """TestCase that checks basic email functionality across methods and socks configs."""
@@ -709,7 +1971,9 @@ class GetEmailParametricTemplate:
         }
 
         if self.method == "local":
-            kwargs["email_box_local_dir"] = "/var/lib/mail/helpdesk/"
+            self.mail_dir = mkdtemp()
+            self.addCleanup(rmtree, self.mail_dir)
+            kwargs["email_box_local_dir"] = self.mail_dir
         else:
             kwargs["email_box_host"] = unrouted_email_server
             kwargs["email_box_port"] = unused_port
@@ -734,6 +1998,12 @@ class GetEmailParametricTemplate:
     def tearDown(self):
         rmtree(self.temp_logdir)
 
+    def write_local_emails(self, message: str, count: int):
+        """Write count copies of message to the local mail directory"""
+        for i in range(1, count + 1):
+            with open(os.path.join(self.mail_dir, f"filename{i}"), "wb") as f:
+                f.write(message.encode("utf-8"))
+
     def test_read_plain_email(self):
         """Tests reading plain text emails from a queue and creating tickets.
         For each email source supported, we mock the backend to provide
@@ -764,20 +2034,9 @@ class GetEmailParametricTemplate:
         else:
             # Test local email reading
             if self.method == "local":
-                with (
-                    mock.patch("os.listdir") as mocked_listdir,
-                    mock.patch("helpdesk.email.isfile") as mocked_isfile,
-                    mock.patch("builtins.open", mock.mock_open(read_data=test_email)),
-                    mock.patch("os.unlink"),
-                ):
-                    mocked_isfile.return_value = True
-                    mocked_listdir.return_value = ["filename1", "filename2"]
-
-                    call_command("get_email")
-
-                    mocked_listdir.assert_called_with("/var/lib/mail/helpdesk/")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename1")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename2")
+                self.write_local_emails(test_email, 2)
+                call_command("get_email")
+                self.assertEqual(os.listdir(self.mail_dir), [])
 
             elif self.method == "pop3":
                 # mock poplib.POP3's list and retr methods to provide responses
@@ -791,6 +2050,7 @@ class GetEmailParametricTemplate:
                     (f"1 {test_mail_len}", f"2 {test_mail_len}"),
                 )
                 mocked_poplib_server = mock.Mock()
+                mocked_poplib_server.capa = mock.Mock(return_value={})
                 mocked_poplib_server.list = mock.Mock(return_value=pop3_mail_list)
                 mocked_poplib_server.retr = mock.Mock(
                     side_effect=lambda x: pop3_emails[x]
@@ -824,20 +2084,14 @@ class GetEmailParametricTemplate:
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's uid method with responses
                 # from RFC 3501
                 imap_emails = {
                     "1": ("OK", (("1", test_email),)),
                     "2": ("OK", (("2", test_email),)),
                 }
-                imap_mail_list = ("OK", ("1 2",))
                 mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server.uid = mock_imap_uid(imap_emails)
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -907,20 +2161,9 @@ class GetEmailParametricTemplate:
         else:
             # Test local email reading
             if self.method == "local":
-                with (
-                    mock.patch("os.listdir") as mocked_listdir,
-                    mock.patch("helpdesk.email.isfile") as mocked_isfile,
-                    mock.patch("builtins.open", mock.mock_open(read_data=test_email)),
-                    mock.patch("os.unlink"),
-                ):
-                    mocked_isfile.return_value = True
-                    mocked_listdir.return_value = ["filename1", "filename2"]
-
-                    call_command("get_email")
-
-                    mocked_listdir.assert_called_with("/var/lib/mail/helpdesk/")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename1")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename2")
+                self.write_local_emails(test_email, 2)
+                call_command("get_email")
+                self.assertEqual(os.listdir(self.mail_dir), [])
 
             elif self.method == "pop3":
                 # mock poplib.POP3's list and retr methods to provide responses
@@ -934,6 +2177,7 @@ class GetEmailParametricTemplate:
                     (f"1 {test_mail_len}", f"2 {test_mail_len}"),
                 )
                 mocked_poplib_server = mock.Mock()
+                mocked_poplib_server.capa = mock.Mock(return_value={})
                 mocked_poplib_server.list = mock.Mock(return_value=pop3_mail_list)
                 mocked_poplib_server.retr = mock.Mock(
                     side_effect=lambda x: pop3_emails[x]
@@ -967,20 +2211,14 @@ class GetEmailParametricTemplate:
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's uid method with responses
                 # from RFC 3501
                 imap_emails = {
                     "1": ("OK", (("1", test_email),)),
                     "2": ("OK", (("2", test_email),)),
                 }
-                imap_mail_list = ("OK", ("1 2",))
                 mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server.uid = mock_imap_uid(imap_emails)
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1054,20 +2292,9 @@ class GetEmailParametricTemplate:
         else:
             # Test local email reading
             if self.method == "local":
-                with (
-                    mock.patch("os.listdir") as mocked_listdir,
-                    mock.patch("helpdesk.email.isfile") as mocked_isfile,
-                    mock.patch("builtins.open", mock.mock_open(read_data=test_email)),
-                    mock.patch("os.unlink"),
-                ):
-                    mocked_isfile.return_value = True
-                    mocked_listdir.return_value = ["filename1", "filename2"]
-
-                    call_command("get_email")
-
-                    mocked_listdir.assert_called_with("/var/lib/mail/helpdesk/")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename1")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename2")
+                self.write_local_emails(test_email, 2)
+                call_command("get_email")
+                self.assertEqual(os.listdir(self.mail_dir), [])
 
             elif self.method == "pop3":
                 # mock poplib.POP3's list and retr methods to provide responses
@@ -1081,6 +2308,7 @@ class GetEmailParametricTemplate:
                     (f"1 {test_mail_len}", f"2 {test_mail_len}"),
                 )
                 mocked_poplib_server = mock.Mock()
+                mocked_poplib_server.capa = mock.Mock(return_value={})
                 mocked_poplib_server.list = mock.Mock(return_value=pop3_mail_list)
                 mocked_poplib_server.retr = mock.Mock(
                     side_effect=lambda x: pop3_emails[x]
@@ -1114,20 +2342,14 @@ class GetEmailParametricTemplate:
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's uid method with responses
                 # from RFC 3501
                 imap_emails = {
                     "1": ("OK", (("1", test_email),)),
                     "2": ("OK", (("2", test_email),)),
                 }
-                imap_mail_list = ("OK", ("1 2",))
                 mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server.uid = mock_imap_uid(imap_emails)
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1166,6 +2388,42 @@ class GetEmailParametricTemplate:
             self.assertEqual(ticket2.title, test_email_subject)
             self.assertEqual(ticket2.description, test_email_body)
 
+    def test_html_text_extraction(self):
+        """
+        Tests that the text of an HTML body skips the style and script tags,
+        that an empty body gives no full body, and that only the first
+        HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE characters are parsed, with a warning.
+        """
+        html = (
+            "<html><head><style>p {}</style><title>Title</title></head>"
+            "<body><p>Hi &amp; welcome</p><script>var x;</script><style>a {}</style>"
+            "<div>Bye</div></body></html>"
+        )
+        self.assertEqual(
+            helpdesk.email.attempt_body_extract_from_html(html),
+            ("Hi & welcomeBye", "Hi & welcomeBye"),
+        )
+        self.assertEqual(
+            helpdesk.email.attempt_body_extract_from_html("<p>No body</p>"),
+            ("", None),
+        )
+        for empty in ("", "<html><body></body></html>"):
+            self.assertEqual(
+                helpdesk.email.attempt_body_extract_from_html(empty), ("", None)
+            )
+        with (
+            mock.patch.object(
+                helpdesk.email.helpdesk_settings,
+                "HELPDESK_EMAIL_HTML_TEXT_MAX_SIZE",
+                100,
+            ),
+            self.assertLogs("helpdesk", logging.WARNING) as logs,
+        ):
+            self.assertEqual(
+                helpdesk.email.attempt_body_extract_from_html(html)[0], "Hi & welcome"
+            )
+        self.assertIn(f"first 100 of the {len(html)} characters", logs.output[0])
+
     def test_read_html_multipart_email(self):
         """Tests reading multipart MIME (HTML body and plain text alternative)
         emails from a queue and creating tickets.
@@ -1224,22 +2482,9 @@ class GetEmailParametricTemplate:
         else:
             # Test local email reading
             if self.method == "local":
-                with (
-                    mock.patch("os.listdir") as mocked_listdir,
-                    mock.patch("helpdesk.email.isfile") as mocked_isfile,
-                    mock.patch(
-                        "builtins.open", mock.mock_open(read_data=msg.as_string())
-                    ),
-                    mock.patch("os.unlink"),
-                ):
-                    mocked_isfile.return_value = True
-                    mocked_listdir.return_value = ["filename1", "filename2"]
-
-                    call_command("get_email")
-
-                    mocked_listdir.assert_called_with("/var/lib/mail/helpdesk/")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename1")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename2")
+                self.write_local_emails(msg.as_string(), 2)
+                call_command("get_email")
+                self.assertEqual(os.listdir(self.mail_dir), [])
 
             elif self.method == "pop3":
                 # mock poplib.POP3's list and retr methods to provide responses
@@ -1253,6 +2498,7 @@ class GetEmailParametricTemplate:
                     (f"1 {test_mail_len}", f"2 {test_mail_len}"),
                 )
                 mocked_poplib_server = mock.Mock()
+                mocked_poplib_server.capa = mock.Mock(return_value={})
                 mocked_poplib_server.list = mock.Mock(return_value=pop3_mail_list)
                 mocked_poplib_server.retr = mock.Mock(
                     side_effect=lambda x: pop3_emails[x]
@@ -1286,20 +2532,14 @@ class GetEmailParametricTemplate:
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's uid method with responses
                 # from RFC 3501
                 imap_emails = {
                     "1": ("OK", (("1", msg.as_string()),)),
                     "2": ("OK", (("2", msg.as_string()),)),
                 }
-                imap_mail_list = ("OK", ("1 2",))
                 mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server.uid = mock_imap_uid(imap_emails)
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1378,19 +2618,9 @@ class GetEmailParametricTemplate:
         else:
             # Test local email reading
             if self.method == "local":
-                with (
-                    mock.patch("os.listdir") as mocked_listdir,
-                    mock.patch("helpdesk.email.isfile") as mocked_isfile,
-                    mock.patch("builtins.open", mock.mock_open(read_data=test_email)),
-                    mock.patch("os.unlink"),
-                ):
-                    mocked_isfile.return_value = True
-                    mocked_listdir.return_value = ["filename1"]
-
-                    call_command("get_email")
-
-                    mocked_listdir.assert_called_with("/var/lib/mail/helpdesk/")
-                    mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename1")
+                self.write_local_emails(test_email, 1)
+                call_command("get_email")
+                self.assertEqual(os.listdir(self.mail_dir), [])
 
             elif self.method == "pop3":
                 # mock poplib.POP3's list and retr methods to provide responses
@@ -1400,6 +2630,7 @@ class GetEmailParametricTemplate:
                 }
                 pop3_mail_list = ("+OK 1 message", (f"1 {test_mail_len}"))
                 mocked_poplib_server = mock.Mock()
+                mocked_poplib_server.capa = mock.Mock(return_value={})
                 mocked_poplib_server.list = mock.Mock(return_value=pop3_mail_list)
                 mocked_poplib_server.retr = mock.Mock(
                     side_effect=lambda x: pop3_emails["1"]
@@ -1432,19 +2663,13 @@ class GetEmailParametricTemplate:
 
             elif self.method == "oauth":
                 # mock the oauthlib session and requests oauth backendclient
-                # then mock imaplib.IMAP4's search and fetch methods with responses
+                # then mock imaplib.IMAP4's uid method with responses
                 # from RFC 3501
                 imap_emails = {
                     "1": ("OK", (("1", test_email),)),
                 }
-                imap_mail_list = ("OK", ("1",))
                 mocked_imaplib_server = mock.Mock()
-                mocked_imaplib_server.search = mock.Mock(return_value=imap_mail_list)
-                # we ignore the second arg as the data item/mime-part is
-                # constant (RFC822)
-                mocked_imaplib_server.fetch = mock.Mock(
-                    side_effect=lambda x, _: imap_emails[x]
-                )
+                mocked_imaplib_server.uid = mock_imap_uid(imap_emails)
 
                 mocked_oauth_backend_client = mock.Mock()
                 with mock.patch(
@@ -1517,6 +2742,8 @@ class GetEmailCCHandling(TestCase):
 
     def setUp(self):
         self.temp_logdir = mkdtemp()
+        self.mail_dir = mkdtemp()
+        self.addCleanup(rmtree, self.mail_dir)
 
         kwargs = {
             "title": "CC Queue",
@@ -1525,7 +2752,7 @@ class GetEmailCCHandling(TestCase):
             "allow_email_submission": True,
             "email_address": "queue@example.com",
             "email_box_type": "local",
-            "email_box_local_dir": "/var/lib/mail/helpdesk/",
+            "email_box_local_dir": self.mail_dir,
             "logging_dir": self.temp_logdir,
             "logging_type": "none",
         }
@@ -1631,19 +2858,10 @@ class GetEmailCCHandling(TestCase):
             + test_email_body
         )
 
-        with (
-            mock.patch("os.listdir") as mocked_listdir,
-            mock.patch("helpdesk.email.isfile") as mocked_isfile,
-            mock.patch("builtins.open", mock.mock_open(read_data=test_email)),
-            mock.patch("os.unlink"),
-        ):
-            mocked_isfile.return_value = True
-            mocked_listdir.return_value = ["filename1"]
-
-            call_command("get_email")
-
-            mocked_listdir.assert_called_with("/var/lib/mail/helpdesk/")
-            mocked_isfile.assert_any_call("/var/lib/mail/helpdesk/filename1")
+        with open(os.path.join(self.mail_dir, "filename1"), "wb") as f:
+            f.write(test_email.encode("utf-8"))
+        call_command("get_email")
+        self.assertEqual(os.listdir(self.mail_dir), [])
         # 9 unique email addresses are CC'd when all is done
         self.assertEqual(len(TicketCC.objects.filter(ticket=1)), 9)
         # next we make sure no duplicates were added, and the
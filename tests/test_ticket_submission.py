@@ -10,7 +10,11 @@ from django.test import TestCase
 from django.test.client import Client
 from django.urls import reverse
 
-from helpdesk.email import MULTIPLE_USERS_SAME_EMAIL_MSG, extract_email_metadata
+from helpdesk.email import (
+    MULTIPLE_USERS_SAME_EMAIL_MSG,
+    create_ticket_cc,
+    extract_email_metadata,
+)
 from helpdesk.models import (
     CustomField,
     FollowUp,
@@ -520,6 +524,28 @@ class EmailInteractionsTestCase(TestCase):
             found, "The duplicated email across user ID's was not sent a notification."
         )
 
+    def test_create_ticket_cc_queries(self):
+        """
+        Ensure that the cc list of an e-mail is resolved with a constant number
+        of queries, and that addresses already subscribed are not added twice
+        """
+        ticket = Ticket.objects.create(title="CC", queue=self.queue_public)
+        User.objects.create(username="User_cc", email="cc0@example.com")
+        existing = TicketCC.objects.create(ticket=ticket, email="cc1@example.com")
+        cc_list = [("", f"cc{i}@example.com") for i in range(50)]
+
+        # Users, existing subscriptions and the bulk insert
+        with self.assertNumQueries(3):
+            ticket_ccs = create_ticket_cc(ticket, cc_list + cc_list[:2], logger)
+
+        self.assertEqual(len(ticket_ccs), 50)
+        self.assertEqual(ticket_ccs[1], existing)
+        self.assertEqual(TicketCC.objects.filter(ticket=ticket).count(), 50)
+        self.assertEqual(
+            TicketCC.objects.get(ticket=ticket, email="cc0@example.com").user.username,
+            "User_cc",
+        )
+
     def test_create_followup_from_email_with_valid_message_id_with_no_initial_cc_list(
         self,
     ):
@@ -608,6 +634,44 @@ class EmailInteractionsTestCase(TestCase):
         # for cc_email in cc_list:
         # self.assertIn(cc_email, mail.outbox[expected_email_count - 1].to)
 
+    def test_create_followup_from_email_with_references_header(self):
+        """
+        Ensure that a reply without In-Reply-To but with the original message
+        in its References header is threaded into the existing ticket, and
+        that unknown or malformed references are skipped.
+        """
+        msg = email.message.Message()
+        message_id = f"<{uuid.uuid4().hex}@example.com>"
+        msg.__setitem__("Message-ID", message_id)
+        msg.__setitem__("Subject", self.ticket_data["title"])
+        msg.__setitem__("From", "foo@bar.py")
+        msg.__setitem__("To", self.queue_public.email_address)
+        msg.__setitem__("Content-Type", "text/plain;")
+        msg.set_payload(self.ticket_data["description"])
+        extract_email_metadata(str(msg), self.queue_public, logger=logger)
+        ticket = FollowUp.objects.get(message_id=message_id).ticket
+
+        reply = email.message.Message()
+        reply.__setitem__("Message-ID", f"<{uuid.uuid4().hex}@example.com>")
+        reply.__setitem__(
+            "References",
+            f"{message_id} garbage <{uuid.uuid4().hex}@example.com>",
+        )
+        reply.__setitem__("Subject", "Re: something unrelated")
+        reply.__setitem__("From", "foo@bar.py")
+        reply.__setitem__("To", self.queue_public.email_address)
+        reply.__setitem__("Content-Type", "text/plain;")
+        reply.set_payload("A reply threaded by References only")
+        extract_email_metadata(str(reply), self.queue_public, logger=logger)
+
+        self.assertEqual(Ticket.objects.count(), 1)
+        self.assertEqual(
+            ticket.followup_set.filter(
+                comment__contains="threaded by References"
+            ).count(),
+            1,
+        )
+
     def test_create_followup_from_email_with_valid_message_id_with_original_cc_list_included(
         self,
     ):